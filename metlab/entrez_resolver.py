@@ -0,0 +1,240 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Concurrent, rate-limited Entrez access for MetaMaker.
+
+The EntrezClient talks to the NCBI E-utilities (or any server mimicking them,
+given by base_url) over plain HTTP, sharing a single token bucket between all
+threads so that the NCBI limits of 3 requests per second (10 with an API key)
+are respected. The MetadataResolver uses a client to resolve candidate genome
+ids into dataset metadata, with batched esummary calls and a bounded pool of
+worker threads for the per-organism searches.
+"""
+
+import time
+import socket
+import urllib
+import urllib2
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from Bio import Entrez
+
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter.
+    """
+
+    def __init__(self, rate, capacity = 1):
+        """
+        Allows on average `rate` acquisitions per second, with bursts of at
+        most `capacity`.
+        """
+        self.rate     = float(rate)
+        self.capacity = float(capacity)
+        self.tokens   = float(capacity)
+        self.last     = time.time()
+        self._lock    = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available, and takes it.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+class EntrezClient(object):
+    """
+    Minimal thread-safe E-utilities client, with a shared rate limit.
+    """
+
+    def __init__(self, base_url = EUTILS_URL, email = None, api_key = None, rate = None,
+                 retries = 5, log = None):
+        self.base_url = base_url.rstrip('/')
+        self.email    = email if email else Entrez.email
+        self.api_key  = api_key
+        self.retries  = retries
+        self.bucket   = TokenBucket(rate if rate else (10 if api_key else 3))
+        self.log      = log if log else logging.getLogger( __name__ )
+
+    def open(self, utility, **params):
+        """
+        Sends a request to an E-utility (e.g. 'esearch') and returns the
+        response handle. Transient errors are retried with exponential
+        backoff.
+        """
+        params['tool'] = 'MetaMaker'
+        if self.email:
+            params['email'] = self.email
+        if self.api_key:
+            params['api_key'] = self.api_key
+        url  = "%s/%s.fcgi" % (self.base_url, utility)
+        data = urllib.urlencode(params, True)
+        for attempt in xrange(self.retries):
+            self.bucket.acquire()
+            try:
+                return urllib2.urlopen(url, data, timeout = 120)
+            except urllib2.HTTPError as e:
+                if attempt == self.retries-1 or (e.code // 100 == 4 and e.code != 429):
+                    raise
+            except (urllib2.URLError, socket.error) as e:
+                if attempt == self.retries-1:
+                    raise
+            self.log.debug("Retrying %s request" % utility)
+            time.sleep(0.5 * 2**attempt)
+
+    def read(self, utility, **params):
+        """
+        Sends a request and parses the XML response with Bio.Entrez.
+        """
+        handle = self.open(utility, **params)
+        try:
+            return Entrez.read(handle)
+        finally:
+            handle.close()
+
+    def esearch(self, db, term, **params):
+        return self.read('esearch', db = db, term = term, **params)
+
+    def esummary(self, db, ids):
+        """
+        Returns the summaries of all ids in a single request, as a dict
+        indexed by id.
+        """
+        if not ids:
+            return {}
+        return dict((str(s['Id']), s) for s in self.read('esummary', db = db,
+                                                         id = ",".join(map(str, ids))))
+
+    def efetch(self, db, id, **params):
+        return self.open('efetch', db = db, id = id, **params)
+
+class MetadataResolver(object):
+    """
+    Resolves candidate NCBI genome ids into MetaMaker dataset metadata.
+    """
+
+    def __init__(self, client, workers = 4, batch_size = 100, cache = None,
+                 offline = False, log = None):
+        """
+        Arguments are:
+        client     : an EntrezClient
+        workers    : number of concurrent requests
+        batch_size : max number of ids per esummary request
+        cache      : optional GenomeCache used to store the lookups
+        offline    : only use cached lookups
+        """
+        self.client     = client
+        self.workers    = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.cache      = cache
+        self.offline    = offline
+        self.log        = log if log else logging.getLogger( __name__ )
+
+    def _cached_batch(self, prefix, keys, fetch):
+        """
+        Returns a dict with the values for all keys that are either cached, or
+        returned by fetch(missing keys), in batches. Fetched values are added
+        to the cache.
+        """
+        output  = {}
+        missing = []
+        for key in keys:
+            value = self.cache.get_metadata("%s:%s" % (prefix, key)) if self.cache else None
+            if value is None:
+                missing += [key]
+            else:
+                output[key] = value
+        if self.offline:
+            return output
+        for start in xrange(0, len(missing), self.batch_size):
+            for key, value in fetch(missing[start:start+self.batch_size]).iteritems():
+                output[key] = value
+                if self.cache and value is not None:
+                    self.cache.put_metadata("%s:%s" % (prefix, key), value)
+        return output
+
+    def _map(self, function, items):
+        """
+        Applies function to all items using the worker threads, returning a
+        dict of item: result for the items where function didn't fail.
+        """
+        def call(item):
+            try:
+                return item, function(item)
+            except Exception as e:
+                self.log.debug("   - Lookup of '%s' failed: %s" % (item, e))
+                return item, None
+        pool = ThreadPool(min(self.workers, max(1, len(items))))
+        try:
+            return dict(pool.map(call, items))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _fetch_summaries(self, genome_ids):
+        return dict((i, dict(s)) for i, s in
+                    self.client.esummary("genome", genome_ids).iteritems())
+
+    def _fetch_tax_ids(self, organisms):
+        """
+        Searches the taxonomy for each organism, and verifies the hits with a
+        single batched esummary.
+        """
+        search = lambda o: self.client.esearch("taxonomy", o)['IdList'][0]
+        hits = dict((o, i) for o, i in self._map(search, organisms).iteritems() if i)
+        summaries = self.client.esummary("taxonomy", sorted(set(hits.values())))
+        output = {}
+        for organism, tax_id in hits.iteritems():
+            summary = summaries.get(str(tax_id))
+            if summary and summary['ScientificName'] == organism:
+                output[organism] = str(summary['TaxId'])
+        return output
+
+    def _fetch_nuc_ids(self, terms):
+        search = lambda t: self.client.esearch("nucleotide", t)['IdList'][0]
+        return dict((t, i) for t, i in self._map(search, terms).iteritems() if i)
+
+    def resolve(self, genome_ids, window = 50):
+        """
+        Generator yielding (genome id, metadata) for each genome id, in order,
+        where metadata is None if the genome can't be used. Ids are resolved
+        `window` at a time, so callers can stop early.
+        """
+        for start in xrange(0, len(genome_ids), window):
+            chunk = genome_ids[start:start+window]
+            summaries = self._cached_batch("genome_summary", chunk, self._fetch_summaries)
+            organisms = sorted(set(s['Organism_Name'] for s in summaries.values()))
+            tax_ids = self._cached_batch("tax_id", organisms, self._fetch_tax_ids)
+            terms = ["%s[Organism] complete genome" % o for o in organisms]
+            nuc_ids = self._cached_batch("nuc_id", terms, self._fetch_nuc_ids)
+
+            for genome_id in chunk:
+                summary = summaries.get(genome_id)
+                if not summary:
+                    self.log.debug(" + Skipping %s: no summary" % genome_id)
+                    yield genome_id, None
+                    continue
+                organism = summary['Organism_Name']
+                tax_id = tax_ids.get(organism)
+                nuc_id = nuc_ids.get("%s[Organism] complete genome" % organism)
+                if not tax_id or not nuc_id:
+                    self.log.debug(" + Skipping %s: no %s id" % (organism,
+                                                                 "nucleotide" if tax_id else "tax"))
+                    yield genome_id, None
+                    continue
+                yield genome_id, {'genome_id':genome_id, 'def':summary['DefLine'],
+                                  'organism':organism,
+                                  'project':summary['ProjectID'],
+                                  'nuc_id':nuc_id,
+                                  'tax_id':tax_id}
@@ -0,0 +1,369 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Evaluates taxonomic classifications of a MetaMaker dataset against its truth.
+
+Reads the per-read kraken output (kraken_results.txt) and/or the parsed vFam
+hmmsearch results (hmmsearch-parsed.txt) of the 'Taxonomic classification'
+pipeline step, and reports per-taxon precision, recall and abundance error,
+using the truth index and key file written by MetaMaker. The classifier output
+is parsed in chunks by a pool of worker processes, which only send back counts
+(kraken) or the best hit of each read in the chunk (hmmsearch). The counts are
+merged as they arrive, and the best hits into one e-value and taxon per read
+of the dataset, so memory use doesn't grow with the size of the classifier
+output.
+
+Taxa are compared by taxonomy id. Given the NCBI taxonomy (nodes.dmp), they
+are compared at a given rank, where a classification above that rank counts
+as unassigned. The vFam families and genera of hmmsearch hits are looked up by
+scientific name in names.dmp, so hmmsearch evaluation needs both files, and a
+rank of 'family' or 'genus'.
+"""
+
+import os
+import sys
+import ast
+import array
+import numpy
+import itertools
+import multiprocessing
+from truth_index import load_truth
+
+# Bytes of classifier output per parsing job
+CHUNK_SIZE = 2**25
+
+HMMSEARCH_RANKS = {'family':3, 'genus':4}
+
+class Taxonomy(object):
+    """
+    NCBI taxonomy tree, held as arrays indexed by taxonomy id.
+    """
+    
+    def __init__(self, nodes, names = None, name_rank = None):
+        """
+        Reads nodes.dmp, and, if given, the scientific names in names.dmp (of
+        all taxa, or only those of name_rank).
+        """
+        taxa, parents, ranks = [], [], []
+        with open(nodes) as f:
+            for line in f:
+                cols = line.split("\t|\t", 3)
+                taxa += [int(cols[0])]
+                parents += [int(cols[1])]
+                ranks += [cols[2]]
+        self.rank_names = sorted(set(ranks))
+        codes = dict((r, i) for i, r in enumerate(self.rank_names))
+        taxa = numpy.array(taxa)
+        self.parent = numpy.zeros(taxa.max() + 1, numpy.int32)
+        self.parent[taxa] = parents
+        self.rank = numpy.zeros(taxa.max() + 1, numpy.int16) - 1
+        self.rank[taxa] = [codes[r] for r in ranks]
+        self.names = {}
+        if names:
+            wanted = codes.get(name_rank, None)
+            with open(names) as f:
+                for line in f:
+                    if not line.endswith("scientific name\t|\n"):
+                        continue
+                    cols = line.split("\t|\t", 2)
+                    taxid = int(cols[0])
+                    if name_rank is None or (taxid < len(self.rank) and
+                                             self.rank[taxid] == wanted):
+                        self.names[taxid] = cols[1]
+    
+    def at_rank(self, taxids, rank):
+        """
+        Returns the ancestors of taxids at rank, or 0 for unknown taxa and
+        taxa above that rank.
+        """
+        taxids = numpy.asarray(taxids, numpy.int64)
+        known = (taxids > 0) & (taxids < len(self.parent))
+        current = numpy.where(known, taxids, 0)
+        result = numpy.zeros(len(taxids), numpy.int64)
+        if rank not in self.rank_names:
+            return result
+        code = self.rank_names.index(rank)
+        # the root (taxid 1) is its own parent
+        while current.any():
+            hit = (self.rank[current] == code) & (result == 0)
+            result[hit] = current[hit]
+            current = numpy.where((current > 1) & (result == 0), self.parent[current], 0)
+        return result
+
+def read_key(keyfile):
+    """
+    Returns the genome ids of a MetaMaker key file, in dataset order.
+    """
+    separator = "\t" if keyfile.endswith(".tsv") else ","
+    with open(keyfile) as f:
+        f.readline()
+        return [line.split(separator)[0] for line in f if line.strip()]
+
+def read_origin(read_id, genomes):
+    """
+    Returns (genome index, read index, mate) from a MetaMaker read id, as in
+    'REC.1|ref:<genome id>-<read index>|pos:<start>-<end>/<mate>', where the
+    mate is 0 for single reads. Returns None for other read ids.
+    """
+    start = read_id.find("|ref:")
+    end = read_id.find("|pos:", start)
+    if start < 0 or end < 0:
+        return None
+    genome_id, _, index = read_id[start+5:end].rpartition("-")
+    if genome_id not in genomes:
+        return None
+    mate = int(read_id[-1]) if read_id[-2:-1] == "/" else 0
+    return genomes[genome_id], int(index), mate
+
+def _chunks(filename, chunk_size = CHUNK_SIZE):
+    size = os.path.getsize(filename)
+    return [(start, min(size, start + chunk_size)) for start in xrange(0, size, chunk_size)]
+
+def _lines(filename, start, end):
+    """
+    Yields the lines of filename starting within the byte range [start, end).
+    """
+    with open(filename) as f:
+        if start:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+def _parse_kraken(args):
+    """
+    Counts the kraken classifications of a chunk, returning (genome, taxid,
+    count) arrays, and the number of lines not from the simulated dataset.
+    """
+    filename, start, end, genomes = args
+    genome, taxid, foreign = array.array('l'), array.array('l'), 0
+    for line in _lines(filename, start, end):
+        cols = line.split("\t", 3)
+        if len(cols) < 3:
+            continue
+        origin = read_origin(cols[1], genomes)
+        if origin is None:
+            foreign += 1
+            continue
+        genome.append(origin[0])
+        taxid.append(int(cols[2]) if cols[0] == 'C' else 0)
+    pairs = numpy.frombuffer(genome, numpy.int_).astype(numpy.int64) << 32 | \
+            numpy.frombuffer(taxid, numpy.int_).astype(numpy.int64)
+    pairs, counts = numpy.unique(pairs, return_counts = True)
+    return pairs, counts, foreign
+
+def _merge_counts(pairs, counts, chunk_pairs, chunk_counts):
+    """
+    Adds the counts of a chunk to the running (pairs, counts) totals.
+    """
+    pairs, index = numpy.unique(numpy.concatenate([pairs, chunk_pairs]), return_inverse = True)
+    return pairs, numpy.bincount(index, numpy.concatenate([counts, chunk_counts]),
+                                 len(pairs)).astype(numpy.int64)
+
+def _parse_hmmsearch(args):
+    """
+    Parses the hits of a chunk of hmmsearch-parsed.txt, and returns the best
+    (lowest e-value) hit of each read in the chunk as (read, evalue, taxid)
+    arrays, where read is the read's row number in offsets order (the first 
+    row of each genome, as from the truth index), and taxid that of the most
+    common family or genus of the hit vFam, looked up in taxa (name -> 
+    taxid), and the number of lines not from the simulated dataset (or
+    beyond its reads).
+    """
+    filename, start, end, genomes, column, taxa, offsets, mates = args
+    read, evalue, taxid, foreign = array.array('l'), array.array('d'), array.array('l'), 0
+    for line in _lines(filename, start, end):
+        cols = line.split("\t")
+        if len(cols) < 5 or cols[0] == "seq_header":
+            continue
+        # FragGeneScan gene ids are <read id>_<start>_<end>_<strand>
+        origin = read_origin(cols[0].rsplit("_", 3)[0], genomes)
+        if origin is None:
+            foreign += 1
+            continue
+        groups = ast.literal_eval(cols[column])
+        best = max(groups, key = groups.get) if groups else None
+        genome, index, mate = origin
+        row = offsets[genome] + index*mates + max(mate - 1, 0)
+        if row >= offsets[genome + 1]:
+            foreign += 1
+            continue
+        read.append(row)
+        evalue.append(float(cols[2]))
+        taxid.append(taxa.get(best, 0))
+    read, evalue, taxid = [numpy.frombuffer(x, t) for x, t in 
+                           [(read, numpy.int_), (evalue, numpy.float64), (taxid, numpy.int_)]]
+    order = numpy.lexsort((evalue, read))
+    read, first = numpy.unique(read[order], return_index = True)
+    best = order[first]
+    return read, evalue[best], taxid[best], foreign
+
+def _scores(truth_counts, true_taxa, genome, predicted, counts):
+    """
+    Returns per-taxon rows of (taxid, true reads, predicted reads, true
+    positives, precision, recall, true abundance, predicted abundance,
+    abundance error), given the read count and taxon of each genome, and the
+    (genome, predicted taxon, count) classifications.
+    """
+    taxa = numpy.union1d(true_taxa[true_taxa > 0], predicted[predicted > 0])
+    known = true_taxa > 0
+    true = numpy.bincount(numpy.searchsorted(taxa, true_taxa[known]), truth_counts[known],
+                          len(taxa) + 1)
+    assigned = predicted > 0
+    index = numpy.searchsorted(taxa, predicted[assigned])
+    pred = numpy.bincount(index, counts[assigned], len(taxa) + 1)
+    correct = assigned & (predicted == true_taxa[genome])
+    tp = numpy.bincount(numpy.searchsorted(taxa, predicted[correct]), counts[correct],
+                        len(taxa) + 1)
+    true, pred, tp = true[:len(taxa)], pred[:len(taxa)], tp[:len(taxa)]
+    true_abundance = true / max(1.0, true.sum())
+    pred_abundance = pred / max(1.0, pred.sum())
+    rows = []
+    for i, taxid in enumerate(taxa):
+        rows += [(int(taxid), int(true[i]), int(pred[i]), int(tp[i]),
+                  tp[i] / pred[i] if pred[i] else float('nan'),
+                  tp[i] / true[i] if true[i] else float('nan'),
+                  true_abundance[i], pred_abundance[i],
+                  pred_abundance[i] - true_abundance[i])]
+    return rows
+
+def evaluate(truthfile, keyfile, kraken = None, hmmsearch = None, taxonomy = None,
+             rank = None, workers = 1, chunk_size = CHUNK_SIZE):
+    """
+    Evaluates kraken and/or hmmsearch results against a MetaMaker dataset,
+    at rank if a Taxonomy is given (with the names of that rank, for
+    hmmsearch). Returns a dict of {classifier: (summary, rows)}, where rows
+    are as returned by _scores, and the summary is a dict of overall numbers.
+    """
+    if hmmsearch and (not taxonomy or not taxonomy.names or rank not in HMMSEARCH_RANKS):
+        raise ValueError("hmmsearch evaluation needs the taxonomy nodes and names, "
+                         "and a rank of %s." % " or ".join(sorted(HMMSEARCH_RANKS)))
+    truth = load_truth(truthfile)
+    genome_ids = read_key(keyfile)
+    genomes = dict((g, i) for i, g in enumerate(genome_ids))
+    
+    # reads (or mates) and taxon per genome
+    taxids = numpy.zeros(len(genome_ids), numpy.int64)
+    truth_counts = numpy.zeros(len(genome_ids), numpy.int64)
+    mates = 1
+    for start in xrange(0, len(truth), 2**24):
+        genome = truth['genome'][start:start + 2**24]
+        taxids[genome] = truth['taxid'][start:start + 2**24]
+        truth_counts += numpy.bincount(genome, minlength = len(genome_ids))
+        mates = max(mates, int(truth['mate'][start:start + 2**24].max()) if len(genome) else 1)
+    
+    to_rank = (lambda t: taxonomy.at_rank(t, rank)) if taxonomy and rank else \
+              (lambda t: numpy.asarray(t, numpy.int64))
+    true_taxa = to_rank(taxids)
+    
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    imap = pool.imap if pool else itertools.imap
+    results = {}
+    try:
+        if kraken:
+            pairs, counts, foreign = numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64), 0
+            jobs = [(kraken, s, e, genomes) for s, e in _chunks(kraken, chunk_size)]
+            for p, c, f in imap(_parse_kraken, jobs):
+                pairs, counts = _merge_counts(pairs, counts, p, c)
+                foreign += f
+            genome, predicted = pairs >> 32, pairs & 0xffffffff
+            classified = counts[predicted > 0].sum()
+            predicted = to_rank(predicted)
+            results['kraken'] = (dict(reads = counts.sum(), classified = classified,
+                                      foreign = foreign),
+                                 _scores(truth_counts, true_taxa, genome, predicted, counts))
+        if hmmsearch:
+            name_taxa = dict((n, t) for t, n in taxonomy.names.iteritems())
+            column = HMMSEARCH_RANKS[rank]
+            # the best (lowest e-value) hit of each read, earlier hits first
+            offsets = numpy.concatenate([[0], numpy.cumsum(truth_counts)])
+            best_evalue = numpy.zeros(offsets[-1]) + numpy.inf
+            best_taxid = numpy.zeros(offsets[-1], numpy.int32)
+            foreign = 0
+            jobs = [(hmmsearch, s, e, genomes, column, name_taxa, offsets.tolist(), mates)
+                    for s, e in _chunks(hmmsearch, chunk_size)]
+            for read, evalue, taxid, f in imap(_parse_hmmsearch, jobs):
+                better = evalue < best_evalue[read]
+                best_evalue[read[better]] = evalue[better]
+                best_taxid[read[better]] = taxid[better]
+                foreign += f
+            hit = numpy.flatnonzero(best_evalue < numpy.inf)
+            genome = numpy.searchsorted(offsets, hit, 'right') - 1
+            predicted = best_taxid[hit].astype(numpy.int64)
+            counts = numpy.ones(len(hit), numpy.int64)
+            results['hmmsearch'] = (dict(reads = len(hit), classified = (predicted > 0).sum(),
+                                         foreign = foreign),
+                                    _scores(truth_counts, true_taxa, genome, predicted, counts))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    for summary, rows in results.values():
+        total = truth_counts.sum()
+        tp = sum(r[3] for r in rows)
+        assigned = sum(r[2] for r in rows)
+        summary.update(truth = total, assigned = assigned,
+                       precision = tp / float(assigned) if assigned else float('nan'),
+                       recall = tp / float(total) if total else float('nan'),
+                       abundance_l1 = sum(abs(r[8]) for r in rows))
+    return results
+
+def write_report(results, output = sys.stdout, taxonomy_names = None):
+    """
+    Writes evaluation results as tab separated tables.
+    """
+    header = ["classifier", "taxid", "name", "true_reads", "predicted_reads", "true_positives",
+              "precision", "recall", "true_abundance", "predicted_abundance", "abundance_error"]
+    output.write("\t".join(header) + "\n")
+    for classifier in sorted(results):
+        summary, rows = results[classifier]
+        for row in rows:
+            name = taxonomy_names.get(row[0], "") if taxonomy_names else ""
+            output.write("%s\t%i\t%s\t%i\t%i\t%i\t%.4f\t%.4f\t%.6f\t%.6f\t%.6f\n" % \
+                         ((classifier, row[0], name) + tuple(row[1:])))
+    for classifier in sorted(results):
+        summary, _ = results[classifier]
+        output.write(("# %s: %i of %i reads classified, %i assigned at rank, precision %.4f, "
+                      "recall %.4f, abundance L1 error %.4f, %i reads not in the dataset\n") % \
+                     (classifier, summary['classified'], summary['truth'], summary['assigned'],
+                      summary['precision'], summary['recall'], summary['abundance_l1'],
+                      summary['foreign']))
+
+if __name__ == '__main__':
+    
+    import argparse
+    
+    parser = argparse.ArgumentParser( description = __doc__,
+                                      formatter_class = argparse.RawDescriptionHelpFormatter )
+    
+    parser.add_argument("truth", help="Truth index (.npy) written by MetaMaker.")
+    parser.add_argument("keyfile", help="Key file written by MetaMaker.")
+    parser.add_argument("--kraken", help="Per-read kraken output (kraken_results.txt).", default=None)
+    parser.add_argument("--hmmsearch", help="Parsed vFam hmmsearch output (hmmsearch-parsed.txt).",
+                        default=None)
+    parser.add_argument("--nodes", help="NCBI taxonomy nodes.dmp, to compare taxa at a rank.",
+                        default=None)
+    parser.add_argument("--names", help="NCBI taxonomy names.dmp, needed for hmmsearch.",
+                        default=None)
+    parser.add_argument("-r", "--rank", help="Taxonomic rank to compare at (needs --nodes).",
+                        default=None)
+    parser.add_argument("-w", "--workers", help="Number of parsing processes.", default=1, type=int)
+    parser.add_argument("-o", "--output", help="Report filename, default is stdout.", default=None)
+    
+    args = parser.parse_args()
+    
+    if not args.kraken and not args.hmmsearch:
+        parser.error("Nothing to evaluate, give --kraken and/or --hmmsearch.")
+    if args.rank and not args.nodes:
+        parser.error("--rank needs --nodes.")
+    
+    taxonomy = Taxonomy(args.nodes, args.names, args.rank) if args.nodes else None
+    results = evaluate(args.truth, args.keyfile, args.kraken, args.hmmsearch, taxonomy,
+                       args.rank, args.workers)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    write_report(results, output, taxonomy.names if taxonomy else None)
+    if args.output:
+        output.close()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Sequencing profile statistics from fastq files.
+
+Fastq files (optionally gzipped) are read as raw text, four lines per record,
+and the read lengths and per-position qualities are accumulated in batches
+with numpy: counts, sums, sums of squares, minimum and maximum. Several files
+can be read in parallel, with the partial statistics merged afterwards.
+Alternatively, a fixed number of reads can be reservoir sampled from the
+input, and the statistics computed from the sample.
+
+The histograms can be saved as a compiled profile (.npz), with Vose alias
+tables for drawing read lengths and per-position qualities in constant time
+per value.
+"""
+
+import os
+import gzip
+import numpy
+import itertools
+import multiprocessing
+
+# Approximate number of bases per batch
+BATCH_BASES = 2**22
+
+# Phred quality offset of Sanger/Illumina 1.8+ fastq files
+PHRED_OFFSET = 33
+
+# Number of quality values (phred 0-93)
+QUALITIES = 94
+
+# Compiled profile tables loaded in this process, by file name: 
+# (modification time, tables)
+_COMPILED = {}
+
+def open_fastq(filename):
+    """
+    Opens a fastq file, which may be gzipped.
+    """
+    with open(filename, 'rb') as handle:
+        magic = handle.read(2)
+    if magic == '\x1f\x8b':
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+def read_qualities(filename, batch_bases = BATCH_BASES):
+    """
+    Generator yielding lists of quality strings, about batch_bases bases at a
+    time. The file is assumed to have four line records, as written by all
+    current sequencers.
+    """
+    with open_fastq(filename) as handle:
+        batch, bases = [], 0
+        for quality in itertools.islice(handle, 3, None, 4):
+            batch += [quality.rstrip('\r\n')]
+            bases += len(batch[-1])
+            if bases >= batch_bases:
+                yield batch
+                batch, bases = [], 0
+        if batch:
+            yield batch
+
+class QualityStats(object):
+    """
+    Read length and per-position quality statistics, kept as a read length
+    histogram, and a quality histogram for each read position, from which
+    the counts, sums, sums of squares, minimum and maximum are derived.
+    """
+    
+    def __init__(self):
+        self.lengths   = numpy.zeros(0, numpy.int64)
+        self.histogram = numpy.zeros((0, QUALITIES), numpy.int64)
+    
+    @staticmethod
+    def _add_counts(counts, other):
+        """
+        Returns the sum of two count arrays, which can differ in length.
+        """
+        if len(other) > len(counts):
+            counts, other = other, counts
+        counts = counts.copy()
+        counts[:len(other)] += other
+        return counts
+    
+    def add(self, qualities):
+        """
+        Adds a list of quality strings to the statistics.
+        """
+        if not qualities:
+            return
+        lengths = numpy.array([len(q) for q in qualities])
+        quality = numpy.frombuffer("".join(qualities), numpy.uint8).astype(numpy.int64)
+        quality = numpy.clip(quality - PHRED_OFFSET, 0, QUALITIES - 1)
+        position = (numpy.arange(len(quality)) -
+                    numpy.repeat(numpy.cumsum(lengths) - lengths, lengths))
+        
+        width = lengths.max()
+        self.lengths = self._add_counts(self.lengths, numpy.bincount(lengths))
+        self.histogram = self._add_counts(self.histogram,
+                                          numpy.bincount(position*QUALITIES + quality,
+                                                         minlength = width*QUALITIES
+                                                         ).reshape(width, QUALITIES))
+    
+    def merge(self, other):
+        """
+        Adds the statistics of another QualityStats object to this one.
+        """
+        self.lengths   = self._add_counts(self.lengths, other.lengths)
+        self.histogram = self._add_counts(self.histogram, other.histogram)
+        return self
+    
+    @property
+    def reads(self):
+        return int(self.lengths.sum())
+    
+    def min_length(self):
+        return int(numpy.nonzero(self.lengths)[0][0])
+    
+    def max_length(self):
+        return len(self.lengths) - 1
+    
+    def length_mean(self):
+        return (self.lengths * numpy.arange(len(self.lengths))).sum() / float(self.reads)
+    
+    def length_var(self):
+        return ((self.lengths * numpy.arange(len(self.lengths))**2).sum() / float(self.reads)
+                - self.length_mean()**2)
+    
+    def count(self):
+        """
+        Returns the number of reads covering each read position.
+        """
+        return self.histogram.sum(axis = 1)
+    
+    def sum(self):
+        """
+        Returns the sum of the qualities at each read position.
+        """
+        return self.histogram.dot(numpy.arange(QUALITIES))
+    
+    def sq_sum(self):
+        """
+        Returns the sum of the squared qualities at each read position.
+        """
+        return self.histogram.dot(numpy.arange(QUALITIES)**2)
+    
+    def min(self):
+        """
+        Returns the minimum quality at each read position.
+        """
+        return (self.histogram > 0).argmax(axis = 1)
+    
+    def max(self):
+        """
+        Returns the maximum quality at each read position.
+        """
+        return QUALITIES - 1 - (self.histogram[:,::-1] > 0).argmax(axis = 1)
+    
+    def quality_mean(self):
+        """
+        Returns the mean quality at each read position.
+        """
+        return self.sum() / self.count().astype(float)
+    
+    def quality_var(self):
+        """
+        Returns the quality variance at each read position.
+        """
+        return self.sq_sum() / self.count().astype(float) - self.quality_mean()**2
+
+class Reservoir(object):
+    """
+    Uniform random sample of a fixed number of reads from a stream of reads.
+    """
+    
+    def __init__(self, size, rng = numpy.random):
+        self.size   = int(size)
+        self.rng    = rng
+        self.seen   = 0
+        self.sample = []
+    
+    def add(self, qualities):
+        """
+        Adds a list of quality strings to the stream.
+        """
+        fill = min(len(qualities), self.size - len(self.sample))
+        self.sample += qualities[:fill]
+        self.seen   += fill
+        rest = qualities[fill:]
+        if not rest:
+            return
+        # read number seen+i replaces a random slot with probability
+        # size/(seen+i+1) (algorithm R)
+        slots = (self.rng.random_sample(len(rest)) *
+                 (self.seen + numpy.arange(len(rest)) + 1)).astype(numpy.int64)
+        for i in numpy.nonzero(slots < self.size)[0]:
+            self.sample[slots[i]] = rest[i]
+        self.seen += len(rest)
+    
+    def merge(self, other):
+        """
+        Merges the sample of another reservoir into this one, so that the
+        result is a uniform sample of both streams.
+        """
+        seen = self.seen + other.seen
+        size = min(self.size, seen)
+        # reads are taken from each sample in proportion to its stream size
+        taken = self.rng.hypergeometric(self.seen, other.seen, size) if other.seen and \
+                self.seen else (size if self.seen else 0)
+        mine   = self.rng.permutation(len(self.sample))[:taken]
+        theirs = self.rng.permutation(len(other.sample))[:size - taken]
+        self.sample = [self.sample[i] for i in mine] + [other.sample[i] for i in theirs]
+        self.seen = seen
+        return self
+
+def alias_table(weights):
+    """
+    Returns the (probability, alias) arrays of Vose's alias method, for 
+    sampling from a discrete distribution with the given weights. Weights 
+    which are all zero give a uniform distribution.
+    """
+    n = len(weights)
+    probability = numpy.ones(n)
+    alias = numpy.arange(n)
+    total = float(numpy.sum(weights))
+    if not total:
+        return probability, alias
+    scaled = list(numpy.asarray(weights, float) * n / total)
+    small = [i for i in xrange(n) if scaled[i] < 1]
+    large = [i for i in xrange(n) if scaled[i] >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probability[less] = scaled[less]
+        alias[less] = more
+        scaled[more] += scaled[less] - 1
+        if scaled[more] < 1:
+            small += [more]
+        else:
+            large += [more]
+    # anything left over has a probability of one, up to rounding errors
+    return probability, alias
+
+def alias_draw(probability, alias, rows, rng = numpy.random):
+    """
+    Draws one value for each entry in rows, from the alias table row given by
+    that entry. Tables are given as (rows x values) arrays.
+    """
+    column = (rng.random_sample(rows.shape) * probability.shape[1]).astype(numpy.int64)
+    keep = rng.random_sample(rows.shape) < probability[rows, column]
+    return numpy.where(keep, column, alias[rows, column])
+
+def save_compiled(stats, filename):
+    """
+    Saves the histograms of a QualityStats object as a compiled profile, 
+    together with alias tables for sampling from them.
+    """
+    tables = [alias_table(row) for row in stats.histogram]
+    length_probability, length_alias = alias_table(stats.lengths)
+    numpy.savez(filename,
+                quality_histogram = stats.histogram,
+                length_histogram  = stats.lengths,
+                quality_probability = numpy.array([p for p, _ in tables]),
+                quality_alias     = numpy.array([a for _, a in tables], numpy.uint8),
+                length_probability = length_probability[None,:],
+                length_alias      = length_alias[None,:])
+
+class CompiledProfile(object):
+    """
+    Compiled empirical sequencing profile, drawing read lengths and 
+    per-position qualities from the histograms of a real sequencing run. 
+    Pickling a CompiledProfile only passes on its file name, and the tables 
+    are loaded again when first used.
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self._tables = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tables'] = None
+        return state
+    
+    def tables(self):
+        """
+        Returns the alias tables as a dict.
+        """
+        if self._tables is None:
+            mtime = os.path.getmtime(self.filename)
+            if _COMPILED.get(self.filename, (None,))[0] != mtime:
+                data = numpy.load(self.filename)
+                _COMPILED[self.filename] = (mtime, dict((k, data[k]) for k in 
+                                                        ['quality_probability',
+                                                         'quality_alias',
+                                                         'length_probability',
+                                                         'length_alias']))
+            self._tables = _COMPILED[self.filename][1]
+        return self._tables
+    
+    def draw_lengths(self, count, rng = numpy.random):
+        """
+        Draws `count` read lengths.
+        """
+        tables = self.tables()
+        return alias_draw(tables['length_probability'], tables['length_alias'],
+                          numpy.zeros(count, numpy.int64), rng)
+    
+    def draw_qualities(self, length, rng = numpy.random):
+        """
+        Draws Phred+33 qualities for reads with the given lengths, as a padded
+        (reads x max length) uint8 array. Positions past the end of the
+        profile use the last position of the profile.
+        """
+        tables = self.tables()
+        width = length.max() if len(length) else 0
+        positions = len(tables['quality_probability'])
+        rows = numpy.minimum(numpy.arange(width), positions - 1)
+        rows = numpy.repeat(rows[None,:], len(length), axis = 0)
+        quality = alias_draw(tables['quality_probability'], tables['quality_alias'],
+                             rows, rng) + PHRED_OFFSET
+        quality[numpy.arange(width) >= length[:,None]] = 0
+        return quality.astype(numpy.uint8)
+
+def _parse_file(args):
+    """
+    Reads a fastq file, and returns its QualityStats, or a Reservoir if a
+    sample size is given. This is run in worker processes, so it can't be a
+    method.
+    """
+    filename, sample_size, seed = args
+    if sample_size:
+        output = Reservoir(sample_size, numpy.random.RandomState(seed))
+    else:
+        output = QualityStats()
+    for qualities in read_qualities(filename):
+        output.add(qualities)
+    return output
+
+def parse_files(filenames, workers = 1, sample_size = 0, seed = None):
+    """
+    Returns the QualityStats of a list of fastq files, read by `workers`
+    processes. If sample_size is set, the statistics are computed from a
+    uniform random sample of that many reads. Returns (stats, total number
+    of reads).
+    """
+    seed = seed if seed is not None else numpy.random.randint(2**31)
+    jobs = [(f, sample_size, [seed, i]) for i, f in enumerate(filenames)]
+    if workers > 1 and len(filenames) > 1:
+        pool = multiprocessing.Pool(min(workers, len(filenames)))
+        results = pool.map(_parse_file, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_parse_file, jobs)
+    
+    if not sample_size:
+        stats = reduce(QualityStats.merge, results, QualityStats())
+        return stats, stats.reads
+    
+    sample = results[0]
+    sample.rng = numpy.random.RandomState([seed, len(filenames)])
+    for other in results[1:]:
+        sample.merge(other)
+    stats = QualityStats()
+    batch, bases = [], 0
+    for quality in sample.sample:
+        batch += [quality]
+        bases += len(quality)
+        if bases >= BATCH_BASES:
+            stats.add(batch)
+            batch, bases = [], 0
+    stats.add(batch)
+    return stats, sample.seen
+
+if __name__ == '__main__':
+    
+    import argparse
+    
+    parser = argparse.ArgumentParser( description = __doc__ )
+    
+    parser.add_argument("fastq", nargs="+", help="Fastq files, optionally gzipped.")
+    parser.add_argument("-w", "--workers", help="Number of worker processes.", default=1,
+                        type=int)
+    parser.add_argument("-n", "--sample", help="Number of reads to sample, 0 uses all reads.",
+                        default=0, type=int)
+    
+    args = parser.parse_args()
+    
+    stats, total = parse_files(args.fastq, args.workers, args.sample)
+    print "# %i reads, %i used, length %.1f +- %.1f (%i-%i)" % (total, stats.reads,
+                                                              stats.length_mean(),
+                                                              stats.length_var()**0.5,
+                                                              stats.min_length(),
+                                                              stats.max_length())
+    print "position\tcount\tmean\tvariance\tmin\tmax"
+    for row in zip(range(1, len(stats.histogram)+1), stats.count(), stats.quality_mean(),
+                   stats.quality_var(), stats.min(), stats.max()):
+        print "%i\t%i\t%.2f\t%.2f\t%i\t%i" % row
@@ -0,0 +1,138 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Buffered, optionally compressed, output streams for MetaMaker.
+
+Output is collected into large blocks, and blocks are compressed in a pool of
+worker threads (zlib releases the GIL), then written in order. The compression
+is chosen from the file extension: '.gz' writes a multi-member gzip file, and
+'.bgz'/'.bgzf' writes BGZF (blocked gzip, as used by samtools/tabix), both of
+which are readable by gzip. '-' writes uncompressed output to stdout, and any
+other name (including a named pipe) is written uncompressed.
+"""
+
+import sys
+import time
+import zlib
+import struct
+import collections
+from multiprocessing.pool import ThreadPool
+
+# Uncompressed bytes per compression job
+BLOCK_SIZE = 2**22
+
+# Max uncompressed bytes per BGZF block
+BGZF_BLOCK_SIZE = 65280
+
+BGZF_EOF = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
+            "\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+COMPRESSED_EXTENSIONS = ['.gz', '.bgz', '.bgzf']
+
+def _deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+def _trailer(data):
+    return struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+def gzip_block(data, level = 6):
+    """
+    Compresses data into a single gzip member.
+    """
+    header = "\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + "\x00\xff"
+    return header + _deflate(data, level) + _trailer(data)
+
+def bgzf_block(data, level = 6):
+    """
+    Compresses data into a series of BGZF blocks.
+    """
+    output = []
+    for start in xrange(0, len(data), BGZF_BLOCK_SIZE):
+        chunk = data[start:start+BGZF_BLOCK_SIZE]
+        cdata = _deflate(chunk, level)
+        header = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" +
+                  struct.pack("<H", len(cdata) + 25))
+        output += [header, cdata, _trailer(chunk)]
+    return "".join(output)
+
+class BlockWriter(object):
+    """
+    File-like object which compresses its output in blocks, using a pool of
+    worker threads, while keeping the output order.
+    """
+    
+    def __init__(self, handle, compress, threads = 1, block_size = BLOCK_SIZE,
+                 footer = "", close_handle = True):
+        """
+        Arguments are:
+        handle     : the underlying (binary) output file
+        compress   : function compressing a block of data
+        threads    : number of compression threads
+        block_size : number of uncompressed bytes per compression job
+        footer     : data written after the last block (e.g. the BGZF EOF)
+        """
+        self.handle       = handle
+        self.compress     = compress
+        self.threads      = max(1, int(threads))
+        self.block_size   = block_size
+        self.footer       = footer
+        self.close_handle = close_handle
+        self.buffer       = []
+        self.buffered     = 0
+        self.pending      = collections.deque()
+        self.pool         = ThreadPool(self.threads) if self.threads > 1 else None
+    
+    def _submit(self):
+        if not self.buffered:
+            return
+        data = "".join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        if self.pool:
+            self.pending.append(self.pool.apply_async(self.compress, (data,)))
+            # bound the memory used by blocks waiting for compression
+            while len(self.pending) > 2*self.threads:
+                self.handle.write(self.pending.popleft().get())
+        else:
+            self.handle.write(self.compress(data))
+    
+    def write(self, data):
+        self.buffer += [data]
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+    
+    def flush(self):
+        """
+        Compresses and writes all buffered data.
+        """
+        self._submit()
+        while self.pending:
+            self.handle.write(self.pending.popleft().get())
+        self.handle.flush()
+    
+    def close(self):
+        self.flush()
+        self.handle.write(self.footer)
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        if self.close_handle:
+            self.handle.close()
+        else:
+            self.handle.flush()
+
+def open_output(filename, threads = 1, block_size = BLOCK_SIZE):
+    """
+    Opens filename for writing, compressed according to its extension. '-'
+    means stdout.
+    """
+    if filename == '-':
+        return BlockWriter(sys.stdout, lambda data: data, 1, block_size,
+                           close_handle = False)
+    if filename.endswith('.gz'):
+        return BlockWriter(open(filename, 'wb'), gzip_block, threads, block_size)
+    if filename.endswith('.bgz') or filename.endswith('.bgzf'):
+        return BlockWriter(open(filename, 'wb'), bgzf_block, threads, block_size,
+                           footer = BGZF_EOF)
+    return BlockWriter(open(filename, 'wb'), lambda data: data, 1, block_size)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache for genomes and metadata downloaded by MetaMaker.
+
+Genomes are stored content-addressed, as compressed uint8 sequence arrays
+named by the SHA-1 digest of their content, and indexed by nucleotide id in
+a small sqlite database. The cache has a size cap, and evicts the least
+recently used genomes when it grows past it. Metadata lookups (summaries,
+taxonomy ids etc.) are stored as json in the same database, with a separate
+cap on the number of entries and the same least recently used eviction.
+"""
+
+import os
+import json
+import time
+import numpy
+import shutil
+import hashlib
+import logging
+import sqlite3
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".metlab", "genomes")
+
+DEFAULT_CACHE_SIZE = 8*2**30
+
+DEFAULT_METADATA_ENTRIES = 2**16
+
+CACHE_SCHEMA = [
+"""CREATE TABLE IF NOT EXISTS genomes (
+    nuc_id TEXT PRIMARY KEY,
+    digest TEXT,
+    size INTEGER,
+    accessed REAL);""",
+"""CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    accessed REAL);""",
+"""CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed);"""]
+
+class GenomeCache(object):
+    """
+    Content-addressed local genome cache, keyed by nucleotide id.
+    """
+
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, max_size = DEFAULT_CACHE_SIZE,
+                 log = None, max_metadata = DEFAULT_METADATA_ENTRIES):
+        """
+        Opens (and creates if needed) the cache in `cache_dir`, limited to
+        `max_size` bytes of genome data and `max_metadata` metadata entries.
+        """
+        self.cache_dir = cache_dir
+        self.max_size  = max_size
+        self.max_metadata = max_metadata
+        self.database  = os.path.join(cache_dir, "index.sqlite3")
+        self.log       = log if log else logging.getLogger( __name__ )
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for table in CACHE_SCHEMA:
+            self._query( table )
+
+    def _query(self, query, *args):
+        con = None
+        data = None
+
+        try:
+            con = sqlite3.connect( self.database, timeout = 60 )
+            cur = con.cursor()
+            cur.execute(query, tuple(args))
+            data = cur.fetchall()
+            if not data:
+                con.commit()
+        except sqlite3.Error as e:
+            self.log.error("Cache database error: %s" % e)
+        finally:
+            if con:
+                con.close()
+        return data
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], "%s.npz" % digest)
+
+    @staticmethod
+    def _digest(ids, sequence):
+        """
+        Returns the SHA-1 hex digest of the genome content.
+        """
+        digest = hashlib.sha1()
+        digest.update("\n".join(ids))
+        digest.update(sequence.tostring())
+        return digest.hexdigest()
+
+    def __contains__(self, nuc_id):
+        return bool(self._query("SELECT nuc_id FROM genomes WHERE nuc_id = ?",
+                                str(nuc_id)))
+
+    def get(self, nuc_id, verify = True):
+        """
+        Returns the records of a cached genome as a list of (record id, uint8
+        sequence array) tuples, or None if the genome isn't in the cache. If
+        `verify` is set, the content is checked against its digest, and
+        corrupt entries are removed.
+        """
+        entry = self._query("SELECT digest FROM genomes WHERE nuc_id = ?", str(nuc_id))
+        if not entry:
+            return None
+        digest = entry[0][0]
+        try:
+            data = numpy.load(self._path(digest))
+            ids, offsets, sequence = list(data['ids']), data['offsets'], data['sequence']
+        except Exception as e:
+            self.log.warning("Could not read cached genome %s: %s" % (nuc_id, e))
+            self.remove(nuc_id)
+            return None
+        if verify and self._digest(ids, sequence) != digest:
+            self.log.warning("Cached genome %s is corrupt, removing it." % nuc_id)
+            self.remove(nuc_id)
+            return None
+
+        self._query("UPDATE genomes SET accessed = ? WHERE nuc_id = ?", time.time(),
+                    str(nuc_id))
+        return [(ids[i], sequence[offsets[i]:offsets[i+1]]) for i in xrange(len(ids))]
+
+    def put(self, nuc_id, records):
+        """
+        Stores a genome, given as a list of (record id, uint8 sequence array)
+        tuples, in the cache, and evicts old genomes if the cache grows too
+        large.
+        """
+        ids = [str(i) for i, _ in records]
+        seqs = [numpy.asarray(s, numpy.uint8) for _, s in records]
+        offsets = numpy.cumsum([0] + [len(s) for s in seqs])
+        sequence = numpy.concatenate(seqs) if seqs else numpy.zeros(0, numpy.uint8)
+        digest = self._digest(ids, sequence)
+
+        path = self._path(digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            temp = "%s.%i.tmp.npz" % (path[:-4], os.getpid())
+            numpy.savez_compressed(temp, ids = numpy.array(ids), offsets = offsets,
+                                   sequence = sequence)
+            os.rename(temp, path)
+
+        self._query("INSERT OR REPLACE INTO genomes (nuc_id, digest, size, accessed) "
+                    "VALUES (?, ?, ?, ?)", str(nuc_id), digest, os.path.getsize(path),
+                    time.time())
+        self.evict()
+
+    def remove(self, nuc_id):
+        """
+        Removes a genome from the cache. The data file is only removed if no
+        other entry shares its content.
+        """
+        entry = self._query("SELECT digest FROM genomes WHERE nuc_id = ?", str(nuc_id))
+        self._query("DELETE FROM genomes WHERE nuc_id = ?", str(nuc_id))
+        for digest, in entry or []:
+            if not self._query("SELECT nuc_id FROM genomes WHERE digest = ?", digest):
+                try:
+                    os.remove(self._path(digest))
+                except OSError:
+                    pass
+
+    def size(self):
+        """
+        Returns the total size of the cached genome files in bytes.
+        """
+        data = self._query("SELECT SUM(size) FROM (SELECT DISTINCT digest, size "
+                           "FROM genomes)")
+        return (data[0][0] or 0) if data else 0
+
+    def evict(self, max_size = None, max_metadata = None):
+        """
+        Removes the least recently used genomes until the cache fits within
+        `max_size` (default: the cache size cap), and the least recently used
+        metadata entries until at most `max_metadata` (default: the metadata
+        cap) remain.
+        """
+        self.evict_metadata(max_metadata)
+        max_size = self.max_size if max_size is None else max_size
+        size = self.size()
+        if size <= max_size:
+            return
+        for nuc_id, file_size in self._query("SELECT nuc_id, size FROM genomes "
+                                             "ORDER BY accessed ASC") or []:
+            if size <= max_size:
+                break
+            self.log.debug("Evicting %s from genome cache" % nuc_id)
+            self.remove(nuc_id)
+            size = self.size()
+
+    def verify(self):
+        """
+        Checks the integrity of all cached genomes, removing corrupt ones.
+        Returns the list of removed nucleotide ids.
+        """
+        removed = []
+        for nuc_id, in self._query("SELECT nuc_id FROM genomes") or []:
+            if self.get(nuc_id, verify = True) is None:
+                removed += [nuc_id]
+        return removed
+
+    def get_metadata(self, key):
+        """
+        Returns cached metadata for `key`, or None if it isn't cached.
+        """
+        data = self._query("SELECT value FROM metadata WHERE key = ?", key)
+        if not data:
+            return None
+        self._query("UPDATE metadata SET accessed = ? WHERE key = ?", time.time(), key)
+        return json.loads(data[0][0])
+
+    def put_metadata(self, key, value):
+        """
+        Stores json-serializable metadata under `key`, and evicts old metadata
+        if there are too many entries.
+        """
+        self._query("INSERT OR REPLACE INTO metadata (key, value, accessed) "
+                    "VALUES (?, ?, ?)", key, json.dumps(value), time.time())
+        self.evict_metadata()
+
+    def metadata_size(self):
+        """
+        Returns the number of cached metadata entries.
+        """
+        data = self._query("SELECT COUNT(*) FROM metadata")
+        return data[0][0] if data else 0
+
+    def evict_metadata(self, max_entries = None):
+        """
+        Removes the least recently used metadata entries until at most
+        `max_entries` (default: the metadata cap) remain.
+        """
+        max_entries = self.max_metadata if max_entries is None else max_entries
+        excess = self.metadata_size() - max_entries
+        if excess > 0:
+            self.log.debug("Evicting %i metadata entries from genome cache" % excess)
+            self._query("DELETE FROM metadata WHERE key IN (SELECT key FROM metadata "
+                        "ORDER BY accessed ASC LIMIT ?)", excess)
+
+    def clear(self):
+        """
+        Removes everything from the cache.
+        """
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        self._query("DELETE FROM genomes")
+        self._query("DELETE FROM metadata")
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser( description = __doc__ )
+
+    parser.add_argument("-d", "--cache_dir", help="Cache directory.", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--verify", help="Check the integrity of all cached genomes.",
+                        action="store_true", default=False)
+    parser.add_argument("--clear", help="Remove all cached data.", action="store_true",
+                        default=False)
+
+    args = parser.parse_args()
+
+    cache = GenomeCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+    if args.verify:
+        removed = cache.verify()
+        print "%i corrupt genomes removed." % len(removed)
+    print "%i genomes, %.1f MB, %i metadata entries" % (
+        len(cache._query("SELECT nuc_id FROM genomes")), cache.size()/2.0**20,
+        cache.metadata_size())
@@ -0,0 +1,264 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped, 2-bit packed genome store for MetaMaker.
+
+Genomes are written to disk packed four bases to a byte, with the (rare)
+non-ACGT bases stored separately as exceptions. Simulation workers then only
+receive the file name of a genome, and memory-map the packed sequence, so that
+only the pages holding the sampled reads are read, and memory use doesn't grow
+with the number or size of the genomes. Base case is not kept.
+"""
+
+import os
+import re
+import numpy
+import shutil
+
+# Packed base codes, indexed by base character. Other characters are stored
+# as exceptions.
+BASE_CODES = numpy.zeros(256, numpy.uint8) + 255
+for _code, _base in enumerate('ACGT'):
+    BASE_CODES[ord(_base)] = BASE_CODES[ord(_base.lower())] = _code
+
+BASES = numpy.frombuffer('ACGT', numpy.uint8)
+
+class Genome(object):
+    """
+    All records of a genome (e.g. the segments of a segmented virus, or the
+    chromosomes and plasmids of a bacterium), held in one contiguous uint8
+    sequence buffer, where record i is sequence[offsets[i]:offsets[i+1]].
+    """
+    
+    def __init__(self, ids, sequence, offsets):
+        self.ids      = list(ids)
+        self.sequence = sequence
+        self.offsets  = numpy.asarray(offsets, numpy.int64)
+        self.lengths  = numpy.diff(self.offsets)
+    
+    @classmethod
+    def from_records(cls, records):
+        """
+        Creates a Genome from a list of (record id, sequence) tuples.
+        """
+        seqs = [numpy.asarray(s, numpy.uint8) for _, s in records]
+        sequence = numpy.concatenate(seqs) if seqs else numpy.zeros(0, numpy.uint8)
+        return cls([str(i) for i, _ in records], sequence,
+                   numpy.cumsum([0] + [len(s) for s in seqs]))
+    
+    def __len__(self):
+        return int(self.offsets[-1])
+    
+    def take(self, index):
+        """
+        Returns the bases at the (genome wide) positions in index, as uint8.
+        """
+        return self.sequence[index]
+    
+    def records(self):
+        """
+        Returns the records as a list of (record id, sequence) tuples.
+        """
+        return [(self.ids[i], self.sequence[self.offsets[i]:self.offsets[i+1]])
+                for i in xrange(len(self.ids))]
+    
+    def draw_records(self, count, rng = numpy.random):
+        """
+        Draws the records of `count` reads, with probabilities proportional to
+        the record lengths.
+        """
+        if len(self.ids) < 2 or not len(self):
+            return numpy.zeros(count, int)
+        return numpy.searchsorted(self.offsets[1:], rng.random_sample(count)*len(self),
+                                  'right')
+
+class PackedGenome(Genome):
+    """
+    A Genome memory-mapped from a GenomeStore. Pickling a PackedGenome only
+    passes on its file name and index, and the sequence is mapped again when
+    it's used.
+    """
+    
+    def __init__(self, path):
+        meta = numpy.load("%s.meta.npz" % path)
+        self.path            = path
+        self.ids             = list(meta['ids'])
+        self.offsets         = meta['offsets']
+        self.lengths         = numpy.diff(self.offsets)
+        self.exceptions      = meta['exceptions']
+        self.exception_bases = meta['exception_bases']
+        self.packed          = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['packed'] = None
+        return state
+    
+    def _map(self):
+        """
+        Returns the memory-mapped packed sequence. The sequence is only mapped 
+        when first used, so that many genomes can be open at once.
+        """
+        if self.packed is None:
+            self.packed = numpy.load("%s.npy" % self.path, mmap_mode = 'r')
+        return self.packed
+    
+    @staticmethod
+    def pack(sequence):
+        """
+        Packs a uint8 sequence array into (packed, exceptions, exception
+        bases), where packed holds four bases per byte, and the non-ACGT bases
+        are listed by position in exceptions.
+        """
+        codes = BASE_CODES[sequence]
+        exceptions = numpy.nonzero(codes == 255)[0]
+        exception_bases = sequence[exceptions]
+        codes[exceptions] = 0
+        codes = numpy.concatenate([codes, numpy.zeros(-len(codes) % 4, numpy.uint8)])
+        codes = codes.reshape(-1, 4)
+        packed = codes[:,0] | codes[:,1] << 2 | codes[:,2] << 4 | codes[:,3] << 6
+        return packed.astype(numpy.uint8), exceptions, exception_bases
+    
+    def take(self, index):
+        index = numpy.asarray(index)
+        bases = BASES[(self._map()[index >> 2] >> ((index & 3) << 1)) & 3]
+        if len(self.exceptions):
+            i = numpy.minimum(numpy.searchsorted(self.exceptions, index),
+                              len(self.exceptions) - 1)
+            hit = self.exceptions[i] == index
+            bases[hit] = self.exception_bases[i[hit]]
+        return bases
+    
+    def records(self):
+        return [(self.ids[i], self.take(numpy.arange(self.offsets[i], self.offsets[i+1])))
+                for i in xrange(len(self.ids))]
+
+class GenomeStore(object):
+    """
+    Directory of 2-bit packed genomes, keyed by name (e.g. nucleotide id).
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    def _path(self, key):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', str(key)))
+    
+    def __contains__(self, key):
+        return os.path.exists("%s.meta.npz" % self._path(key))
+    
+    def get(self, key):
+        """
+        Returns the PackedGenome stored under key, or None if it isn't stored.
+        """
+        if key not in self:
+            return None
+        return PackedGenome(self._path(key))
+    
+    def put(self, key, genome):
+        """
+        Packs and stores a Genome under key, and returns it as a PackedGenome.
+        """
+        path = self._path(key)
+        temp = "%s.%i.tmp" % (path, os.getpid())
+        packed, exceptions, exception_bases = PackedGenome.pack(genome.sequence)
+        numpy.save("%s.npy" % temp, packed)
+        numpy.savez("%s.meta.npz" % temp, ids = numpy.array(genome.ids),
+                    offsets = genome.offsets, exceptions = exceptions,
+                    exception_bases = exception_bases)
+        # the meta file marks the genome as stored, so it's moved last
+        os.rename("%s.npy" % temp, "%s.npy" % path)
+        os.rename("%s.meta.npz" % temp, "%s.meta.npz" % path)
+        return PackedGenome(path)
+    
+    def remove(self, key):
+        """
+        Removes a genome from the store.
+        """
+        path = self._path(key)
+        for name in ["%s.meta.npz" % path, "%s.npy" % path]:
+            if os.path.exists(name):
+                os.remove(name)
+    
+    def clear(self):
+        """
+        Removes the store directory, with all genomes.
+        """
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+def _benchmark_run(num_genomes, genome_size, reads, workers, mapped, results):
+    """
+    Simulates reads spread over num_genomes random genomes, either mapped from
+    a store or held in memory, and puts the peak RSS (in kB) of the process
+    and of its workers on the results queue.
+    """
+    import resource
+    import tempfile
+    import multiprocessing
+    from metamaker import ReadGenerator, _simulate_shard
+    
+    store = GenomeStore(tempfile.mkdtemp(prefix = "metlab_benchmark"))
+    rng = numpy.random.RandomState(0)
+    genomes = []
+    for i in xrange(num_genomes):
+        genome = Genome(["g%i" % i], BASES[rng.randint(0, 4, genome_size)],
+                        [0, genome_size])
+        if mapped:
+            store.put(i, genome)
+        else:
+            genomes += [genome]
+    del genome
+    
+    generator = ReadGenerator(150, 0, [30], [4], False)
+    count = max(1, reads // num_genomes)
+    shards = ((generator, [(i, store.get(i) if mapped else genomes[i], 0, count, [0, i])],
+               None) for i in xrange(num_genomes))
+    pool = multiprocessing.Pool(workers)
+    for _ in pool.imap_unordered(_simulate_shard, shards):
+        pass
+    pool.close()
+    pool.join()
+    store.clear()
+    results.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+
+if __name__ == '__main__':
+    
+    import argparse
+    import multiprocessing
+    
+    parser = argparse.ArgumentParser( description = __doc__ )
+    
+    parser.add_argument("--benchmark", help="Measure peak RSS for growing numbers of genomes.",
+                        action="store_true", default=False)
+    parser.add_argument("--in_memory", help="Also benchmark genomes held in memory.",
+                        action="store_true", default=False)
+    parser.add_argument("-n", "--num_genomes", help="Numbers of genomes to benchmark.",
+                        nargs="+", type=int, default=[10, 100, 1000, 10000])
+    parser.add_argument("-s", "--genome_size", help="Genome size in bases.", type=int,
+                        default=100000)
+    parser.add_argument("-r", "--reads", help="Number of reads to simulate.", type=int,
+                        default=100000)
+    parser.add_argument("-w", "--workers", help="Number of worker processes.", type=int,
+                        default=4)
+    
+    args = parser.parse_args()
+    
+    if args.benchmark:
+        print "genomes\tbases\tmode\tpeak RSS (MB)\tpeak worker RSS (MB)"
+        for num_genomes in args.num_genomes:
+            for mode in ['mapped', 'memory'] if args.in_memory else ['mapped']:
+                # each measurement runs in a new process, as the RSS peak is
+                # kept for the life time of a process.
+                results = multiprocessing.Queue()
+                run = multiprocessing.Process(target = _benchmark_run,
+                                              args = (num_genomes, args.genome_size,
+                                                      args.reads, args.workers,
+                                                      mode == 'mapped', results))
+                run.start()
+                rss, workers = results.get()
+                run.join()
+                print "%i\t%i\t%s\t%.1f\t%.1f" % (num_genomes, num_genomes*args.genome_size,
+                                                    mode, rss/1024.0, workers/1024.0)
@@ -10,17 +10,295 @@ import os
 import sys
 import time
 import json
+import Queue
 import numpy
 import random
 import logging
+import tempfile
+import itertools
+import functools
+import collections
 import threading
 import curses.ascii
+import multiprocessing
 from Bio import Entrez, SeqIO
+from genome_cache import GenomeCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from reference_index import ReferenceIndex
+from entrez_resolver import EntrezClient, MetadataResolver, EUTILS_URL
+from fastq_writer import open_output, COMPRESSED_EXTENSIONS
+from genome_store import Genome, GenomeStore
+from fastq_profile import parse_files, save_compiled, CompiledProfile
+from truth_index import TruthWriter, truth_rows
 
 # Please add your own e-mail address here!
 # It makes the people at Entrez super happy!
 Entrez.email = "MetaMaker@slu.se"
 
+# Approximate number of bases to generate per batch of reads. Reads are
+# generated as padded (reads x length) arrays, so this bounds memory use.
+BATCH_BASES = 2**22
+
+# Sequencing error probability, indexed by the Phred+33 quality character.
+# Characters below 33 (i.e. read padding) never get errors.
+ERROR_PROBABILITY = numpy.zeros(256)
+ERROR_PROBABILITY[33:127] = 10**(-numpy.arange(94)/10.0)
+
+# Replacement bases used for sequencing errors.
+ERROR_BASES = numpy.frombuffer('actg', numpy.uint8)
+
+# Sequencing profiles read by get_profiles, by file name: (modification 
+# time, profile)
+_PROFILES = {}
+
+class ReadBatch(object):
+    """
+    A batch of simulated reads (or one side of a batch of mate-pairs).
+    
+    Sequences and qualities are stored as padded uint8 arrays, one row per
+    read, where only the first `length[i]` positions of row i are valid.
+    `genome` is the dataset index of the genome each read comes from, `index`
+    the number of the read within that genome, `record` and `ids` the index
+    and id of the genome record, `start` and `end` the read positions in that
+    record, as written to the fastq headers, and `errors` the number of
+    sequencing errors in each read.
+    """
+    
+    FIELDS = ['length', 'start', 'end', 'errors', 'record', 'ids', 'genome', 'index']
+    
+    def __init__(self, sequence, quality, length, start, end, errors = None,
+                 record = None, ids = None, genome = None, index = None):
+        self.sequence = sequence
+        self.quality  = quality
+        self.length   = length
+        self.start    = start
+        self.end      = end
+        self.errors   = errors
+        self.record   = record if record is not None else numpy.zeros(len(length), int)
+        self.ids      = ids if ids is not None else numpy.repeat('', len(length))
+        self.genome   = genome if genome is not None else numpy.zeros(len(length), int)
+        self.index    = index if index is not None else numpy.arange(len(length))
+    
+    def __len__(self):
+        return len(self.length)
+    
+    def take(self, order):
+        """
+        Returns a new ReadBatch with the reads in the given order.
+        """
+        return ReadBatch(self.sequence[order], self.quality[order],
+                         **dict((f, getattr(self, f)[order]) for f in self.FIELDS))
+    
+    @staticmethod
+    def concatenate(batches):
+        """
+        Joins a list of ReadBatches into one.
+        """
+        width = max(b.sequence.shape[1] for b in batches)
+        def pad(data):
+            output = numpy.zeros((len(data), width), numpy.uint8)
+            output[:,:data.shape[1]] = data
+            return output
+        return ReadBatch(numpy.concatenate([pad(b.sequence) for b in batches]),
+                         numpy.concatenate([pad(b.quality) for b in batches]),
+                         **dict((f, numpy.concatenate([getattr(b, f) for b in batches]))
+                                for f in ReadBatch.FIELDS))
+    
+    def read(self, i):
+        """
+        Returns the sequence and quality strings of read i.
+        """
+        length = self.length[i]
+        return (self.sequence[i,:length].tostring(),
+                self.quality[i,:length].tostring())
+
+class ReadGenerator(object):
+    """
+    Vectorized read generator.
+    
+    Draws start positions, read and mate lengths and qualities for thousands
+    of reads at once, and extracts the read sequences from the genome in bulk.
+    """
+    
+    def __init__(self, read_length = 200, length_var = 0, quality_mean = [25],
+                 quality_var = [10], matepair = True, insert_size = 500,
+                 profile = None):
+        """
+        Stores the read settings. If a CompiledProfile is given, read lengths 
+        and qualities are drawn from it instead.
+        """
+        self.read_length  = read_length
+        self.length_var   = length_var
+        self.quality_mean = quality_mean
+        self.quality_var  = quality_var
+        self.matepair     = matepair
+        self.insert_size  = insert_size
+        self.profile      = profile
+        
+        self.quality_cache  = numpy.zeros(0)
+        self.variance_cache = numpy.zeros(0)
+    
+    def _quality_tables(self, length):
+        """
+        Returns the quality mean and variance for the first `length` read
+        positions, evaluating the profile polynomials as needed.
+        """
+        if len(self.quality_cache) < length:
+            x = numpy.arange(length)
+            self.quality_cache  = numpy.poly1d(self.quality_mean)(x)
+            self.variance_cache = numpy.poly1d(self.quality_var)(x)
+        return self.quality_cache[:length], self.variance_cache[:length]
+    
+    def _slice(self, genome, start, length):
+        """
+        Extracts the subsequences genome[start[i]:start[i]+length[i]] into a
+        padded (reads x max length) array.
+        """
+        width = length.max() if len(length) else 0
+        mask  = numpy.arange(width) < length[:,None]
+        index = numpy.where(mask, start[:,None] + numpy.arange(width), 0)
+        output = genome.take(index)
+        output[~mask] = 0
+        return output
+    
+    def add_errors(self, batch, rng = numpy.random):
+        """
+        Applies sequencing errors to all reads in a ReadBatch according to
+        their qualities, replacing erroneous bases with a random base.
+        """
+        error = ERROR_PROBABILITY[batch.quality]
+        mask  = rng.random_sample(error.shape) < error
+        batch.sequence[mask] = ERROR_BASES[rng.randint(4, size = mask.sum())]
+        batch.errors = mask.sum(axis = 1)
+        return batch
+    
+    def batch_size(self):
+        """
+        Returns the number of reads (or mate-pairs) to generate per batch.
+        """
+        return max(1, int(BATCH_BASES // max(1, self.read_length)))
+    
+    def make_quality(self, length, rng = numpy.random):
+        """
+        Simulates read qualities from an error function, for a batch of reads
+        with the given lengths.
+        Qualities are in Sanger Fastq format (Phred+33), i.e. quality is
+        represented by an integer from 0 to 93, represented by the ascii
+        characters 33-126.
+        Errors are represented as 10^-0.0 (random base) to 10^-9.3 (super
+        accurate).
+        
+        ref: http://www.ncbi.nlm.nih.gov/pmc/articles/PMC2847217/?tool=pubmed
+        """
+        if self.profile:
+            return self.profile.draw_qualities(length, rng)
+        width = length.max() if len(length) else 0
+        mean, var = self._quality_tables(width)
+        
+        with numpy.errstate(invalid = 'ignore'):
+            noise = rng.normal(0, 1, (len(length), width)) * numpy.sqrt(var)
+        noise[numpy.isnan(noise)] = 0
+        
+        quality = numpy.clip((mean + noise).astype(int), 0, 93) + 33
+        quality[numpy.arange(width) >= length[:,None]] = 0
+        return quality.astype(numpy.uint8)
+    
+    def make_batch(self, genome, count, rng = numpy.random):
+        """
+        Extracts `count` single, or mate-paired reads from a Genome, drawing
+        the record of each read proportionally to the record lengths. Returns
+        a list with one ReadBatch for single reads, or two (read and mate) for
+        mate-pairs.
+        """
+        length = int(self.read_length)
+        stdev  = numpy.sqrt(self.length_var)
+        
+        def draw_lengths():
+            if self.profile:
+                return self.profile.draw_lengths(count, rng)
+            if stdev:
+                return length + rng.normal(0, stdev, count).astype(int)
+            return numpy.repeat(length, count)
+        
+        read_length = draw_lengths()
+        if self.matepair:
+            mate_length = draw_lengths()
+            min_length  = numpy.maximum(numpy.maximum(read_length, mate_length),
+                                        self.insert_size)
+        else:
+            min_length  = read_length
+        
+        record = genome.draw_records(count, rng)
+        record_length = genome.lengths[record]
+        
+        # randint only takes scalar bounds in older numpy versions
+        positions = numpy.maximum(0, record_length-min_length) + 1
+        start = (rng.random_sample(count) * positions).astype(int)
+        ends  = [(start, start + read_length)]
+        if self.matepair:
+            mate_start = start + min_length - mate_length
+            ends += [(mate_start, mate_start + mate_length)]
+        
+        output = []
+        for first, last in ends:
+            valid = numpy.clip(numpy.minimum(last, record_length) - first, 0, None)
+            batch = ReadBatch(self._slice(genome, genome.offsets[record] + first, valid),
+                              self.make_quality(valid, rng),
+                              valid, first, last, record = record,
+                              ids = numpy.array(genome.ids)[record])
+            output += [self.add_errors(batch, rng)]
+        return output
+    
+    def batches(self, genome, count, rng = numpy.random):
+        """
+        Generator yielding (offset, reads) tuples, where reads is the output
+        of make_batch and offset the index of the first read in the batch,
+        until `count` reads have been generated.
+        """
+        size = self.batch_size()
+        for offset in xrange(0, int(count), size):
+            yield offset, self.make_batch(genome, min(size, int(count) - offset), rng)
+
+def _bounded_imap(pool, function, iterable, window):
+    """
+    Like pool.imap, but keeps at most `window` tasks in flight, so that shards
+    aren't all submitted up front and results don't pile up in the parent 
+    when they are consumed slower than the workers produce them.
+    """
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(function, (args,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _simulate_shard(args):
+    """
+    Simulates one shard of reads. This is run in the worker processes, so it 
+    can't be a method. 
+    
+    A shard is a (generator, parts, shuffle seed) tuple, where parts is a list 
+    of (genome index, genome, offset, count, seed), i.e. `count` reads of a 
+    genome, starting at read number `offset`, simulated with a random stream 
+    of their own. Returns a list of batches (lists of ReadBatches, as from 
+    make_batch). If a shuffle seed is given, the reads of all parts are 
+    joined and returned in random order as a single batch.
+    """
+    generator, parts, shuffle = args
+    output = []
+    for genome_index, genome, offset, count, seed in parts:
+        rng = numpy.random.RandomState(seed)
+        for i, reads in generator.batches(genome, count, rng):
+            for batch in reads:
+                batch.genome = numpy.repeat(genome_index, len(batch))
+                batch.index  = offset + i + numpy.arange(len(batch))
+            output += [reads]
+    if shuffle is None or not output:
+        return output
+    reads = [ReadBatch.concatenate(batches) for batches in zip(*output)]
+    order = numpy.random.RandomState(shuffle).permutation(len(reads[0]))
+    return [[batch.take(order) for batch in reads]]
+
 class MetaMaker( threading.Thread ):
     """
     Viral Metagenomic dataset simulator.
@@ -36,7 +314,7 @@ as well as create sequencing profiles from sequence data.
         threading.Thread.__init__(self)
         
         self.num_genomes  = num_genomes
-        self.outfile      = outfile if outfile.endswith("fastq") else "%s.fastq" % outfile
+        self.outfile      = outfile if self._is_fastq_name(outfile) else "%s.fastq" % outfile
         self.keyfile      = outfile if outfile.endswith("key") else "%s.key" % outfile
         self.taxa         = 'viruses'
         self.reads        = 1000
@@ -49,6 +327,21 @@ as well as create sequencing profiles from sequence data.
         self.profile_dir  = profile_dir
         self.matepair     = True
         self.insert_size  = 500
+        self.workers      = 1
+        self.seed         = -1
+        self.chunk_size   = 100000
+        self.cache_dir    = DEFAULT_CACHE_DIR
+        self.cache_size   = DEFAULT_CACHE_SIZE
+        self.offline      = False
+        self.reference_dir = ''
+        self.entrez_url   = EUTILS_URL
+        self.api_key      = ''
+        self.entrez_workers = 4
+        self.prefetch     = 2
+        self.compress_threads = 4
+        self.store_dir    = ''
+        self.interleave   = False
+        self.truthfile    = ''
         
         self.log = log if log else logging.getLogger( __name__ )
         self.log.setLevel( log_level )
@@ -58,29 +351,34 @@ as well as create sequencing profiles from sequence data.
             self.log_handler.setFormatter( logging.Formatter( '%(asctime)s %(levelname)s: %(message)s', "%H:%M:%S" ) )
         self.log.addHandler(self.log_handler)
         
-        self.quality_cache = []
-        self.variance_cache = []
         self._progress = 0
+        self._download_progress = 0
+        self._random = random.Random()
+        self._cache = None
+        self._references = None
+        self._entrez_client = None
+        self._run_seed = None
+        self._store = None
+        self._compiled_profile = None
         self._stop = threading.Event()
         self.running = False
     
-    def _get_tax_id(self, data):
+    def _entrez(self):
         """
-        Attempts to get taxonomic id from NCBI, given some data.
+        Returns the (rate limited) Entrez client.
         """
-        organism = data['Organism_Name']
-        for retries in xrange(5):
-            try:
-                search = Entrez.read(Entrez.esearch('taxonomy', organism))
-                data   = Entrez.read(Entrez.esummary(db='taxonomy',
-                                                     id=search['IdList'][0]))
-                if data[0]['ScientificName'] != organism:
-                    raise Exception("Something went wrong in the search!")
-                return data[0]['TaxId']
-            except Exception as e:
-                pass
-        
-        return None
+        if not self._entrez_client:
+            self._entrez_client = EntrezClient(self.entrez_url, api_key = self.api_key,
+                                               log = self.log)
+        return self._entrez_client
+    
+    def _genome_cache(self):
+        """
+        Returns the genome cache, or None if caching is disabled.
+        """
+        if self.cache_dir and not self._cache:
+            self._cache = GenomeCache(self.cache_dir, self.cache_size, self.log)
+        return self._cache if self.cache_dir else None
     
     def _list_ncbi(self, max = 10000):
         """
@@ -88,19 +386,81 @@ as well as create sequencing profiles from sequence data.
         """
         self.log.info('Getting list of %s from NCBI' % self.taxa)
         term = "%s[Organism]" % self.taxa
-        handle = Entrez.esearch("genome", term = term, retmax = max)
-        results = Entrez.read(handle)
-        self.log.info(' + Found %i %s' % (len(results['IdList']), self.taxa))
-        return results['IdList']
+        key = "genome_list:%s:%i" % (self.taxa, max)
+        cache = self._genome_cache()
+        # Search results change as NCBI publishes new genomes, so the cached
+        # list is only used when running offline.
+        if self.offline:
+            results = cache.get_metadata(key) if cache else None
+        else:
+            results = list(self._entrez().esearch("genome", term, retmax = max)['IdList'])
+            if cache:
+                cache.put_metadata(key, results)
+        results = results if results else []
+        self.log.info(' + Found %i %s' % (len(results), self.taxa))
+        return results
     
     def _list(self):
         """
         Wrapper function in case more sources are added.
         """
         id_list  = []
-        id_list += self._list_ncbi()
+        if self.reference_dir:
+            id_list += self._list_local()
+        else:
+            id_list += self._list_ncbi()
         return id_list
     
+    def _list_local(self):
+        """
+        Lists the genomes in the local reference collection matching the 
+        specified taxa.
+        """
+        self.log.info('Getting list of %s from %s' % (self.taxa, self.reference_dir))
+        results = ["local:%i" % i for i in self._reference_index().select(self.taxa)]
+        self.log.info(' + Found %i %s' % (len(results), self.taxa))
+        return results
+    
+    def _reference_index(self):
+        """
+        Returns the index of the local reference collection.
+        """
+        if not self._references:
+            self._references = ReferenceIndex(self.reference_dir, self.log)
+        return self._references
+    
+    def _resolve(self, genome_ids):
+        """
+        Generator yielding (genome id, metadata) for the candidate genomes, in
+        order. Metadata is None for genomes that can't be used in the dataset.
+        """
+        if self.reference_dir:
+            for genome_id in genome_ids:
+                yield genome_id, self._resolve_local(genome_id)
+            return
+        
+        cache = self._genome_cache()
+        resolver = MetadataResolver(self._entrez(), self.entrez_workers, cache = cache,
+                                    offline = self.offline, log = self.log)
+        window = max(self.entrez_workers, 2*self.num_genomes)
+        for genome_id, data in resolver.resolve(genome_ids, window):
+            if data and self.offline and not (cache and data['nuc_id'] in cache):
+                self.log.debug(" + Skipping %s: genome not cached" % data['organism'])
+                data = None
+            yield genome_id, data
+    
+    def _resolve_local(self, genome_id):
+        """
+        Returns the metadata for a genome in the local reference collection.
+        """
+        records = self._reference_index().records(int(genome_id.split(':')[1]))
+        return {'genome_id':str(records[0]['id']), 
+                'def':str(records[0]['description']),
+                'organism':str(records[0]['organism'] or records[0]['description']),
+                'project':'', 
+                'nuc_id':genome_id, 
+                'tax_id':int(records[0]['taxid'])}
+    
     def _make_dataset(self):
         """
         Creates the metadata for the project.
@@ -112,52 +472,24 @@ as well as create sequencing profiles from sequence data.
             n = self.reads**(1.0/(self.num_genomes-1))
         
         ids = self._list()
+        self._random.shuffle(ids)
         last = 0
         i = 0
         self.log.info("Making dataset")
-        while i < self.num_genomes:
+        for genome_id, data in self._resolve(ids):
             if self._stop.isSet():
                 break
-            if ids:
-                genome_id = random.choice(ids)
-                ids.remove(genome_id)
-            else:
-                raise Exception('Not enough genomes.')
+            if not data:
+                continue
             
             new = True
             for prev in dataset:
-                if prev['genome_id'] == genome_id:
+                if prev['genome_id'] == data['genome_id']:
                     new = False
                     break
             if not new:
                 continue
-            
-            summary = Entrez.read(Entrez.esummary(db="genome", id=genome_id))[0]
-            self.log.debug(" + Trying: %s" % summary['Organism_Name'])
-            
-            
-            # Get a taxonomy id if we're printing a key-file
-            tax_id = self._get_tax_id(summary)
-            if not tax_id:
-                self.log.debug("   - Failed: no tax id")
-                continue
-            
-            # Make sure we have a nucleotide id to download the data later.
-            nuc_id = None
-            search_term = "%s[Organism] complete genome" % summary['Organism_Name']
-            try:
-                project_data = Entrez.read(Entrez.esearch("nucleotide", search_term))
-                nuc_id = project_data['IdList'][0]
-            except Exception as e:
-                self.log.debug("   - Failed: no nuc id")
-                continue
-            
-            self.log.info(" * Added %s to dataset" % summary['Organism_Name'])
-            data = {'genome_id':genome_id, 'def':summary['DefLine'], 
-                    'organism':summary['Organism_Name'],
-                    'project':summary['ProjectID'], 
-                    'nuc_id':nuc_id,
-                    'tax_id':tax_id}
+            self.log.info(" * Added %s to dataset" % data['organism'])
             
             if self.distribution.lower() == 'uniform':
                 data['reads'] = avg_reads
@@ -170,68 +502,217 @@ as well as create sequencing profiles from sequence data.
                 data['reads'] = avg_reads
             dataset += [data]
             i += 1
+            if i >= self.num_genomes:
+                break
+        if i < self.num_genomes and not self._stop.isSet():
+            raise Exception('Not enough genomes.')
         return dataset
     
-    def _make_read(self, seq):
+    def _fetch_genome(self, nuc_id):
         """
-        Extracts a single, or mate-paired read from a sequence, and returns the 
-        read sequence as well as the position metadata.
+        Returns a genome, with all of its records, as a Genome. Genomes are 
+        read from the local reference collection or the genome cache when 
+        possible, otherwise they are downloaded from NCBI and cached.
         """
-        length = int(self.read_length)
-        stdev  = numpy.sqrt(self.length_var)
+        if nuc_id.startswith("local:"):
+            return Genome.from_records(self._reference_index().load(int(nuc_id.split(':')[1])))
         
-        read_length = length + int(numpy.random.normal(0, stdev)) if stdev else length
-        if self.matepair:
-            mate_length = length + int(numpy.random.normal(0, stdev)) if stdev else length
-            min_length = max(read_length, mate_length, self.insert_size)
-        else:
-            min_length  = read_length
-    
-        start = random.randint(0, max(0, len(seq)-min_length))
-        read_pos = (start, start + read_length)
-        read_seq = seq[read_pos[0]:read_pos[1]]
-        read_qual = self._make_quality(read_seq)
-        output = [(read_seq, read_pos, read_qual)]
+        cache = self._genome_cache()
+        records = cache.get(nuc_id) if cache else None
+        if records is not None:
+            self.log.info("  * Loaded %s from cache" % nuc_id)
+            return Genome.from_records(records)
+        if self.offline:
+            raise Exception("Genome %s isn't cached, can't download it offline." % nuc_id)
+        
+        self.log.info("  * Downloading %s" % nuc_id)
+        data = None
+        for tries in xrange(5):
+            if self._stop.isSet():
+                break
+            try: 
+                data = self._entrez().efetch("nucleotide", nuc_id, 
+                                             rettype="gb", retmode="text")
+                break
+            except Exception as e:
+                self.log.warning(e)
+                self.log.info("    * Retrying")
+        if not data:
+            raise Exception("Could not download genome %s." % nuc_id)
+        
+        genome = Genome.from_records([(record.id, numpy.frombuffer(str(record.seq), numpy.uint8))
+                                      for record in SeqIO.parse(data, "gb")])
+        if cache:
+            cache.put(nuc_id, genome.records())
+        return genome
     
-        if self.matepair:
-            mate_start = start + min_length - mate_length
-            mate_pos = (mate_start, mate_start+mate_length)
-            mate_seq = seq[mate_pos[0]:mate_pos[1]]
-            mate_qual = self._make_quality(mate_seq)
-            output += [(mate_seq, mate_pos, mate_qual)]
-        return output
+    def _prefetch(self, dataset, genomes, slots, done):
+        """
+        Fetches the genomes of the dataset in order, packs them into the 
+        genome store, and puts (metadata, PackedGenome) tuples on the genomes 
+        queue. A slot is taken for each genome before fetching it. Exceptions 
+        are passed on through the queue.
+        """
+        try:
+            for i, metadata in enumerate(dataset):
+                while not slots.acquire(False):
+                    if self._stop.isSet() or done.isSet():
+                        return
+                    time.sleep(0.1)
+                if self._stop.isSet() or done.isSet():
+                    return
+                self.log.info("  * Fetching %s (%i/%i)" % (metadata['def'], i+1, len(dataset)))
+                key = self._store_key(i, metadata)
+                genome = self._store.get(key)
+                if genome is None:
+                    genome = self._store.put(key, self._fetch_genome(metadata['nuc_id']))
+                self._download_progress = (i+1)/float(len(dataset))
+                genomes.put((metadata, genome))
+        except Exception as e:
+            genomes.put(e)
     
-    def _make_quality(self, seq):
+    def _genomes(self, dataset):
         """
-        Simulates read quality from an error function.
-        Qualities are in Sanger Fastq format (Phred+33), i.e. quality is 
-        represented by an integer from 0 to 93, represented by the ascii 
-        characters 33-126. 
-        Errors are represented as 10^-0.0 (random base) to 10^-9.3 (super 
-        accurate).
-        
-        ref: http://www.ncbi.nlm.nih.gov/pmc/articles/PMC2847217/?tool=pubmed
-        
-        This might be re-written in the future using Biopythons QualityIO,
-        http://www.biopython.org/DIST/docs/api/Bio.SeqIO.QualityIO-module.html
+        Generator yielding (metadata, Genome) for each genome in the dataset.
+        The genomes are fetched by a background thread, so that downloads 
+        overlap with read generation. At most `prefetch` genomes are fetched 
+        ahead, including the one being simulated.
         """
+        genomes = Queue.Queue()
+        slots   = threading.Semaphore(max(1, int(self.prefetch)))
+        done    = threading.Event()
+        self._download_progress = 0.0
         
-        output = ""
-        for i, q in enumerate(seq):
-            if len(self.quality_cache) <= i:
-                f = numpy.poly1d(self.quality_mean)
-                self.quality_cache += [f(len(self.quality_cache))]
-            if len(self.variance_cache) <= i:
-                v = numpy.poly1d(self.quality_var)
-                self.variance_cache += [v(len(self.variance_cache))]
-            
-            quality = self.quality_cache[i]
-            var = numpy.random.normal(0, numpy.sqrt(self.variance_cache[i]))
-            if not numpy.isnan(var):
-                quality += var
-            quality = min(93, max(int(quality), 0))
-            output += "%c" % (33+quality)
-            
+        fetcher = threading.Thread(target = self._prefetch, 
+                                   args = (dataset, genomes, slots, done))
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            for i in xrange(len(dataset)):
+                item = None
+                while item is None:
+                    if self._stop.isSet():
+                        return
+                    try:
+                        item = genomes.get(timeout = 0.5)
+                    except Queue.Empty:
+                        pass
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                item = None
+                slots.release()
+        finally:
+            done.set()
+    
+    def _store_key(self, index, metadata):
+        """
+        Returns the genome store key of a dataset genome. Temporary stores 
+        are keyed by dataset index, so that genomes can be removed as soon as 
+        they have been simulated.
+        """
+        if self.store_dir:
+            return metadata['nuc_id']
+        return "%i_%s" % (index, metadata['nuc_id'])
+    
+    def _read_generator(self):
+        """
+        Returns a ReadGenerator using the current read settings.
+        """
+        return ReadGenerator(self.read_length, self.length_var,
+                             self.quality_mean, self.quality_var,
+                             self.matepair, self.insert_size,
+                             self._compiled_profile)
+    
+    def _shards(self, generator, genome, genome_index, reads, seed):
+        """
+        Splits the reads of a genome into shards of at most `chunk_size` 
+        reads. Each shard gets a random stream seeded from the run seed, the 
+        genome index and the shard index, so that the output is the same 
+        regardless of the number of workers.
+        """
+        chunk_size = max(1, int(self.chunk_size))
+        for i, offset in enumerate(xrange(0, int(reads), chunk_size)):
+            count = min(chunk_size, int(reads) - offset)
+            yield (generator, [(genome_index, genome, offset, count, 
+                                [seed, genome_index, i])], None)
+    
+    def _chunks(self, generator, dataset, genomes, seed):
+        """
+        Splits the reads of all genomes into shards of `chunk_size` reads, 
+        where each shard has reads from all genomes, in random order. The 
+        genome read counts of each chunk are drawn by sequential hypergeometric 
+        sampling, i.e. multinomial sampling without replacement from the reads 
+        that are left, so that the genome totals still match the dataset.
+        """
+        rng = numpy.random.RandomState(seed)
+        remaining = [int(metadata['reads']) for metadata in dataset]
+        offsets   = [0]*len(dataset)
+        left      = sum(remaining)
+        chunk_size = max(1, int(self.chunk_size))
+        for chunk in itertools.count():
+            if not left:
+                break
+            size = min(chunk_size, left)
+            rest = left
+            parts = []
+            for genome_index, count in enumerate(remaining):
+                rest -= count
+                if not size:
+                    break
+                if not count:
+                    continue
+                drawn = rng.hypergeometric(count, rest, size) if rest else size
+                if drawn:
+                    parts += [(genome_index, genomes[genome_index], offsets[genome_index],
+                               drawn, [seed, genome_index, chunk])]
+                    offsets[genome_index]   += drawn
+                    remaining[genome_index] -= drawn
+                    size -= drawn
+                    left -= drawn
+            yield (generator, parts, [seed, chunk])
+    
+    @staticmethod
+    def _is_fastq_name(filename):
+        """
+        Returns True if filename is stdout ('-') or a (possibly compressed) 
+        fastq file name.
+        """
+        for extension in COMPRESSED_EXTENSIONS:
+            if filename.endswith(extension):
+                filename = filename[:-len(extension)]
+        return filename == '-' or filename.endswith("fastq")
+    
+    def _output_files(self):
+        """
+        Returns the list of output file names, with one file per mate for 
+        mate-pairs. A compression extension on the output name applies to all 
+        files. Mate-pairs written to stdout ('-') are interleaved, and then 
+        listed once.
+        """
+        if self.outfile == '-':
+            return ['-']
+        name, extension = self.outfile, ''
+        for compressed in COMPRESSED_EXTENSIONS:
+            if name.endswith(compressed):
+                name, extension = name[:-len(compressed)], compressed
+        if not self.matepair:
+            return [self.outfile]
+        base = ".".join(name.split('.')[:-1])
+        return ["%s.1.fastq%s" % (base, extension), "%s.2.fastq%s" % (base, extension)]
+    
+    def _fastq_records(self, batch, dataset, suffix = ""):
+        """
+        Returns the reads in a ReadBatch as a list of fastq records.
+        """
+        output = []
+        for i in xrange(len(batch)):
+            seq, quality = batch.read(i)
+            header = "@%s|ref:%s-%i|pos:%i-%i%s" % (batch.ids[i],
+                                                    dataset[batch.genome[i]]['genome_id'],
+                                                    batch.index[i], batch.start[i],
+                                                    batch.end[i], suffix)
+            output += ["%s\n%s\n+\n%s\n" % (header, seq, quality)]
         return output
     
     def _write_csv(self, dataset, separator = ','):
@@ -261,7 +742,14 @@ as well as create sequencing profiles from sequence data.
             self.quality_mean = profile['quality_mean']
             self.quality_var  = profile['quality_var']
             
-            self.log.info("Using profile '%s'" % profile_name)
+            compiled = os.path.join(self.profile_dir, profile.get('compiled', ''))
+            if profile.get('compiled') and os.path.exists(compiled):
+                self._compiled_profile = CompiledProfile(compiled)
+            else:
+                self._compiled_profile = None
+            
+            self.log.info("Using %sprofile '%s'" % ("compiled " if self._compiled_profile 
+                                                   else "", profile_name))
             self.log.info(" + Number of reads: %.1e" % self.reads)
             self.log.info(" + Read length    : %i±%i Bp" % (self.read_length, numpy.sqrt(self.length_var),))
         else:
@@ -273,17 +761,28 @@ as well as create sequencing profiles from sequence data.
         """
         return self._progress
     
+    def download_progress(self):
+        """
+        Returns the fraction of the dataset genomes that have been fetched.
+        """
+        return self._download_progress
+    
     @staticmethod
     def get_profiles(return_format = None, profile_dir = 'profiles'):
         """
-        Returns a list of allowed sequencing profiles.
+        Returns a list of allowed sequencing profiles. Profiles are only read 
+        again if their files have been modified.
         """
         profiles = {}
         
         try:
             for profile in os.listdir(profile_dir):
                 if profile.split('.')[-1].lower() == 'json' and profile[0] != '.':
-                    data = json.load(open("%s/%s" % (profile_dir, profile)))
+                    filename = "%s/%s" % (profile_dir, profile)
+                    mtime = os.path.getmtime(filename)
+                    if _PROFILES.get(filename, (None,))[0] != mtime:
+                        _PROFILES[filename] = (mtime, json.load(open(filename)))
+                    data = _PROFILES[filename][1]
                     profiles[data['key']] = data
         except:
             return profiles
@@ -298,68 +797,32 @@ as well as create sequencing profiles from sequence data.
         return profiles
     
     @staticmethod
-    def parse_profile(infiles, output = None, profile_dir = 'profiles'):
-        min_length  = 1e12
-        max_length  = 0
-        length_mean = 0
-        length_var  = 0
-        
-        min_qual    = None
-        max_qual    = None
-        qual_mean   = None
-        qual_var    = 0
-        count       = []
-        
-        for infile in infiles:
-            for i, record in enumerate(SeqIO.parse(infile, 'fastq')):
-                qual = numpy.array(record.letter_annotations['phred_quality'], 
-                                   float)
-                length_mean += len(record.seq)
-                length_var  += len(record.seq)**2
-                if len(record.seq) < min_length:
-                    min_length = len(record.seq)
-                if len(record.seq) > max_length:
-                    max_length = len(record.seq)
-            
-                if qual_mean == None:
-                    qual_mean = numpy.array(qual)
-                    max_qual  = qual
-                    min_qual  = qual
-                    qual_var  = qual**2
-                else:
-                    for p, q in enumerate(qual):
-                        if p >= len(qual_mean):
-                            qual_mean = numpy.append(qual_mean, q)
-                            max_qual  = numpy.append(max_qual,  q)
-                            min_qual  = numpy.append(min_qual,  q)
-                            qual_var  = numpy.append(qual_var, q**2)
-                        else:
-                            qual_mean[p] += q
-                            qual_var[p] += q**2
-                            if q > max_qual[p]:
-                                max_qual[p] = q
-                            if q < min_qual[p]:
-                                min_qual[p] = q
-            
-                # counter to keep track of how many values are stored for each 
-                # nucleotide position
-                for p, q in enumerate(qual):
-                    if p >= len(count):
-                        count = numpy.append(count, 1.0)
-                    else:
-                        count[p] += 1.0
-        
-        # convenience variables
-        tot = float(count[0]) # total number of reads
-        
-        mean_reads  = round(tot / len(infiles))
-        length_mean = length_mean / tot
-        length_var  = length_var / tot - length_mean**2
-        qual_mean   = qual_mean / count
-        qual_var    = qual_var / count - qual_mean**2
+    def parse_profile(infiles, output = None, profile_dir = 'profiles', workers = 1,
+                      sample_size = 0, seed = None):
+        """
+        Creates a sequencing profile from a list of (optionally gzipped) fastq 
+        files, read in parallel by `workers` processes. If sample_size is set, 
+        the quality and length statistics are taken from that many randomly 
+        sampled reads.
+        
+        Besides the json profile, a compiled profile (.npz) is saved with the 
+        read length and per-position quality histograms, which are then used 
+        to draw read lengths and qualities when the profile is loaded.
+        """
+        stats, total = parse_files(infiles, workers, sample_size, seed)
+        
+        mean_reads  = round(total / float(len(infiles)))
+        length_mean = stats.length_mean()
+        length_var  = stats.length_var()
+        qual_mean   = stats.quality_mean()
+        qual_var    = stats.quality_var()
         
         if not output:
             output = infiles[0].split('/')[-1].split('.')[0]
+        if output.endswith(".json"):
+            output = output[:-5]
+        compiled = "%s.npz" % output
+        save_compiled(stats, "%s/%s" % (profile_dir, compiled))
         
         # least squares approximation coefficients
         
@@ -373,13 +836,125 @@ as well as create sequencing profiles from sequence data.
                    "read_length_var": length_var,
                    "quality_mean": list(m),
                    "quality_var": list(v),
+                   "compiled": compiled,
                   }
 
-        if not output.endswith(".json"):
-            output = "%s.json" % output
+        output = "%s.json" % output
         with open("%s/%s" % (profile_dir, output), 'w') as out:
             out.write(json.dumps(profile, indent=True))
     
+    def _reset_seed(self):
+        """
+        Picks the random seed for a new dataset (a random one if the seed 
+        setting is negative), and seeds the genome selection with it.
+        """
+        self._run_seed = self.seed if self.seed >= 0 else random.randint(0, 2**32-1)
+        self.log.info('Random seed: %i' % self._run_seed)
+        self._random.seed(self._run_seed)
+        return self._run_seed
+    
+    def _sequential(self, dataset, generator, simulate, seed):
+        """
+        Generator yielding batches of reads one genome at a time.
+        """
+        for genome_index, (metadata, genome) in enumerate(self._genomes(dataset)):
+            if self._stop.isSet():
+                break
+            self._progress = 0.0
+            
+            self.log.info("* Parsing %s" % metadata['def'])
+            self.log.info("  * Creating Reads from %i record(s)" % len(genome.ids))
+            
+            shards = self._shards(generator, genome, genome_index,
+                                  metadata['reads'], seed)
+            done = 0
+            for batches in simulate(_simulate_shard, shards):
+                if self._stop.isSet():
+                    break
+                for reads in batches:
+                    yield reads
+                    done += len(reads[0])
+                    self._progress = done/float(int(metadata['reads']))
+            if not self.store_dir:
+                self._store.remove(self._store_key(genome_index, metadata))
+    
+    def _interleaved(self, dataset, generator, simulate, seed):
+        """
+        Generator yielding batches of reads from all genomes at once, in 
+        random order. All genomes are fetched into the genome store first.
+        """
+        genomes = []
+        for metadata, genome in self._genomes(dataset):
+            genomes += [genome]
+        if self._stop.isSet():
+            return
+        self._progress = 0.0
+        self.log.info("* Creating Reads from %i genomes" % len(genomes))
+        
+        total = sum(int(metadata['reads']) for metadata in dataset)
+        done  = 0
+        for batches in simulate(_simulate_shard, 
+                                self._chunks(generator, dataset, genomes, seed)):
+            if self._stop.isSet():
+                break
+            for reads in batches:
+                yield reads
+                done += len(reads[0])
+                self._progress = done/float(total)
+    
+    def iter_reads(self, dataset = None):
+        """
+        Generator yielding the simulated reads of a dataset in batches, as 
+        (dataset, reads) tuples, where dataset is the list of genome metadata 
+        (organism, tax_id, etc.), and reads a list of one ReadBatch, or two for 
+        mate-pairs, holding the sequences, qualities, genomes (as indices into 
+        the dataset), records, positions and number of errors of the reads.
+        
+        Reads are generated one genome at a time, or from all genomes in 
+        random order if the interleave setting is set.
+        
+        If no dataset is given, a new one is created from the settings. Reads 
+        are generated as they are consumed, and genomes are memory-mapped from 
+        a 2-bit packed genome store (in store_dir, or a temporary directory), 
+        so memory use doesn't depend on the number or size of the genomes.
+        """
+        if dataset is None or self._run_seed is None:
+            self._reset_seed()
+        if dataset is None:
+            dataset = self._make_dataset()
+        seed = self._run_seed
+        if self.store_dir:
+            self._store = GenomeStore(self.store_dir)
+        else:
+            self._store = GenomeStore(tempfile.mkdtemp(prefix = "metamaker"))
+        
+        if self.workers > 1:
+            self.log.info('Simulating reads using %i processes' % self.workers)
+            pool = multiprocessing.Pool(self.workers)
+            simulate = functools.partial(_bounded_imap, pool, window = 2*self.workers)
+        else:
+            pool = None
+            simulate = itertools.imap
+        generator = self._read_generator()
+        finished = False
+        try:
+            if self.interleave:
+                batches = self._interleaved(dataset, generator, simulate, seed)
+            else:
+                batches = self._sequential(dataset, generator, simulate, seed)
+            for reads in batches:
+                yield dataset, reads
+            finished = not self._stop.isSet()
+        finally:
+            if pool:
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+            if not self.store_dir:
+                self._store.clear()
+    
     def run(self):
         """
         Starts the job of creating a metagenomic sample set.
@@ -389,13 +964,10 @@ as well as create sequencing profiles from sequence data.
                 self.log.error('Already running MetaMaker, can\'t start again.')
             self.log.info("Running MetaMaker")
             self.running = True
-            if self.matepair:
-                base = ".".join(self.outfile.split('.')[:-1])
-                self.log.info('output: %s.1.fastq & %s.2.fastq, key-file: %s' % 
-                             (base, base, self.keyfile) )
-            else:
-                self.log.info('output: %s, key-file: %s' % 
-                             (self.outfile, self.keyfile) )
+            self._reset_seed()
+            filenames = self._output_files()
+            self.log.info('output: %s, key-file: %s' % 
+                          (" & ".join(filenames), self.keyfile) )
             
             dataset = self._make_dataset()
             
@@ -411,90 +983,33 @@ as well as create sequencing profiles from sequence data.
             if self.keyfile:
                 self._write_csv(dataset)
                 
-            # Start creating the fastq output file.
-            if self.matepair:
-                base = ".".join(self.outfile.split('.')[:-1])
-                out = open("%s.1.fastq" % base, 'w')
-                mate = open("%s.2.fastq" % base, 'w')
-            else:
-                out = open(self.outfile, 'w')
-            for metadata in dataset:
-                if self._stop.isSet():
-                    break
-                self._progress = 0.0
-                
-                self.log.info("* Parsing %s" % metadata['def'])
-                self.log.info("  * Downloading")
-                
-                for tries in xrange(5):
-                    if self._stop.isSet():
-                        break
-                    try: 
-                        data = Entrez.efetch(db="nucleotide", id=metadata['nuc_id'], 
-                                             rettype="gb",    retmode="text")
-                        break
-                    except Exception as e:
-                        self.log.warning(e)
-                        self.log.info(project_data)
-                        self.log.info("    * Retrying")
-                        pass
-                
-                self.log.info("  * Creating Reads" )
-                
-                for record in SeqIO.parse(data,"gb"):
-                    if self._stop.isSet():
-                        break
-                    # TODO: make use of several records if present
-                    for i in xrange(int(metadata['reads'])):
-                        if self._stop.isSet():
-                            break
-                        seqs = []
-                        while not seqs:
-                            if self._stop.isSet():
-                                break
-                            seqs = self._make_read(record.seq)
-                    
-                        # apply quality to read(s)
-                        first = True
-                        for seq, pos, quality in seqs:
-                            if self._stop.isSet():
-                                break
-                            seq = list(seq)
-                            for j, q in enumerate(quality):
-                                if numpy.random.random() < (10**-((ord(q)-33)/10.0)):
-                                    seq[j] = 'actg'[numpy.random.randint(4)]
-                            seq = "".join(seq)
-                            header = "@%s|ref:%s-%i|pos:%i-%i" % (record.id, 
-                                                            metadata['genome_id'],
-                                                            i, pos[0], pos[1])
-                            if self.matepair:
-                                if first:
-                                    out.write("%s/1\n" % header)
-                                    out.write("%s\n" % seq)
-                                    out.write("+\n%s\n" % quality)
-                                else:
-                                    mate.write("%s/2\n" % header)
-                                    mate.write("%s\n" % seq)
-                                    mate.write("+\n%s\n" % quality)
-                            else:
-                                out.write("%s\n" % header)
-                                out.write("%s\n" % seq)
-                                out.write("+\n%s\n" % quality)
-                            first = False
-                        self._progress = (i+1)/float(int(metadata['reads']))
-                    break
+            # Start creating the fastq output file, and the truth index.
+            handles = [open_output(f, self.compress_threads) for f in filenames]
+            mates_interleaved = self.matepair and len(handles) == 1
+            suffixes = ["/1", "/2"] if self.matepair else [""]
+            truth = TruthWriter(self.truthfile) if self.truthfile else None
+            taxids = numpy.array([i['tax_id'] for i in dataset], numpy.int32)
+            written = 0
+            for dataset, reads in self.iter_reads(dataset):
+                if truth:
+                    truth.write(truth_rows(reads, written, taxids))
+                written += len(reads[0])
+                fastq = [self._fastq_records(batch, dataset, suffix)
+                         for batch, suffix in zip(reads, suffixes)]
+                if mates_interleaved:
+                    handles[0].write("".join(itertools.chain(*zip(*fastq))))
+                else:
+                    for handle, records in zip(handles, fastq):
+                        handle.write("".join(records))
             
-            out.close()
-            if self.matepair:
-                mate.close()
+            for handle in handles:
+                handle.close()
+            if truth:
+                truth.close()
+                self.log.info("Truth index saved to %s" % self.truthfile)
             self._progress = -1
             self.log.info("Finished. All went well!")
-            if self.matepair:
-                base = ".".join(self.outfile.split('.')[:-1])
-                self.log.info("Results saved to %s.1.fastq & %s.2.fastq" % 
-                              (base, base))
-            else:
-                self.log.info("Results saved to %s" % self.outfile)
+            self.log.info("Results saved to %s" % " & ".join(filenames))
         except RuntimeError as e:
             pass
         except Exception as e:
@@ -531,17 +1046,38 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser( description = __doc__,
                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     
-    parser.add_argument("-c", "--create", help="Create new profile from file(s).", nargs="+", default=None)
+    parser.add_argument("-c", "--create", help="Create new profile from (optionally gzipped) fastq file(s).", nargs="+", default=None)
+    parser.add_argument("--sample", help="Create the profile from this many randomly sampled reads, 0 uses all reads.", default=0, type=int)
     parser.add_argument("-d", "--distribution", help="Read distribution, 'uniform' or 'exponential'", default="uniform")
     parser.add_argument("-i", "--insert", help="Matepair insert size.", type=int, default=3000)
     parser.add_argument("-k", "--keyfile", help="key filename.", default=None)
+    parser.add_argument("-t", "--truth", help="Write the origin of each read to this (.npy) truth index.",
+                        default="")
     parser.add_argument("-l", "--length_var", help="Length variance.", default=0.0, type=float)
-    parser.add_argument("-o", "--output", help="Output filename", default="output")
+    parser.add_argument("-o", "--output", help=("Output filename. Compressed if ending with .gz "
+                                                "(gzip) or .bgz (BGZF), '-' writes to stdout."),
+                        default="output")
     parser.add_argument("-p", "--progress", default=False, action='store_true', help="Display progress information for long tasks.")
     parser.add_argument("-m", "--matepair", help="Generate matepairs.", action="store_true", default=False)
     parser.add_argument("-n", "--no_reads", help="Number of reads.", default="50M")
     parser.add_argument("-r", "--read_length", help="Read length", default="200")
     parser.add_argument("-s", "--no_species", help="Number of species.", default=10, type=int)
+    parser.add_argument("-w", "--workers", help="Number of worker processes for read generation.", default=1, type=int)
+    parser.add_argument("--chunk", help="Number of reads per shard given to a worker process. Each shard has its own random stream, so a seeded dataset depends on the shard size, but not on the number of workers.", default=100000, type=int)
+    parser.add_argument("--cache_dir", help="Genome cache directory, disables the cache if empty.", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--cache_size", help="Genome cache size limit in bytes.", default=str(DEFAULT_CACHE_SIZE))
+    parser.add_argument("--references", help="Directory of local fasta/genbank reference genomes to use instead of NCBI.", default="")
+    parser.add_argument("--entrez_url", help="Base URL of the Entrez E-utilities.", default=EUTILS_URL)
+    parser.add_argument("--api_key", help="NCBI API key, raises the request rate limit.", default="")
+    parser.add_argument("--entrez_workers", help="Number of concurrent Entrez requests.", default=4, type=int)
+    parser.add_argument("--prefetch", help="Max number of genomes held in memory, while downloading ahead.", default=2, type=int)
+    parser.add_argument("--offline", help="Only use cached genomes and metadata.", action="store_true", default=False)
+    parser.add_argument("--compress_threads", help="Number of threads for output compression.", default=4, type=int)
+    parser.add_argument("--store_dir", help=("Directory of 2-bit packed genomes to simulate from, kept between "
+                                             "runs. A temporary directory is used if empty."), default="")
+    parser.add_argument("--interleave", help="Write the reads of all genomes in random order, instead of one genome at a time.",
+                        action="store_true", default=False)
+    parser.add_argument("--seed", help="Random seed, for reproducible datasets. Random if negative.", default=-1, type=int)
     parser.add_argument("-f", "--profile", default=None,
                         help=("Sequencing profile to use for read generation. Changes default for "
                               "reads, read_length and error_function. Valid options are %s") % \
@@ -561,7 +1097,7 @@ if __name__ == '__main__':
     
     args = parser.parse_args()
     
-    for arg in ['no_reads', 'read_length']:
+    for arg in ['no_reads', 'read_length', 'cache_size']:
         if eval("args.%s" % arg)[-1] in ['K', 'k']:
             exec("args.%s = int(args.%s[:-1])*1000" % (arg, arg))
         elif eval("args.%s" % arg)[-1] in ['M', 'm']:
@@ -588,7 +1124,9 @@ if __name__ == '__main__':
     
     app = MetaMaker( args.output, args.no_species )
     if args.create:
-        app.parse_profile(args.create, args.output)
+        app.parse_profile(args.create, args.output, workers = args.workers,
+                          sample_size = args.sample,
+                          seed = args.seed if args.seed >= 0 else None)
     else:
         if args.profile:
             app.load_profile( args.profile )
@@ -603,4 +1141,19 @@ if __name__ == '__main__':
         app.set('matepair',     args.matepair)
         app.set('insert_size',  args.insert)
         app.set('progress',     args.progress)
+        app.set('workers',      args.workers)
+        app.set('chunk_size',   args.chunk)
+        app.set('seed',         args.seed)
+        app.set('cache_dir',    args.cache_dir)
+        app.set('cache_size',   args.cache_size)
+        app.set('offline',      args.offline)
+        app.set('reference_dir', args.references)
+        app.set('entrez_url',   args.entrez_url)
+        app.set('api_key',      args.api_key)
+        app.set('entrez_workers', args.entrez_workers)
+        app.set('prefetch',     args.prefetch)
+        app.set('compress_threads', args.compress_threads)
+        app.set('store_dir',    args.store_dir)
+        app.set('interleave',   args.interleave)
+        app.set('truthfile',    args.truth)
         app.run()
\ No newline at end of file
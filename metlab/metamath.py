@@ -1,46 +1,340 @@
 #!/usr/bin/env python2.7
 
 from __future__ import division
+import math
+import numpy
+import logging
 try:
-    try:
-        from metapprox import metapprox
-    except:
-        from mpmath import *
-        mp.dps = 128
-        mp.pretty = True
+    from probability_cache import ProbabilityCache
+except ImportError:
+    ProbabilityCache = None
+try:
+    from metapprox import metapprox
+except:
+    metapprox = None
+try:
+    from mpmath import *
 except:
-    raise
+    if not metapprox:
+        raise
+
+# Default bound on the absolute error of calculated probabilities
+TOLERANCE = 1e-12
+# Range of working precisions (in bits) of the mpmath calculations
+MIN_PRECISION = 64
+MAX_PRECISION = 2**20
+GUARD_BITS = 8
+# Threads summing the series in the C functions, 0 for one per processor
+THREADS = 0
+# Version of the calculations, part of the keys of cached results, to be 
+# increased whenever the results of full_coverage, gap_consensus or get_runs
+# change
+CACHE_VERSION = 3
+# Whether results are cached persistently (see probability_cache), so that 
+# the GUI, the controller and the command line share them between sessions
+USE_CACHE = True
+_CACHE = []
 
 def bp_to_int(value, suffix="KMGTP"):
     try:
-        exp = (suffix.index(value[-1].upper())+1)*3 if value[-1].upper() in suffix else 1
+        if value[-1].upper() not in suffix:
+            return int(float(value))
+        exp = (suffix.index(value[-1].upper())+1)*3
         return int(float(value[:-1])*(10**exp))
     except:
         return -1
 
+def _cached(name, args, calculate):
+    """
+    Returns the result of calculate(), from the persistent result cache if 
+    it's there, keyed by the function name, its normalized arguments, 
+    CACHE_VERSION and TOLERANCE.
+    """
+    if not _CACHE and USE_CACHE and ProbabilityCache:
+        try:
+            _CACHE.append(ProbabilityCache())
+        except (OSError, IOError) as e:
+            logging.getLogger(__name__).warning("Can't open probability cache: %s" % e)
+            _CACHE.append(None)
+    cache = _CACHE[0] if _CACHE and USE_CACHE else None
+    key = ProbabilityCache.key(name, CACHE_VERSION, TOLERANCE, *args) if cache else None
+    result = cache.get(key) if cache else None
+    if result is None:
+        result = calculate()
+        if cache:
+            cache.put(key, result)
+    return result
+
 def binomial(n,k):
     return fac(n)/(fac(k)*fac(n-k))
 
-def get_runs(L,l,R,a,max_iterations=10,p_limit=0.1):
-    for i in range(max_iterations):
-        p = full_coverage(L,l,R*(i+1),a)
-        if p >= p_limit:
+def _stevens_sum(R,f,a,k,first,n,coefficient):
+    """
+    Returns the sum of the terms first <= b < n of the series
+      
+      c_b * (1-b*f)^(b-1) * (1-b*f*a)^(R-b)
+    
+    where coefficient is c_first, and c_(b+1) = -c_b * a * (R-b)/(b+1-k), 
+    which is binomial(R,b)*(-a)^b for k = 0, and binomial(R-k,b-k)*(-1)^(b-k)*a^b
+    when starting from c_k = a^k. The powers are evaluated in log-space, so 
+    that each term costs the same, instead of computing factorials and powers 
+    from scratch for every term.
+    """
+    result = mpf(0)
+    for b in xrange(first, n):
+        result += coefficient * exp((b-1)*log1p(-b*f) + (R-b)*log1p(-b*f*a))
+        coefficient *= -a*(R-b)/(b+1-k)
+    return result
+
+def _log1p_condition(y):
+    """
+    Returns the condition number of log(1-y), for 0 <= y < 1.
+    """
+    return y / ((1.0 - y) * abs(math.log1p(-y))) if y > 0 else 1.0
+
+def _plan(R,f,a,k,first,n,log_c0,tolerance):
+    """
+    Plans the evaluation of _stevens_sum from the magnitudes of the terms, 
+    computed with floats in log-space, the same way as plan_series in 
+    _metapprox.c. Returns (terms, tail, log_weight): the series is truncated 
+    to the terms first <= b < terms, with the remaining tail bounded by tail,
+    and the rounding error at precision p is bounded by 
+    exp(log_weight)*2^(1-p).
+    """
+    log_a = math.log(a) if a > 0 else -float('inf')
+    log_e = (R-n) * math.log1p(-f*a)
+    log_c = log_c0
+    max_log, total, weights = -float('inf'), 0.0, 0.0
+    terms, tail = n, 0.0
+    for b in xrange(first, n):
+        x = (b-1)*math.log1p(-b*f) + (R-b)*math.log1p(-b*f*a)
+        c = max(_log1p_condition(b*f), _log1p_condition(b*f*a))
+        log_t = log_c + x
+        
+        # running sums of |T_b| and |T_b|*factor, scaled by exp(-max_log)
+        if log_t > max_log:
+            total *= math.exp(max_log - log_t)
+            weights *= math.exp(max_log - log_t)
+            max_log = log_t
+        if log_t > -float('inf'):
+            total += math.exp(log_t - max_log)
+            weights += math.exp(log_t - max_log) * (3.0*(b-first) + (c+4.0)*abs(x) + 16.0)
+        
+        if b + 1 >= n:
             break
-    return i+1, p
+        # the remaining terms shrink at least by the ratio q, once it's < 1
+        log_q = log_a + math.log(R-b) - math.log(b+1-k)
+        if log_q + log_e < 0:
+            q = math.exp(log_q + log_e)
+            bound = log_t + log_q + log_e - math.log1p(-q)
+            if bound < math.log(tolerance/4.0):
+                terms, tail = b + 1, math.exp(bound)
+                break
+        log_c += log_q
+    weight = weights + (terms-first)*total
+    return terms, tail, max_log + math.log(weight) if weight > 0 else -float('inf')
 
-def full_coverage(L,l,R,a):
+def _precision(log_weight, tolerance):
+    """
+    Returns the precision p (in bits) for which exp(log_weight)*2^(1-p) is 
+    below tolerance/2, with a few guard bits.
+    """
+    bits = (log_weight - math.log(tolerance/2.0)) / math.log(2.0) + 1 + GUARD_BITS
+    if not bits > MIN_PRECISION:
+        return MIN_PRECISION
+    return int(math.ceil(bits)) if bits < MAX_PRECISION else MAX_PRECISION
+
+def _rounding_error(log_weight, precision):
+    return math.exp(log_weight + (1 - precision)*math.log(2.0))
+
+def _series_length(L,l,R):
+    """
+    Returns the Stevens series delimiter min(R, round(L/l)), as the C 
+    implementation.
+    """
+    return min(int(R), (2*int(L) + int(l))//(2*int(l)))
+
+def _clamp(result):
+    """
+    Clamps the probability of a (p, error, precision) result to [0, 1], 
+    where rounding and truncation may leave it, keeping its error bound.
+    """
+    p, error, precision = result
+    return min(1.0, max(0.0, p)), error, precision
+
+def _full_coverage_direct(L,l,R,a):
+    """
+    Reference implementation of full_coverage, summing the terms directly.
+    """
+    f = mpf(l)/L
+    n = _series_length(L,l,R)
+    a = mpf(a)
+    result = 0.0
+    for b in range(0, n):
+        
+        first  = binomial(R,b)
+        second = (-a)**(b)
+        third  = (1-b*f)**(b-1)
+        fourth  = (1-b*f*a)**(R-b) 
+        
+        result += first * second * third * fourth
+    
+    return result
+
+def _gap_consensus_direct(L,l,R,a,k):
+    """
+    Reference implementation of gap_consensus, summing the terms directly.
+    """
+    f = mpf(l)/L
+    n = _series_length(L,l,R)
+    a = mpf(a)
+    term1 = binomial(R,k)
+    term2 = 0.0
+    for b in range(k, n):
+        
+        first  = binomial(R-k,b-k)
+        second = (-1)**(b-k)
+        third  = a**b
+        fourth = (1-b*f)**(b-1)
+        fifth  = (1-b*f*a)**(R-b) 
+        
+        term2 += first * second * third * fourth * fifth
+    
+    return term1*term2
+
+def check(cases = [(10000,100,1000,0.5,2), (100000,150,50000,0.1,2),
+                   (20000,100,5000,0.2,2), (10000,50,2000,0.3,2)]):
+    """
+    Compares the mpmath recurrences with the direct summation (at 128 
+    digits), for parameter sets (L,l,R,a,k) small enough for the sums to 
+    converge. Returns a list of (L, l, R, a, k, function, direct, recurrence,
+    difference, error bound, precision).
     """
-    Wrapper function around the C-function with the same name. Casts all 
-    arguments to the correct type, then calls the C function and returns it's 
-    return value. If the C-function isn't available, the value is calculated 
-    using mpmath instead.
+    results = []
+    for L,l,R,a,k in cases:
+        with workdps(128):
+            direct = [_full_coverage_direct(L,l,R,a), _gap_consensus_direct(L,l,R,a,k)]
+        for name, reference, (p, error, precision) in [
+                ("full_coverage", direct[0], _full_coverage(L,l,R,a)),
+                ("gap_consensus", direct[1], _gap_consensus(L,l,R,a,k))]:
+            results += [(L,l,R,a,k,name,float(reference),p,
+                         float(abs(p-reference)),error,precision)]
+    return results
 
+def _probabilities(L,l,R,a,k,memo,threads=THREADS):
+    """
+    Returns the probabilities of full coverage (or of at most k gaps) for a 
+    list of read counts R, evaluating all new points in one call so that they
+    share the terms that don't depend on R. Evaluated points are kept in 
+    memo, a dict keyed by read count, for the other calls of the same search.
+    """
+    new = sorted(set(r for r in R if r not in memo))
+    if new and k is None:
+        p = full_coverage_tiered(L,l,numpy.array(new),a,TOLERANCE,threads)[0]
+    elif new:
+        p = sum(gap_consensus_tiered(L,l,numpy.array(new),a,j,TOLERANCE,threads)[0] 
+                for j in xrange(k+1))
+    for r, x in zip(new, p if new else []):
+        memo[r] = float(x)
+    return [memo[r] for r in R]
+
+def min_reads(L,l,a,p_limit=0.1,k=None,step=1,max_reads=10**12,tolerance=0,probes=4,
+              threads=THREADS):
+    """
+    Returns (R, p), the smallest number of reads R (a multiple of step) with 
+    a probability p >= p_limit of full coverage, or of at most k gaps if k is
+    given, or (None, p) if max_reads isn't enough. As the probability grows 
+    with R, the answer is first bracketed, starting from a Lander-Waterman 
+    estimate and doubling, and then narrowed by evaluating a few probes 
+    within the bracket at once, until it is known exactly, or only to within
+    tolerance (relative to R) if a tolerance is given, in which case R may 
+    be larger than the minimum.
+    
+    Arguments are:
+    L : approximated length of target genome
+    l : (mean) length of sequenced reads
+    a : approximated abundance of target in R
+    """
+    L, l, a = int(L), int(l), float(a)
+    max_units = max(1, int(max_reads // step))
+    # reads needed for 1X expected coverage with no gaps, L/l*ln(L/l)/a
+    units = int(L/l*math.log(max(2.0, L/l))/max(a, 1e-300)/step)
+    units = min(max_units, max(1, units))
+    memo = {}
+    
+    # find a bracket lo < R <= hi, in units of step
+    lo, hi = 0, None
+    while hi is None:
+        p = _probabilities(L,l,[units*step],a,k,memo,threads)[0]
+        if p >= p_limit:
+            hi, p_hi = units, p
+        elif units >= max_units:
+            return None, p
+        else:
+            lo, units = units, min(max_units, units*2)
+    
+    # narrow the bracket
+    while hi - lo > max(1, int(tolerance*hi)):
+        points = sorted(set(lo + (hi-lo)*(i+1)//(probes+1) for i in xrange(probes)))
+        points = [u for u in points if lo < u < hi]
+        for u, p in zip(points, _probabilities(L,l,[u*step for u in points],a,k,memo,threads)):
+            if p >= p_limit:
+                hi, p_hi = u, p
+                break
+            lo = u
+    
+    return hi*step, p_hi
+
+def min_runs(L,l,R,a,p_limit=0.1,k=None,max_runs=10**6,threads=THREADS):
+    """
+    Returns (runs, p), the smallest number of sequencing runs of R reads with
+    a probability p >= p_limit of full coverage (or of at most k gaps), or 
+    (None, p) if max_runs runs aren't enough.
+    """
+    reads, p = min_reads(L,l,a,p_limit,k,int(R),int(R)*max_runs,tolerance=0,threads=threads)
+    return (reads//int(R) if reads else None), p
+
+def get_runs(L,l,R,a,max_iterations=10,p_limit=0.1,threads=THREADS):
+    """
+    Returns (runs, p), the number of runs of R reads needed to reach a 
+    probability of full coverage p >= p_limit, or (max_iterations, p) if it
+    isn't reached in max_iterations runs. The series are summed on threads
+    threads (see full_coverage_bounds). Results are cached persistently.
+    """
+    L, l, R, max_iterations, p_limit = int(L), int(l), int(R), int(max_iterations), float(p_limit)
+    a = float(a)
+    def calculate():
+        runs, p = min_runs(L,l,R,a,p_limit,max_runs=max_iterations,threads=threads)
+        return (runs if runs else max_iterations), p
+    return tuple(_cached("get_runs", [L,l,R,a,max_iterations,p_limit], calculate))
+
+def full_coverage(L,l,R,a):
+    """
+    Returns the probability of full coverage of the target genome, to within
+    TOLERANCE. The float64 approximation is used where its error estimate is
+    small enough, and the series otherwise, see full_coverage_tiered and 
+    full_coverage_bounds. Results are cached persistently.
+    
     Arguments are:
     L : approximated length of target genome
     l : (mean) length of sequenced reads
     R : number of reads in the metagenomic community
     a : approximated abundance of target in R
     """
+    L, l, R, a = int(L), int(l), int(R), float(a)
+    return _cached("full_coverage", [L,l,R,a], 
+                   lambda: float(full_coverage_tiered(L,l,R,a,TOLERANCE)[0]))
+
+def full_coverage_bounds(L,l,R,a,tolerance=TOLERANCE,threads=THREADS):
+    """
+    Wrapper function around the C-function full_coverage. Casts all 
+    arguments to the correct type, then calls the C function and returns 
+    (p, error, precision): the probability (clamped to [0, 1]), a bound on
+    its absolute error, and the working precision (in bits) that was needed
+    to reach tolerance. The C function sums blocks of the series on threads threads. If the 
+    C-function isn't available, the value is calculated using mpmath 
+    instead, in a single thread.
+    """
     # Cast all variables to the right type
     L = int(L)
     l = int(l)
@@ -49,34 +343,103 @@ def full_coverage(L,l,R,a):
     
     try:
         from metapprox import metapprox
-        return metapprox.full_coverage(L,l,R,a)
+        return _clamp(metapprox.full_coverage(L,l,R,a,tolerance,int(threads)))
     except Exception as e:
         pass
     
+    return _clamp(_full_coverage(L,l,R,a,tolerance))
+
+def _full_coverage(L,l,R,a,tolerance=TOLERANCE):
     # calculate derived variables
-    f = l/L
-    n = min(R, int(1.0/f))
+    n = _series_length(L,l,R)
     
-    # calculate result
-    result = 0.0
-    steps = n
-    for b in range(0, n):
-        
-        first  = binomial(R,b)
-        second = (-a)**(b)
-        third  = (1-b*f)**(b-1)
-        fourth  = (1-b*f*a)**(R-b) 
-        
-        result += first * second * third * fourth
+    # truncate the series and choose a precision, then calculate result
+    terms, tail, log_weight = _plan(R,l/L,a,0,0,n,0.0,tolerance)
+    precision = _precision(log_weight, tolerance)
+    with workprec(precision):
+        p = _stevens_sum(R,mpf(l)/L,mpf(a),0,0,terms,mpf(1))
     
-    return result
+    return float(p), tail + _rounding_error(log_weight, precision), precision
+
+def full_coverage_grid(L,l,R,a,tolerance=TOLERANCE,bounds=False,threads=THREADS):
+    """
+    Calculates full_coverage for arrays of parameters, which are broadcast 
+    against each other, and returns an array of probabilities of the 
+    broadcast shape, or (probabilities, errors) if bounds is True. Points 
+    with the same L and l (and a) share the parts of the series which only 
+    depend on those, so a grid over e.g. read counts costs much less than 
+    calling full_coverage for every point. The C function releases the GIL 
+    while calculating, and sums each group of points on threads threads.
+    """
+    L, l, R, a = numpy.broadcast_arrays(L, l, R, a)
+    shape = L.shape
+    L, l, R = [numpy.asarray(x, numpy.int64).ravel() for x in [L, l, R]]
+    a = numpy.asarray(a, float).ravel()
+    
+    # sort the points so that points sharing work are adjacent
+    order = numpy.lexsort((R, a, l, L))
+    args = [x[order].tolist() for x in [L, l, R, a]] + [tolerance]
+    result = numpy.zeros(len(order))
+    errors = numpy.zeros(len(order))
+    try:
+        from metapprox import metapprox
+        result[order], errors[order] = metapprox.full_coverage_grid(*args + [int(threads)])
+    except Exception as e:
+        result[order], errors[order] = _full_coverage_grid(*args)
+    
+    numpy.clip(result, 0.0, 1.0, out=result)
+    if bounds:
+        return result.reshape(shape), errors.reshape(shape)
+    return result.reshape(shape)
+
+def _full_coverage_grid(L,l,R,a,tolerance=TOLERANCE):
+    results, errors = [], []
+    start = 0
+    while start < len(L):
+        end = start + 1
+        while end < len(L) and L[end] == L[start] and l[end] == l[start]:
+            end += 1
+        p, error = _coverage_group(L[start], l[start], R[start:end], a[start:end], tolerance)
+        results += p
+        errors += error
+        start = end
+    return results, errors
+
+def _coverage_group(L,l,R,a,tolerance=TOLERANCE):
+    """
+    Calculates full_coverage for points sharing L and l, summing the series 
+    term by term for all points at once, so that (b-1)*log(1-b*f) is only 
+    computed once per term, and log(1-b*f*a) once per term and value of a.
+    Each point is truncated on its own, and the group is summed at the 
+    highest precision any point needs. Returns (probabilities, errors).
+    """
+    plans = [_plan(r,l/L,x,0,0,_series_length(L,l,r),0.0,tolerance) for r, x in zip(R,a)]
+    precision = max([_precision(w, tolerance) for n, tail, w in plans] or [MIN_PRECISION])
+    errors = [tail + _rounding_error(w, precision) for n, tail, w in plans]
+    n = [terms for terms, tail, w in plans]
+    with workprec(precision):
+        f = mpf(l)/L
+        a = [mpf(x) for x in a]
+        coefficient = [mpf(1)]*len(R)
+        result = [mpf(0)]*len(R)
+        for b in xrange(max(n) if n else 0):
+            shared = (b-1)*log1p(-b*f)
+            logs = {}
+            for j in xrange(len(R)):
+                if b >= n[j]:
+                    continue
+                if a[j] not in logs:
+                    logs[a[j]] = log1p(-b*f*a[j])
+                result[j] += coefficient[j] * exp(shared + (R[j]-b)*logs[a[j]])
+                coefficient[j] *= -a[j]*(R[j]-b)/(b+1)
+    return [float(x) for x in result], errors
 
 def gap_consensus(L,l,R,a,k):
     """
-    Wrapper function around the C-function with the same name. Casts all 
-    arguments to the correct type, then calls the C function and returns it's 
-    return value. If the C-function isn't available, the value is calculated 
-    using mpmath instead.
+    Returns the probability of exactly k assembly gaps, to within TOLERANCE,
+    from the float64 approximation or the series as full_coverage. See 
+    gap_consensus_tiered and gap_consensus_bounds. Results are cached 
+    persistently.
     
     Arguments are:
     L : approximated length of target genome
@@ -85,6 +448,17 @@ def gap_consensus(L,l,R,a,k):
     a : approximated abundance of target in R
     k : target number of assembly gaps
     """
+    L, l, R, a, k = int(L), int(l), int(R), float(a), int(k)
+    return _cached("gap_consensus", [L,l,R,a,k], 
+                   lambda: float(gap_consensus_tiered(L,l,R,a,k,TOLERANCE)[0]))
+
+def gap_consensus_bounds(L,l,R,a,k,tolerance=TOLERANCE,threads=THREADS):
+    """
+    Wrapper function around the C-function gap_consensus. Casts all 
+    arguments to the correct type, then calls the C function and returns 
+    (p, error, precision), as full_coverage_bounds. If the C-function isn't 
+    available, the value is calculated using mpmath instead.
+    """
     # Cast all variables to the right type
     L = int(L)
     l = int(l)
@@ -94,31 +468,182 @@ def gap_consensus(L,l,R,a,k):
     
     try:
         from metapprox import metapprox
-        return metapprox.gap_consensus(L,l,R,a,k)
+        return _clamp(metapprox.gap_consensus(L,l,R,a,k,tolerance,int(threads)))
     except Exception as e:
         pass
     
+    return _clamp(_gap_consensus(L,l,R,a,k,tolerance))
+
+def _log_gap_coefficient(R,a,k):
+    """
+    Returns log(binomial(R,k)*a^k), the log of the first coefficient of the
+    series for k gaps.
+    """
+    log_c0 = math.lgamma(R+1) - math.lgamma(k+1) - math.lgamma(R-k+1)
+    if k:
+        log_c0 += k*math.log(a) if a > 0 else -float('inf')
+    return log_c0
+
+def _gap_consensus(L,l,R,a,k,tolerance=TOLERANCE):
     # calculate derived variables
-    f = l/L
-    n = min(R, int(1.0/f))
+    n = _series_length(L,l,R)
     
-    # calculate result
-    term1 = binomial(R,k)
+    # truncate the series and choose a precision, then calculate result, 
+    # starting from c_k = binomial(R,k)*a^k
+    terms, tail, log_weight = _plan(R,l/L,a,k,k,n,_log_gap_coefficient(R,a,k),tolerance)
+    precision = _precision(log_weight, tolerance)
+    with workprec(precision):
+        a = mpf(a)
+        p = _stevens_sum(R,mpf(l)/L,a,k,k,terms,binomial(R,k)*a**k)
     
-    term2 = 0.0
-    steps = n-k
-    for b in range(k, n):
-        
-        first  = binomial(R-k,b-k)
-        second = (-1)**(b-k)
-        third  = a**b
-        fourth = (1-b*f)**(b-1)
-        fifth  = (1-b*f*a)**(R-b) 
-        
-        term2 += first * second * third * fourth * fifth
-    result = term1*term2
+    # binomial and a**k add a few roundings to the coefficient
+    error = tail + _rounding_error(log_weight + math.log(1.5), precision)
+    return float(p), error, precision
+
+def gap_distribution(L,l,R,a,K,tolerance=TOLERANCE,threads=THREADS):
+    """
+    Returns (p, errors), arrays of the probabilities of k = 0..K assembly 
+    gaps and their error bounds, from a single pass over the series: every
+    term is computed once, and used for all k.
+    """
+    p, errors = coverage_curve(L,l,[R],a,K,tolerance,threads)
+    return p[0], errors[0]
+
+def coverage_curve(L,l,R,a,K=0,tolerance=TOLERANCE,threads=THREADS):
+    """
+    Returns (p, errors), arrays of shape (len(R), K+1) with the probabilities
+    of k = 0..K gaps for each number of reads in R (so that column 0 is the 
+    probability of full coverage), and their error bounds. The parts of the 
+    terms which don't depend on R are computed once for the whole curve, and
+    the C function releases the GIL while calculating.
+    """
+    R = numpy.asarray(R, numpy.int64).ravel()
+    args = [[int(L)]*len(R), [int(l)]*len(R), R.tolist(), [float(a)]*len(R), int(K), tolerance]
+    try:
+        from metapprox import metapprox
+        p, errors = metapprox.gap_distribution_grid(*args + [int(threads)])
+    except Exception as e:
+        p, errors = _gap_distributions(*args)
     
-    return result
+    p = numpy.clip(p, 0.0, 1.0)
+    return (numpy.reshape(p, (len(R), int(K)+1)), 
+            numpy.reshape(errors, (len(R), int(K)+1)))
+
+def _gap_distributions(L,l,R,a,K,tolerance=TOLERANCE):
+    results, errors = [], []
+    for point in zip(L,l,R,a):
+        p, error = _gap_distribution(*point + (K,tolerance))
+        results += p
+        errors += error
+    return results, errors
+
+def _gap_distribution(L,l,R,a,K,tolerance=TOLERANCE):
+    """
+    Calculates the probabilities of 0..K gaps in one pass over the full 
+    coverage series, adding (-1)^k*binomial(b,k) times each term to the 
+    probability of k gaps. Each probability is truncated as _gap_consensus 
+    would, and all are summed at the highest precision any of them needs.
+    Returns (probabilities, errors).
+    """
+    n = _series_length(L,l,R)
+    plans = [_plan(R,l/L,a,k,k,n,_log_gap_coefficient(R,a,k),tolerance) for k in xrange(K+1)]
+    # the terms for k gaps take 3*k more coefficient updates, and 2*k 
+    # binomial roundings, than _gap_consensus'
+    weights = [w + math.log(1 + 5*k/16.0) for k, (terms, tail, w) in enumerate(plans)]
+    precision = max(_precision(w, tolerance) for w in weights)
+    terms = [t for t, tail, w in plans]
+    with workprec(precision):
+        f = mpf(l)/L
+        a = mpf(a)
+        coefficient = mpf(1)
+        result = [mpf(0)]*(K+1)
+        for b in xrange(max(terms)):
+            term = coefficient * exp((b-1)*log1p(-b*f) + (R-b)*log1p(-b*f*a))
+            for k in xrange(min(b, K)+1):
+                if k:
+                    term *= -mpf(b-k+1)/k
+                if b < terms[k]:
+                    result[k] += term
+            coefficient *= -a*(R-b)/(b+1)
+    return ([float(x) for x in result], 
+            [plan[1] + _rounding_error(w, precision) for plan, w in zip(plans, weights)])
+
+def _poisson_approximation(L,l,R,a,k=0):
+    """
+    Approximates the probability of k gaps (k = 0 for full coverage) with 
+    float64 arrays. The terms of the series are the binomial moments S_b of 
+    the number of gaps G, so that log E[z^G] = sum c_j*(z-1)^j, with the 
+    factorial cumulants
+      
+      c_1 = S_1 = R*a*(1-f*a)^(R-1)  (the Lander-Waterman expected gaps)
+      c_2 = S_2 - S_1^2/2
+      c_3 = S_3 - S_1*S_2 + S_1^3/3
+    
+    which are small beyond c_1 when the gaps are close to independent. The 
+    probabilities are the coefficients of exp(c_1*(z-1) + c_2*(z-1)^2), a 
+    Poisson distribution with a second order correction, and the error is 
+    estimated from the change the c_3 term would make, plus rounding. 
+    Returns (p, error), with an infinite error where the approximation 
+    doesn't apply.
+    """
+    L, l, R, a = [numpy.asarray(x, float) for x in numpy.broadcast_arrays(L, l, R, a)]
+    with numpy.errstate(all='ignore'):
+        f = l/L
+        log_fa = numpy.log1p(-f*a)
+        s1 = R*a*numpy.exp((R-1)*log_fa)
+        # log(S_2/(S_1^2/2)) and log(S_3/(S_1^3/6)), which are close to 0
+        r2 = numpy.log1p(-1/R) + numpy.log1p(-2*f) + (R-2)*numpy.log1p(-2*f*a) - (2*R-2)*log_fa
+        r3 = (numpy.log1p(-1/R) + numpy.log1p(-2/R) + 2*numpy.log1p(-3*f) + 
+              (R-3)*numpy.log1p(-3*f*a) - (3*R-3)*log_fa)
+        c2 = s1**2/2*numpy.expm1(r2)
+        c3 = s1**3/6*(numpy.expm1(r3) - 3*numpy.expm1(r2))
+        
+        # coefficients g_j of exp(c_2-c_1) * exp((c_1-2*c_2)*z + c_2*z^2)
+        g = [numpy.zeros_like(s1)]*3 + [numpy.exp(c2-s1)]
+        for j in xrange(1, k+1):
+            g += [((s1-2*c2)*g[-1] + 2*c2*g[-2])/j]
+        p = numpy.array(g[-1], float)
+        change = abs(g[-1]) + 3*abs(g[-2]) + 3*abs(g[-3]) + abs(g[-4])
+        scale = numpy.max([abs(x) for x in g], axis=0)
+        error = (2*numpy.expm1(abs(c3))*change + 
+                 16*(k+1)*numpy.finfo(float).eps*scale*(1 + s1*(1+R*f*a) + s1**2*R*f*a))
+    valid = numpy.isfinite(p) & numpy.isfinite(error) & (3*f < 1) & (R >= 3)
+    return p, numpy.where(valid, error, numpy.inf)
+
+def full_coverage_tiered(L,l,R,a,tolerance=TOLERANCE,threads=THREADS):
+    """
+    Calculates full_coverage for arrays of parameters, which are broadcast 
+    against each other, in two tiers: the float64 approximation of 
+    _poisson_approximation, and for the points where its error estimate 
+    exceeds tolerance, the series (as full_coverage_grid). Returns arrays 
+    (p, error, tier) of the broadcast shape, where tier is 'poisson' or 
+    'series', and error the estimated or bounded error.
+    """
+    L, l, R, a = numpy.broadcast_arrays(L, l, R, a)
+    L, l, R = [numpy.asarray(x, numpy.int64) for x in [L, l, R]]
+    a = numpy.asarray(a, float)
+    p, error = _poisson_approximation(L, l, R, a)
+    tier = numpy.where(error <= tolerance, 'poisson', 'series')
+    series = tier == 'series'
+    if series.any():
+        p[series], error[series] = full_coverage_grid(L[series], l[series], R[series], a[series],
+                                                      tolerance, True, threads)
+    return numpy.clip(p, 0.0, 1.0, out=p), error, tier
+
+def gap_consensus_tiered(L,l,R,a,k,tolerance=TOLERANCE,threads=THREADS):
+    """
+    Calculates gap_consensus for arrays of parameters, in the same tiers as
+    full_coverage_tiered, and returns (p, error, tier).
+    """
+    L, l, R, a = numpy.broadcast_arrays(L, l, R, a)
+    L, l, R = [numpy.asarray(x, numpy.int64) for x in [L, l, R]]
+    a = numpy.asarray(a, float)
+    p, error = _poisson_approximation(L, l, R, a, int(k))
+    tier = numpy.where(error <= tolerance, 'poisson', 'series')
+    for i in numpy.flatnonzero(tier == 'series'):
+        p.flat[i], error.flat[i] = gap_consensus_bounds(L.flat[i], l.flat[i], R.flat[i], a.flat[i],
+                                                        k, tolerance, threads)[:2]
+    return numpy.clip(p, 0.0, 1.0, out=p), error, tier
 
 if __name__ == '__main__':
     
@@ -133,13 +658,71 @@ if __name__ == '__main__':
     parser.add_argument("-k", help="target number of assembly gaps", default=None)
     parser.add_argument("-m", help="max iterations", default=None, type=int)
     parser.add_argument("-p", help="min probability", default=0.1, type=float)
+    parser.add_argument("-t", "--tolerance", help="bound on the absolute error of probabilities",
+                        default=TOLERANCE, type=float)
+    parser.add_argument("-j", "--threads", help="threads summing the series (0 for one per processor)",
+                        default=THREADS, type=int)
+    parser.add_argument("--tiered", help=("use the float64 approximation where its estimated error is "
+                                          "below the tolerance, and report which tier answered"),
+                        action="store_true", default=False)
+    parser.add_argument("--distribution", help=("write the probabilities of 0..k gaps (-k, default 0) "
+                                                "as CSV, for one or more comma separated -R values"),
+                        action="store_true", default=False)
+    parser.add_argument("--no-cache", help="don't use the persistent result cache",
+                        action="store_true", default=False)
+    parser.add_argument("--solve", help=("find the minimum number of reads (and runs of R reads) reaching "
+                                         "probability -p of full coverage, or of at most -k gaps"),
+                        action="store_true", default=False)
+    parser.add_argument("--check", help="compare the mpmath recurrences with direct summation",
+                        action="store_true", default=False)
     
     args = parser.parse_args()
+    USE_CACHE = not args.no_cache
+    TOLERANCE = args.tolerance
     
-    if args.k:
-        print gap_consensus(bp_to_int(args.L), args.l, bp_to_int(args.R), args.a, bp_to_int(args.k))
+    if args.check:
+        print "L\tl\tR\ta\tk\tfunction\tdirect\trecurrence\tdifference\terror bound\tprecision"
+        for row in check():
+            print "%i\t%i\t%i\t%g\t%i\t%s\t%.12g\t%.12g\t%.3g\t%.3g\t%i" % row
+    elif args.solve:
+        L, R = bp_to_int(args.L), bp_to_int(args.R)
+        k = bp_to_int(args.k) if args.k else None
+        reads, p = min_reads(L, args.l, args.a, args.p, k)
+        runs, p_runs = min_runs(L, args.l, R, args.a, args.p, k)
+        if reads is None:
+            print "probability %s not reached, p = %g" % (args.p, p)
+        else:
+            print "reads\tprobability\truns\trun probability"
+            print "%i\t%.5f\t%i\t%.5f" % (reads, p, runs, p_runs)
+    elif args.distribution:
+        import csv
+        import sys
+        R = [bp_to_int(x) for x in args.R.split(",")]
+        p, errors = coverage_curve(bp_to_int(args.L), args.l, R, args.a, 
+                                   bp_to_int(args.k) if args.k else 0, args.tolerance, args.threads)
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["reads", "gaps", "probability", "error"])
+        for i, reads in enumerate(R):
+            for k in xrange(p.shape[1]):
+                writer.writerow([reads, k, repr(p[i,k]), "%.3g" % errors[i,k]])
+    elif args.tiered:
+        L, R = bp_to_int(args.L), bp_to_int(args.R)
+        if args.k:
+            p, error, tier = gap_consensus_tiered(L, args.l, R, args.a, bp_to_int(args.k), 
+                                                  args.tolerance, args.threads)
+        else:
+            p, error, tier = full_coverage_tiered(L, args.l, R, args.a, args.tolerance, args.threads)
+        print "%.12g\t(error <= %.3g, %s)" % (p, error, tier)
+    elif args.k:
+        L, l, R, a, k = bp_to_int(args.L), int(args.l), bp_to_int(args.R), float(args.a), bp_to_int(args.k)
+        print "%.12g\t(error <= %.3g, %i bits)" % tuple(_cached(
+            "gap_consensus_bounds", [L,l,R,a,k],
+            lambda: list(gap_consensus_bounds(L,l,R,a,k,TOLERANCE,args.threads))))
     elif args.m:
         print get_runs(bp_to_int(args.L), args.l, bp_to_int(args.R), args.a, args.m, args.p)
     else:
-        print full_coverage(bp_to_int(args.L), args.l, bp_to_int(args.R), args.a)
+        L, l, R, a = bp_to_int(args.L), int(args.l), bp_to_int(args.R), float(args.a)
+        print "%.12g\t(error <= %.3g, %i bits)" % tuple(_cached(
+            "full_coverage_bounds", [L,l,R,a],
+            lambda: list(full_coverage_bounds(L,l,R,a,TOLERANCE,args.threads))))
     
\ No newline at end of file
@@ -1,5 +1,9 @@
 #include "metapprox.h"
+#include <math.h>
+#include <pthread.h>
 #include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
 
 int binomial(mpfr_t retval, unsigned long R, unsigned long k)
 {
@@ -37,7 +41,10 @@ int binomial(mpfr_t retval, unsigned long R, unsigned long k)
     return 0;
 }
 
-int gap_consensus(mpfr_t result, unsigned long L, unsigned int l, unsigned long R_in, double a, unsigned int k_in)
+/* Direct summation of the series, evaluating every term from scratch. These 
+   are slow, but kept as the reference for the recurrences below. */
+
+int gap_consensus_direct(mpfr_t result, unsigned long L, unsigned int l, unsigned long R_in, double a, unsigned int k_in)
 {
     mpfr_t f, n, R, k;
     mpfr_t temp, temp2;
@@ -84,7 +91,6 @@ int gap_consensus(mpfr_t result, unsigned long L, unsigned int l, unsigned long
     
     /* The big sum, this is where it get's tricky */
     
-    mpfr_init2 (result, PRECISION);
     mpfr_set_d(result, 0.0, MPFR_RNDD);
     
     for (b = k_in; b < mpfr_get_ui(n, MPFR_RNDD); b++)
@@ -134,7 +140,7 @@ int gap_consensus(mpfr_t result, unsigned long L, unsigned int l, unsigned long
     return 0;
 }
 
-int full_coverage(mpfr_t result, unsigned long L, unsigned int l, unsigned long R_in, double a)
+int full_coverage_direct(mpfr_t result, unsigned long L, unsigned int l, unsigned long R_in, double a)
 {
     mpfr_t f, n, R;
     mpfr_t temp, temp2;
@@ -170,7 +176,6 @@ int full_coverage(mpfr_t result, unsigned long L, unsigned int l, unsigned long
     /* Now we have all the variables. Start Calculating! */
     /* The big sum, slightly simpler than the gap consensus one */
     
-    mpfr_init2 (result, PRECISION);
     mpfr_set_d(result, 0.0, MPFR_RNDD);
     
     for (b = 0; b < mpfr_get_ui(n, MPFR_RNDD); b++)
@@ -210,33 +215,567 @@ int full_coverage(mpfr_t result, unsigned long L, unsigned int l, unsigned long
     return 0;
 }
 
-int main(void)
-{
-    mpfr_t result;
-    unsigned long L, R;
-    unsigned int l, k;
-    double a;
-    
-    L = 10000000; // 10Mb target species
-    l = 250;      // 250bp reads
-    R = 45000000; // 10M reads
-    a = 0.001;     // 0.1% reads from target species
-    k = 10;       // target number of gaps in the sequence
-    
-    // printf("Running test with:\n");
-    // printf("  L = %lu\n", L);
-    // printf("  l = %i\n", l);
-    // printf("  R = %lu\n", R);
-    // printf("  a = %3.2f\n", a);
-    // printf("  k = %i\n", k);
-    
-    
-    mpfr_init2 (result, PRECISION);
-    // gap_consensus(result, L, l, R, a, k);
-    // printf("Gap Consensus, k = %i\n", k);
-    // mpfr_printf("Got: %Rf\n\n", result);
-    full_coverage(result, L, l, R, a);
-	printf("%i, ", PRECISION);
-    mpfr_printf("%Rf\n", result);
-    mpfr_clear (result);
-}
\ No newline at end of file
+static unsigned long series_length(unsigned long L, unsigned int l, unsigned long R)
+{
+    /* Returns the steven's series delimiter, min(R, round(1/f)), where 
+       f = l/L is the probability of a position being covered by a read.
+    */
+    unsigned long n = (2*L + l) / (2*(unsigned long)l);
+    
+    return n < R ? n : R;
+}
+
+static double log1p_condition(double y)
+{
+    /* Returns the condition number of log(1-y), for 0 <= y < 1. */
+    return y > 0.0 ? y / ((1.0 - y) * fabs(log1p(-y))) : 1.0;
+}
+
+static void plan_series(series_plan *plan, double f, double a, unsigned long R, 
+                        unsigned long k, unsigned long first, unsigned long n,
+                        double log_c0, double tolerance)
+{
+    /* Plans the evaluation of the series summed by stevens_sum, from the
+       magnitudes of its terms, computed in double precision and log-space.
+       
+       Truncation: for b' >= b, the ratio of consecutive terms is bounded by 
+       
+         |T_(b'+1)/T_b'| <= Q_b = a*(R-b)/(b+1-k) * (1-f*a)^(R-n)
+       
+       (as (1-(b+1)*f)^b/(1-b*f)^(b-1) <= 1-b*f <= 1-b*f*a, and the ratio of
+       the (1-b*f*a) powers is at most (1-f*a)^(R-b-1)/(1-b*f*a)), so once 
+       Q_b < 1 the remaining terms sum to at most |T_b|*Q_b/(1-Q_b). The 
+       series is truncated when this is below tolerance/4.
+       
+       Precision: with u = 2^(1-p), each term is computed with a relative
+       error of at most (3*i + (c+4)*|x| + 16)*u, to first order, where i is
+       the number of coefficient updates, x the exponent, and c the condition
+       number of the log1p calls, and the summation adds at most N*u times 
+       the sum of |T_b|. The weight W is the sum of |T_b| times these factors,
+       and the precision is chosen so that W*u <= tolerance/2. This is where 
+       cancellation is accounted for: the terms may be far larger than the 
+       sum.
+    */
+    double log_a = log(a), log_e = (double)(R - n) * log1p(-f*a);
+    double log_c = log_c0, log_t, log_q, x, c, q, bound;
+    double max_log = -HUGE_VAL, sum = 0.0, weights = 0.0;
+    unsigned long b;
+    
+    plan->terms = n;
+    plan->tail = 0.0;
+    for (b = first; b < n; b++)
+    {
+        x = (double)((long)b - 1) * log1p(-(double)b*f) + (double)(R - b) * log1p(-(double)b*f*a);
+        c = fmax(log1p_condition((double)b*f), log1p_condition((double)b*f*a));
+        log_t = log_c + x;
+        
+        /* running sums of |T_b| and |T_b|*factor, scaled by exp(-max_log) */
+        if (log_t > max_log)
+        {
+            sum *= exp(max_log - log_t);
+            weights *= exp(max_log - log_t);
+            max_log = log_t;
+        }
+        if (log_t > -HUGE_VAL)
+        {
+            sum += exp(log_t - max_log);
+            weights += exp(log_t - max_log) * (3.0*(b - first) + (c + 4.0)*fabs(x) + 16.0);
+        }
+        
+        if (b + 1 >= n)
+            break;
+        log_q = log_a + log((double)(R - b)) - log((double)(b + 1 - k));
+        if (log_q + log_e < 0.0)
+        {
+            q = exp(log_q + log_e);
+            bound = log_t + log_q + log_e - log1p(-q);
+            if (bound < log(tolerance / 4.0))
+            {
+                plan->terms = b + 1;
+                plan->tail = exp(bound);
+                break;
+            }
+        }
+        log_c += log_q;
+    }
+    plan->log_weight = max_log + log(weights + (double)(plan->terms - first) * sum);
+}
+
+static mpfr_prec_t plan_precision(double log_weight, double tolerance)
+{
+    /* Returns the precision p for which exp(log_weight)*2^(1-p) is below
+       tolerance/2, with a few guard bits. */
+    double bits = (log_weight - log(tolerance / 2.0)) / log(2.0) + 1.0 + GUARD_BITS;
+    
+    if (!(bits > MIN_PRECISION))
+        return MIN_PRECISION;
+    return bits < MAX_PRECISION ? (mpfr_prec_t)ceil(bits) : MAX_PRECISION;
+}
+
+static double rounding_error(double log_weight, mpfr_prec_t precision)
+{
+    return exp(log_weight + (1.0 - (double)precision) * log(2.0));
+}
+
+static void seed_coefficient(mpfr_t coefficient, mpfr_t c_first, double a, 
+                             unsigned long R, unsigned long k, unsigned long b)
+{
+    /* Sets coefficient to c_b = c_k * bin(R-k, b-k) * (-a)^(b-k), the value 
+       the recurrence in stevens_sums reaches from c_k, so that a block of the
+       series can be summed without the terms before it. The binomial and the
+       power are evaluated as 
+       
+         exp(lngamma(R-k+1) - lngamma(b-k+1) - lngamma(R-b+1) + (b-k)*log(a))
+       
+       with extra bits for the magnitude of the lngamma terms, so that the 
+       seed is within a few roundings of c_b, far fewer than the 3*(b-k) the
+       recurrence would have made, which plan_series accounts for.
+    */
+    mpfr_prec_t precision = mpfr_get_prec(coefficient);
+    mpfr_t log_c, temp;
+    
+    if (b == k || a == 0.0)
+    {
+        mpfr_set (coefficient, c_first, MPFR_RNDD);
+        if (b != k)
+            mpfr_set_ui (coefficient, 0, MPFR_RNDD);
+        return;
+    }
+    
+    precision += (mpfr_prec_t)ceil(log2((double)R * log((double)R + 2.0) + 2.0)) + 16;
+    mpfr_init2 (log_c, precision);
+    mpfr_init2 (temp,  precision);
+    
+    mpfr_set_ui   (temp, R - k + 1, MPFR_RNDD);
+    mpfr_lngamma  (log_c, temp, MPFR_RNDD);
+    mpfr_set_ui   (temp, b - k + 1, MPFR_RNDD);
+    mpfr_lngamma  (temp, temp, MPFR_RNDD);
+    mpfr_sub      (log_c, log_c, temp, MPFR_RNDD);
+    mpfr_set_ui   (temp, R - b + 1, MPFR_RNDD);
+    mpfr_lngamma  (temp, temp, MPFR_RNDD);
+    mpfr_sub      (log_c, log_c, temp, MPFR_RNDD);
+    mpfr_set_d    (temp, a, MPFR_RNDD);
+    mpfr_log      (temp, temp, MPFR_RNDD);
+    mpfr_mul_ui   (temp, temp, b - k, MPFR_RNDD);
+    mpfr_add      (log_c, log_c, temp, MPFR_RNDD);
+    mpfr_exp      (log_c, log_c, MPFR_RNDD);
+    
+    mpfr_mul (coefficient, c_first, log_c, MPFR_RNDD);
+    if ((b - k) % 2)
+        mpfr_neg (coefficient, coefficient, MPFR_RNDD);
+    
+    mpfr_clear (log_c);
+    mpfr_clear (temp);
+}
+
+/* A share of the blocks of stevens_sums, for one thread */
+typedef struct {
+    mpfr_t              *partials;
+    mpfr_t              *c_first;
+    mpfr_t              *f;
+    const unsigned long *R;
+    const double        *a;
+    const unsigned long *terms;
+    const unsigned long *slot_terms;
+    unsigned long        count;
+    unsigned long        outputs;
+    unsigned long        k;
+    unsigned long        n;
+    unsigned long        blocks;
+    unsigned long        thread;
+    unsigned long        threads;
+} sum_task;
+
+static void *sum_blocks(void *arg)
+{
+    /* Sums the blocks thread, thread + threads, ... of the series, into 
+       partial sums per block, point and output. Each block starts from 
+       coefficients seeded with seed_coefficient, and then follows the 
+       recurrence 
+         
+         c_(b+1) = -c_b * a * (R-b)/(b+1-k)
+       
+       The powers are evaluated in log-space, as exp((b-1)*log1p(-b*f) + 
+       (R-b)*log1p(-b*f*a)), which costs the same for every term, instead of
+       growing with the exponents. (b-1)*log1p(-b*f) is shared by all points,
+       and log1p(-b*f*a) by each run of points with the same a. Output m of a
+       point gets (-1)^m * bin(b,m) times each term, for the b < slot_terms 
+       of the output. All temporaries are allocated once, at the precision of
+       the partial sums.
+    */
+    sum_task *task = (sum_task *)arg;
+    mpfr_prec_t precision = mpfr_get_prec(task->partials[0]);
+    mpfr_t fa, shared, power, temp;
+    mpfr_t *coefficient, *partial;
+    unsigned long block, start, end, b, j, m;
+    
+    coefficient = malloc(task->count * sizeof(mpfr_t));
+    mpfr_init2 (fa,     precision);
+    mpfr_init2 (shared, precision);
+    mpfr_init2 (power,  precision);
+    mpfr_init2 (temp,   precision);
+    for (j = 0; j < task->count; j++)
+        mpfr_init2 (coefficient[j], precision);
+    
+    for (block = task->thread; block < task->blocks; block += task->threads)
+    {
+        start = task->k + block * BLOCK_TERMS;
+        end = start + BLOCK_TERMS < task->n ? start + BLOCK_TERMS : task->n;
+        for (j = 0; j < task->count; j++)
+            if (start < task->terms[j])
+                seed_coefficient(coefficient[j], task->c_first[j], task->a[j], 
+                                 task->R[j], task->k, start);
+        
+        for (b = start; b < end; b++)
+        {
+            /* (b-1)*log(1-b*f) */
+            mpfr_mul_ui (shared, *task->f, b, MPFR_RNDD);
+            mpfr_neg    (shared, shared, MPFR_RNDD);
+            mpfr_log1p  (shared, shared, MPFR_RNDD);
+            mpfr_mul_si (shared, shared, (long)b - 1, MPFR_RNDD);
+            
+            for (j = 0; j < task->count; j++)
+            {
+                if (b >= task->terms[j])
+                    continue;
+                
+                /* log(1-b*f*a) */
+                if (j == 0 || task->a[j] != task->a[j-1] || b >= task->terms[j-1])
+                {
+                    mpfr_mul_d  (fa, *task->f, task->a[j], MPFR_RNDD);
+                    mpfr_mul_ui (fa, fa, b, MPFR_RNDD);
+                    mpfr_neg    (fa, fa, MPFR_RNDD);
+                    mpfr_log1p  (fa, fa, MPFR_RNDD);
+                }
+                
+                /* c_b * exp((b-1)*log(1-b*f) + (R-b)*log(1-b*f*a)) */
+                mpfr_mul_ui (temp, fa, task->R[j] - b, MPFR_RNDD);
+                mpfr_add (power, shared, temp, MPFR_RNDD);
+                mpfr_exp (power, power, MPFR_RNDD);
+                mpfr_mul (power, coefficient[j], power, MPFR_RNDD);
+                
+                /* (-1)^m * bin(b,m) * term, for each output m */
+                partial = task->partials + (block * task->count + j) * task->outputs;
+                for (m = 0; m < task->outputs && m <= b; m++)
+                {
+                    if (m)
+                    {
+                        mpfr_mul_ui (power, power, b - m + 1, MPFR_RNDD);
+                        mpfr_div_ui (power, power, m, MPFR_RNDD);
+                        mpfr_neg    (power, power, MPFR_RNDD);
+                    }
+                    if (b < task->slot_terms[j * task->outputs + m])
+                        mpfr_add (partial[m], partial[m], power, MPFR_RNDD);
+                }
+                
+                /* c_(b+1) = -c_b * a * (R-b)/(b+1-k) */
+                mpfr_mul_d  (coefficient[j], coefficient[j], -task->a[j], MPFR_RNDD);
+                mpfr_mul_ui (coefficient[j], coefficient[j], task->R[j] - b, MPFR_RNDD);
+                mpfr_div_ui (coefficient[j], coefficient[j], b + 1 - task->k, MPFR_RNDD);
+            }
+        }
+    }
+    
+    for (j = 0; j < task->count; j++)
+        mpfr_clear (coefficient[j]);
+    mpfr_clear (fa);
+    mpfr_clear (shared);
+    mpfr_clear (power);
+    mpfr_clear (temp);
+    free (coefficient);
+    /* MPFR keeps per-thread caches of constants */
+    if (task->thread)
+        mpfr_free_cache ();
+    return NULL;
+}
+
+static unsigned long thread_count(unsigned long threads, unsigned long blocks)
+{
+    /* Returns the number of threads to use for blocks blocks, where 0 
+       threads means one per online processor. */
+    long processors = sysconf(_SC_NPROCESSORS_ONLN);
+    
+    if (threads == 0)
+        threads = processors > 0 ? (unsigned long)processors : 1;
+    return threads < blocks ? threads : (blocks ? blocks : 1);
+}
+
+static void stevens_sums(mpfr_t *result, mpfr_t *c_first, mpfr_t f, const unsigned long *R,
+                         const double *a, const unsigned long *slot_terms, unsigned long count, 
+                         unsigned long outputs, unsigned long k, unsigned long threads)
+{
+    /* Sets result[j*outputs + m] to the sum of the terms k <= b < 
+       slot_terms[j*outputs + m] of the series
+         
+         (-1)^m * bin(b,m) * c_b * (1-b*f)^(b-1) * (1-b*f*a[j])^(R[j]-b)
+       
+       for count points sharing f and k, where c_first[j] holds c_k. c_b is
+       bin(R,b)*(-a)^b for k = 0, and bin(R,k)*bin(R-k,b-k)*(-1)^(b-k)*a^b when
+       starting from c_k = bin(R,k)*a^k. With outputs = 1 this is the series 
+       itself; with k = 0 output m is the probability of m gaps, as the terms 
+       are (-1)^b times the binomial moments of the number of gaps. 
+       
+       The range of b is split into blocks of BLOCK_TERMS terms, which are 
+       summed by threads threads (0 for one per online processor). The 
+       partial sums are added in block order, so the result doesn't depend on
+       the number of threads. The sums are computed at the precision of 
+       result[0].
+    */
+    mpfr_prec_t precision = mpfr_get_prec(result[0]);
+    mpfr_t *partials;
+    sum_task *tasks;
+    pthread_t *workers;
+    int *started;
+    unsigned long *terms;
+    unsigned long n = k, blocks, block, t, j, m;
+    
+    /* the terms needed by any output of each point */
+    terms = malloc(count * sizeof(unsigned long));
+    for (j = 0; j < count; j++)
+    {
+        terms[j] = 0;
+        for (m = 0; m < outputs; m++)
+            if (slot_terms[j * outputs + m] > terms[j])
+                terms[j] = slot_terms[j * outputs + m];
+        n = terms[j] > n ? terms[j] : n;
+    }
+    blocks = (n - k + BLOCK_TERMS - 1) / BLOCK_TERMS;
+    threads = thread_count(threads, blocks);
+    
+    partials = malloc((blocks * count * outputs + 1) * sizeof(mpfr_t));
+    tasks    = malloc(threads * sizeof(sum_task));
+    workers  = malloc(threads * sizeof(pthread_t));
+    started  = malloc(threads * sizeof(int));
+    for (j = 0; j < blocks * count * outputs; j++)
+    {
+        mpfr_init2 (partials[j], precision);
+        mpfr_set_d (partials[j], 0.0, MPFR_RNDD);
+    }
+    
+    for (t = 0; t < threads; t++)
+    {
+        sum_task task = {partials, c_first, (mpfr_t *)f, R, a, terms, slot_terms, count, 
+                         outputs, k, n, blocks, t, threads};
+        tasks[t] = task;
+        started[t] = 0;
+    }
+    /* the calling thread takes the first share, and any share a thread 
+       couldn't be started for */
+    for (t = 1; t < threads; t++)
+        started[t] = pthread_create(&workers[t], NULL, sum_blocks, &tasks[t]) == 0;
+    if (blocks)
+        sum_blocks(&tasks[0]);
+    for (t = 1; t < threads; t++)
+    {
+        if (started[t])
+            pthread_join(workers[t], NULL);
+        else
+            sum_blocks(&tasks[t]);
+    }
+    
+    for (j = 0; j < count * outputs; j++)
+    {
+        mpfr_set_prec (result[j], precision);
+        mpfr_set_d (result[j], 0.0, MPFR_RNDD);
+        for (block = 0; block < blocks; block++)
+            mpfr_add (result[j], result[j], partials[block * count * outputs + j], MPFR_RNDD);
+    }
+    
+    for (j = 0; j < blocks * count * outputs; j++)
+        mpfr_clear (partials[j]);
+    free (partials);
+    free (tasks);
+    free (workers);
+    free (started);
+    free (terms);
+}
+
+static double log_gap_coefficient(unsigned long R, double a, unsigned long k)
+{
+    /* Returns log(bin(R,k)*a^k), the log of the first coefficient of the 
+       series for k gaps. */
+    double log_c0 = k ? (double)k * log(a) : 0.0;
+    unsigned long i;
+    
+    for (i = 1; i <= k; i++)
+        log_c0 += log((double)(R - k + i) / (double)i);
+    return log_c0;
+}
+
+long gap_consensus(mpfr_t result, double *error, unsigned long L, unsigned int l, 
+                   unsigned long R_in, double a, unsigned int k_in, double tolerance,
+                   unsigned long threads)
+{
+    series_plan plan;
+    mpfr_prec_t precision;
+    mpfr_t f, coefficient;
+    unsigned long i;
+    
+    /* Plan the sum, starting from c_k = bin(R,k)*a^k */
+    plan_series(&plan, (double)l/(double)L, a, R_in, k_in, k_in, series_length(L, l, R_in), 
+                log_gap_coefficient(R_in, a, k_in), tolerance);
+    precision = plan_precision(plan.log_weight, tolerance);
+    
+    /* "f" is the probability of a position being covered */
+    mpfr_init2 (f, precision);
+    mpfr_set_ui (f, l, MPFR_RNDD);
+    mpfr_div_ui (f, f, L, MPFR_RNDD);
+    
+    /* c_k = bin(R, k)*a^k, bin(R, k) as the product of (R-k+i)/i for i = 1..k */
+    mpfr_init2 (coefficient, precision);
+    mpfr_set_d (coefficient, a, MPFR_RNDD);
+    mpfr_pow_ui (coefficient, coefficient, k_in, MPFR_RNDD);
+    for (i = 1; i <= k_in; i++)
+    {
+        mpfr_mul_ui (coefficient, coefficient, R_in - k_in + i, MPFR_RNDD);
+        mpfr_div_ui (coefficient, coefficient, i, MPFR_RNDD);
+    }
+    
+    /* The big sum */
+    mpfr_set_prec (result, precision);
+    stevens_sums((mpfr_t *)result, &coefficient, f, &R_in, &a, &plan.terms, 1, 1, k_in, threads);
+    
+    mpfr_clear (f);
+    mpfr_clear (coefficient);
+    
+    /* the pow_ui and bin(R,k) products add 2k+2 roundings to the coefficient */
+    *error = plan.tail + rounding_error(plan.log_weight + log(1.0 + (2.0*k_in + 2.0)/16.0), 
+                                        precision);
+    return precision;
+}
+
+long full_coverage(mpfr_t result, double *error, unsigned long L, unsigned int l, 
+                   unsigned long R_in, double a, double tolerance, unsigned long threads)
+{
+    series_plan plan;
+    mpfr_prec_t precision;
+    mpfr_t f, coefficient;
+    
+    /* Plan the sum, starting from c_0 = bin(R,0)*(-a)^0 = 1 */
+    plan_series(&plan, (double)l/(double)L, a, R_in, 0, 0, series_length(L, l, R_in), 
+                0.0, tolerance);
+    precision = plan_precision(plan.log_weight, tolerance);
+    
+    /* "f" is the probability of a position being covered */
+    mpfr_init2 (f, precision);
+    mpfr_set_ui (f, l, MPFR_RNDD);
+    mpfr_div_ui (f, f, L, MPFR_RNDD);
+    
+    mpfr_init2 (coefficient, precision);
+    mpfr_set_ui (coefficient, 1, MPFR_RNDD);
+    
+    /* The big sum */
+    mpfr_set_prec (result, precision);
+    stevens_sums((mpfr_t *)result, &coefficient, f, &R_in, &a, &plan.terms, 1, 1, 0, threads);
+    
+    mpfr_clear (f);
+    mpfr_clear (coefficient);
+    
+    *error = plan.tail + rounding_error(plan.log_weight, precision);
+    return precision;
+}
+
+static void coverage_group(double *probabilities, double *errors, unsigned long L, 
+                           unsigned int l, const unsigned long *R, const double *a,
+                           unsigned long count, unsigned int K, double tolerance, 
+                           unsigned long threads)
+{
+    /* Evaluates the probabilities of 0..K gaps for count points sharing L 
+       and l, writing K+1 values per point. The terms are summed for all 
+       points at once, so that (b-1)*log(1-b*f), which only depends on 
+       f = l/L, is computed once per term for the whole group, and 
+       log(1-b*f*a) once per term for each run of points with the same a, and
+       each term is used for all numbers of gaps. Each probability is 
+       truncated as gap_consensus would, and the group is evaluated at the 
+       highest precision needed by any of them.
+    */
+    series_plan *plans;
+    mpfr_prec_t precision = MIN_PRECISION, p;
+    mpfr_t f;
+    mpfr_t *coefficient, *sum;
+    unsigned long *terms, j, m, outputs = K + 1;
+    
+    coefficient = malloc(count * sizeof(mpfr_t));
+    sum         = malloc(count * outputs * sizeof(mpfr_t));
+    plans       = malloc(count * outputs * sizeof(series_plan));
+    terms       = malloc(count * outputs * sizeof(unsigned long));
+    
+    for (j = 0; j < count * outputs; j++)
+    {
+        m = j % outputs;
+        plan_series(&plans[j], (double)l/(double)L, a[j / outputs], R[j / outputs], m, m,
+                    series_length(L, l, R[j / outputs]), 
+                    log_gap_coefficient(R[j / outputs], a[j / outputs], m), tolerance);
+        /* the terms for m gaps take 3*m more coefficient updates, and 2*m
+           binomial roundings, than gap_consensus' */
+        plans[j].log_weight += log(1.0 + 5.0*m/16.0);
+        p = plan_precision(plans[j].log_weight, tolerance);
+        precision = p > precision ? p : precision;
+        terms[j] = plans[j].terms;
+    }
+    
+    mpfr_init2 (f, precision);
+    mpfr_set_ui (f, l, MPFR_RNDD);
+    mpfr_div_ui (f, f, L, MPFR_RNDD);
+    for (j = 0; j < count; j++)
+    {
+        mpfr_init2 (coefficient[j], precision);
+        mpfr_set_ui (coefficient[j], 1, MPFR_RNDD);
+    }
+    for (j = 0; j < count * outputs; j++)
+        mpfr_init2 (sum[j], precision);
+    
+    stevens_sums(sum, coefficient, f, R, a, terms, count, outputs, 0, threads);
+    
+    for (j = 0; j < count * outputs; j++)
+    {
+        probabilities[j] = mpfr_get_d (sum[j], MPFR_RNDN);
+        if (errors)
+            errors[j] = plans[j].tail + rounding_error(plans[j].log_weight, precision);
+        mpfr_clear (sum[j]);
+    }
+    for (j = 0; j < count; j++)
+        mpfr_clear (coefficient[j]);
+    mpfr_clear (f);
+    free (coefficient);
+    free (sum);
+    free (plans);
+    free (terms);
+}
+
+int gap_distribution_batch(double *probabilities, double *errors, const unsigned long *L, 
+                           const unsigned int *l, const unsigned long *R, const double *a, 
+                           unsigned long count, unsigned int K, double tolerance, 
+                           unsigned long threads)
+{
+    /* Evaluates the probabilities of 0..K gaps for count points, writing 
+       K+1 probabilities (and, unless errors is NULL, their error bounds) per
+       point as doubles. Work is shared between consecutive points with the 
+       same L and l, and within those, with the same a, so points should be 
+       sorted by (L, l, a). Each group of points is summed on threads threads.
+    */
+    unsigned long start = 0, end;
+    
+    while (start < count)
+    {
+        end = start + 1;
+        while (end < count && L[end] == L[start] && l[end] == l[start])
+            end++;
+        coverage_group(probabilities + start * (K + 1), errors ? errors + start * (K + 1) : NULL, 
+                       L[start], l[start], R + start, a + start, end - start, K, tolerance, 
+                       threads);
+        start = end;
+    }
+    
+    return 0;
+}
+
+int full_coverage_batch(double *probabilities, double *errors, const unsigned long *L, 
+                        const unsigned int *l, const unsigned long *R, const double *a, 
+                        unsigned long count, double tolerance, unsigned long threads)
+{
+    /* Evaluates full_coverage for count points, as gap_distribution_batch 
+       for 0 gaps. */
+    return gap_distribution_batch(probabilities, errors, L, l, R, a, count, 0, tolerance, 
+                                  threads);
+}
@@ -0,0 +1,60 @@
+#include "metapprox.h"
+#include <stdio.h>
+#include <time.h>
+
+int main(void)
+{
+    /* Compares the adaptive recurrence implementation with the direct 
+       summation for a few parameter sets, small enough for the direct sums to
+       converge at PRECISION bits, and then evaluates a few which don't. 
+       Build with:
+       
+         gcc -pthread -o metapprox_check check.c _metapprox.c -lmpfr -lgmp -lm
+    */
+    unsigned long L[] = {10000, 100000, 20000, 10000, 1000000, 1000000,  1000000};
+    unsigned int  l[] = {100,   150,    100,   50,    250,     100,      100};
+    unsigned long R[] = {1000,  50000,  5000,  2000,  2000000, 500000,   1000000};
+    double        a[] = {0.5,   0.1,    0.2,   0.3,   0.01,    0.05,     0.1};
+    int           cases = 7, reference = 4;
+    unsigned int  k = 2;
+    mpfr_t direct, result, difference;
+    clock_t start;
+    double direct_time, time, error;
+    long precision;
+    int i, j;
+    
+    mpfr_init2 (difference, PRECISION);
+    printf("L\tl\tR\ta\tfunction\tdirect\tadaptive\tdifference\terror bound\tprecision\t"
+           "direct time (s)\tadaptive time (s)\n");
+    for (i = 0; i < cases; i++)
+    {
+        for (j = 0; j < 2; j++)
+        {
+            mpfr_init2 (direct, PRECISION);
+            mpfr_init2 (result, PRECISION);
+            direct_time = 0.0;
+            if (i < reference)
+            {
+                start = clock();
+                if (j == 0) full_coverage_direct(direct, L[i], l[i], R[i], a[i]);
+                else        gap_consensus_direct(direct, L[i], l[i], R[i], a[i], k);
+                direct_time = (double)(clock() - start) / CLOCKS_PER_SEC;
+            }
+            else
+                mpfr_set_nan (direct);
+            start = clock();
+            if (j == 0) precision = full_coverage(result, &error, L[i], l[i], R[i], a[i], TOLERANCE, THREADS);
+            else        precision = gap_consensus(result, &error, L[i], l[i], R[i], a[i], k, TOLERANCE, THREADS);
+            time = (double)(clock() - start) / CLOCKS_PER_SEC;
+            
+            mpfr_sub (difference, result, direct, MPFR_RNDN);
+            mpfr_printf("%lu\t%u\t%lu\t%g\t%s\t%.12Rg\t%.12Rg\t%.3Rg\t%.3g\t%ld\t%.4f\t%.4f\n", 
+                        L[i], l[i], R[i], a[i], j ? "gap_consensus" : "full_coverage",
+                        direct, result, difference, error, precision, direct_time, time);
+            mpfr_clear (direct);
+            mpfr_clear (result);
+        }
+    }
+    mpfr_clear (difference);
+    return 0;
+}
@@ -21,16 +21,27 @@
 static char module_docstring[] =
     "implementation for solving the metagenomic approximation of Stevens' Theorem as explained by Wendl et al. in 'Coverage theories for metagenomic DNA sequencing based on a generalization of Stevens' theorem'";
 static char full_coverage_docstring[] =
-    "Calculates the probability of full coverage of a genome of length L, with an abundance of a in a metagenomic community with R reads of length l.";
+    "Calculates the probability of full coverage of a genome of length L, with an abundance of a in a metagenomic community with R reads of length l. Returns (probability, error bound, precision in bits), where the absolute error is below the optional tolerance argument. The optional threads argument is the number of threads summing the series (0 for one per processor).";
+static char full_coverage_grid_docstring[] =
+    "Calculates full_coverage for sequences of L, l, R and a, of the same length, and optional tolerance and threads arguments, and returns a list of probabilities and a list of error bounds. Points sharing L and l (and within those, a) share work when they are adjacent, so they should be sorted by (L, l, a).";
+static char gap_distribution_grid_docstring[] =
+    "Calculates the probabilities of 0..K gaps for sequences of L, l, R and a, of the same length, with K and optional tolerance and threads arguments, in a single pass over the series of each point. Returns a list of the K+1 probabilities of each point, one point after another, and a list of their error bounds. Points should be sorted by (L, l, a), as for full_coverage_grid.";
 static char gap_consensus_docstring[] =
-    "Calculates the probability of k gaps in a genome of length L, with an abundance of a in a metagenomic community with R reads of length l.";
+    "Calculates the probability of k gaps in a genome of length L, with an abundance of a in a metagenomic community with R reads of length l. Returns (probability, error bound, precision in bits), where the absolute error is below the optional tolerance argument. The optional threads argument is the number of threads summing the series (0 for one per processor).";
 
 static PyObject *metapprox_full_coverage(PyObject *self, PyObject *args);
 static PyObject *metapprox_gap_consensus(PyObject *self, PyObject *args);
+static PyObject *metapprox_full_coverage_grid(PyObject *self, PyObject *args);
+static PyObject *metapprox_gap_distribution_grid(PyObject *self, PyObject *args);
+static PyObject *gap_distributions(PyObject *L_in, PyObject *l_in, PyObject *R_in, 
+                                   PyObject *a_in, unsigned int K, double tolerance, 
+                                   unsigned long threads);
 
 static PyMethodDef module_methods[] = {
     {"full_coverage", metapprox_full_coverage, METH_VARARGS, full_coverage_docstring},
     {"gap_consensus", metapprox_gap_consensus, METH_VARARGS, gap_consensus_docstring},
+    {"full_coverage_grid", metapprox_full_coverage_grid, METH_VARARGS, full_coverage_grid_docstring},
+    {"gap_distribution_grid", metapprox_gap_distribution_grid, METH_VARARGS, gap_distribution_grid_docstring},
     {NULL, NULL, 0, NULL}
 };
 
@@ -48,26 +59,34 @@ static PyObject *metapprox_full_coverage(PyObject *self, PyObject *args)
              unsigned int l : (mean) length of sequenced reads
         unsigned long int R : number of reads in the metagenomic community
                    double a : approximated abundance of target in R
+           double tolerance : (optional) absolute error bound
+      unsigned long threads : (optional) number of threads, 0 for one per 
+                              processor
     */
     unsigned long int L, R;
     unsigned int l;
-    double a;
+    unsigned long threads = THREADS;
+    double a, tolerance = TOLERANCE;
 
     /* Parse the input tuple */
-    if (!PyArg_ParseTuple(args, "kIkd", &L, &l, &R, &a))
+    if (!PyArg_ParseTuple(args, "kIkd|dk", &L, &l, &R, &a, &tolerance, &threads))
         return NULL;
 
     
-    /* Call the external C function to compute the probability. */
+    /* Call the external C function to compute the probability, without 
+       holding the GIL. */
+    double probability, error;
+    long precision;
     mpfr_t result;
-    mpfr_init2(result, PRECISION);
-    full_coverage(result, L, l, R, a);
+    Py_BEGIN_ALLOW_THREADS
+    mpfr_init2(result, MIN_PRECISION);
+    precision = full_coverage(result, &error, L, l, R, a, tolerance, threads);
+    probability = mpfr_get_d(result, MPFR_RNDN);
+    mpfr_clear(result);
+    Py_END_ALLOW_THREADS
     
-    /* This doesn't seem to work right... */
-    double probability = mpfr_get_d(result, MPFR_RNDD);
-    
-    /* Build the output double */
-    PyObject *ret = Py_BuildValue("d", probability);
+    /* Build the output tuple */
+    PyObject *ret = Py_BuildValue("(ddl)", probability, error, precision);
     return ret;
 }
 
@@ -79,25 +98,152 @@ static PyObject *metapprox_gap_consensus(PyObject *self, PyObject *args)
         unsigned long int R : number of reads in the metagenomic community
                    double a : approximated abundance of target in R
              unsigned int k : number of gaps in the assembly
-    
+           double tolerance : (optional) absolute error bound
+      unsigned long threads : (optional) number of threads, 0 for one per 
+                              processor
     */
     unsigned long int L, R;
     unsigned int l, k;
-    double a;
+    unsigned long threads = THREADS;
+    double a, tolerance = TOLERANCE;
     
     /* Parse the input tuple */
-    if (!PyArg_ParseTuple(args, "kIkdI", &L, &l, &R, &a, &k))
+    if (!PyArg_ParseTuple(args, "kIkdI|dk", &L, &l, &R, &a, &k, &tolerance, &threads))
         return NULL;
     
-    /* Call the external C function to compute the probability. */
+    /* Call the external C function to compute the probability, without 
+       holding the GIL. */
+    double probability, error;
+    long precision;
     mpfr_t result;
-    mpfr_init2(result, PRECISION);
-    gap_consensus(result, L, l, R, a, k);
+    Py_BEGIN_ALLOW_THREADS
+    mpfr_init2(result, MIN_PRECISION);
+    precision = gap_consensus(result, &error, L, l, R, a, k, tolerance, threads);
+    probability = mpfr_get_d(result, MPFR_RNDN);
+    mpfr_clear(result);
+    Py_END_ALLOW_THREADS
+    
+    /* Build the output tuple */
+    PyObject *ret = Py_BuildValue("(ddl)", probability, error, precision);
+    return ret;
+}
+
+static PyObject *metapprox_full_coverage_grid(PyObject *self, PyObject *args)
+{
+    /* This function takes four sequences of the same length:
+        L : approximated lengths of target genome (unsigned long)
+        l : (mean) lengths of sequenced reads (unsigned int)
+        R : numbers of reads in the metagenomic community (unsigned long)
+        a : approximated abundances of target in R (double)
+    and an optional absolute error bound, tolerance, and number of threads.
+    */
+    PyObject *L_in, *l_in, *R_in, *a_in;
+    double tolerance = TOLERANCE;
+    unsigned long threads = THREADS;
+    
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(args, "OOOO|dk", &L_in, &l_in, &R_in, &a_in, &tolerance, &threads))
+        return NULL;
+    
+    return gap_distributions(L_in, l_in, R_in, a_in, 0, tolerance, threads);
+}
+
+static PyObject *metapprox_gap_distribution_grid(PyObject *self, PyObject *args)
+{
+    /* This function takes the sequences L, l, R and a of full_coverage_grid,
+       the largest number of gaps K (unsigned int), and an optional absolute 
+       error bound, tolerance, and number of threads.
+    */
+    PyObject *L_in, *l_in, *R_in, *a_in;
+    unsigned int K;
+    double tolerance = TOLERANCE;
+    unsigned long threads = THREADS;
+    
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(args, "OOOOI|dk", &L_in, &l_in, &R_in, &a_in, &K, &tolerance, &threads))
+        return NULL;
+    
+    return gap_distributions(L_in, l_in, R_in, a_in, K, tolerance, threads);
+}
+
+static PyObject *gap_distributions(PyObject *L_in, PyObject *l_in, PyObject *R_in, 
+                                   PyObject *a_in, unsigned int K, double tolerance, 
+                                   unsigned long threads)
+{
+    /* Converts the sequences of points, and calls gap_distribution_batch 
+       without holding the GIL. Returns a list of the K+1 probabilities of 
+       each point, one point after another, and a list of their error bounds.
+    */
+    PyObject *seq[4] = {NULL, NULL, NULL, NULL};
+    PyObject *ret = NULL, *probability_list = NULL, *error_list = NULL;
+    unsigned long *L = NULL, *R = NULL;
+    unsigned int *l = NULL;
+    double *a = NULL, *probabilities = NULL, *errors = NULL;
+    Py_ssize_t count, i;
+    
+    seq[0] = PySequence_Fast(L_in, "L must be a sequence");
+    seq[1] = PySequence_Fast(l_in, "l must be a sequence");
+    seq[2] = PySequence_Fast(R_in, "R must be a sequence");
+    seq[3] = PySequence_Fast(a_in, "a must be a sequence");
+    if (!seq[0] || !seq[1] || !seq[2] || !seq[3])
+        goto done;
+    
+    count = PySequence_Fast_GET_SIZE(seq[0]);
+    for (i = 1; i < 4; i++)
+    {
+        if (PySequence_Fast_GET_SIZE(seq[i]) != count)
+        {
+            PyErr_SetString(PyExc_ValueError, "L, l, R and a must have the same length");
+            goto done;
+        }
+    }
+    
+    L = malloc((count + 1) * sizeof(unsigned long));
+    l = malloc((count + 1) * sizeof(unsigned int));
+    R = malloc((count + 1) * sizeof(unsigned long));
+    a = malloc((count + 1) * sizeof(double));
+    probabilities = malloc((count + 1) * (K + 1) * sizeof(double));
+    errors = malloc((count + 1) * (K + 1) * sizeof(double));
+    if (!L || !l || !R || !a || !probabilities || !errors)
+    {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (i = 0; i < count; i++)
+    {
+        L[i] = PyInt_AsUnsignedLongMask(PySequence_Fast_GET_ITEM(seq[0], i));
+        l[i] = (unsigned int)PyInt_AsUnsignedLongMask(PySequence_Fast_GET_ITEM(seq[1], i));
+        R[i] = PyInt_AsUnsignedLongMask(PySequence_Fast_GET_ITEM(seq[2], i));
+        a[i] = PyFloat_AsDouble(PySequence_Fast_GET_ITEM(seq[3], i));
+    }
+    if (PyErr_Occurred())
+        goto done;
+    
+    /* Calculate all points without holding the GIL */
+    Py_BEGIN_ALLOW_THREADS
+    gap_distribution_batch(probabilities, errors, L, l, R, a, count, K, tolerance, threads);
+    Py_END_ALLOW_THREADS
     
-    /* This doesn't seem to work right... */
-    double probability = mpfr_get_d(result, MPFR_RNDD);
+    probability_list = PyList_New(count * (K + 1));
+    error_list = PyList_New(count * (K + 1));
+    for (i = 0; probability_list && error_list && i < count * (K + 1); i++)
+    {
+        PyList_SET_ITEM(probability_list, i, PyFloat_FromDouble(probabilities[i]));
+        PyList_SET_ITEM(error_list, i, PyFloat_FromDouble(errors[i]));
+    }
+    if (probability_list && error_list)
+        ret = Py_BuildValue("(OO)", probability_list, error_list);
+    Py_XDECREF(probability_list);
+    Py_XDECREF(error_list);
     
-    /* Build the output double */
-    PyObject *ret = Py_BuildValue("d", probability);
+done:
+    for (i = 0; i < 4; i++)
+        Py_XDECREF(seq[i]);
+    free(L);
+    free(l);
+    free(R);
+    free(a);
+    free(probabilities);
+    free(errors);
     return ret;
 }
@@ -1,22 +1,93 @@
 #ifndef __METAPPROX_H__
 #define __METAPPROX_H__
 
+/* Fixed precision of the direct summation */
 #define PRECISION 128
 
+/* Precision bounds, and guard bits, of the adaptive evaluation */
+#define MIN_PRECISION 64
+#define MAX_PRECISION 1048576
+#define GUARD_BITS 8
+
+/* Default absolute error bound of probabilities */
+#define TOLERANCE 1e-12
+
+/* Terms per block of a partitioned sum, and the default number of threads
+   summing the blocks (0 for one per online processor) */
+#define BLOCK_TERMS 4096
+#define THREADS 0
+
 #include <gmp.h>
 #include <mpfr.h>
 
+/* Evaluation plan of a series: number of terms to sum, bound on the 
+   truncated tail, and log of the rounding error weight. */
+typedef struct {
+    unsigned long terms;
+    double        tail;
+    double        log_weight;
+} series_plan;
+
 /******************************************************************************
 * FUNCTION DEFINITIONS                                                        *
+*                                                                             *
+* The result arguments must be initialized (mpfr_init2) by the caller. The    *
+* adaptive functions set the precision of result to what's needed for an      *
+* absolute error below tolerance, store the achieved error bound in error,    *
+* and return the precision used. The terms are summed in blocks, on threads   *
+* threads (0 for one per online processor), with the same result for any      *
+* number of threads.                                                          *
 ******************************************************************************/
 
-int gap_consensus(mpfr_t          result,
+long gap_consensus(mpfr_t         result,
+                   double        *error,
+                   unsigned long  L, 
+                   unsigned int   l, 
+                   unsigned long  R, 
+                   double         a, 
+                   unsigned int   k,
+                   double         tolerance,
+                   unsigned long  threads);
+long full_coverage(mpfr_t         result,
+                   double        *error,
+                   unsigned long  L, 
+                   unsigned int   l, 
+                   unsigned long  R, 
+                   double         a,
+                   double         tolerance,
+                   unsigned long  threads);
+
+int full_coverage_batch(double  *probabilities,
+                  double              *errors,
+                  const unsigned long *L,
+                  const unsigned int  *l,
+                  const unsigned long *R,
+                  const double        *a,
+                  unsigned long  count,
+                  double         tolerance,
+                  unsigned long  threads);
+
+/* Probabilities of 0..K gaps, K+1 per point, from a single pass over the
+   series of each group of points sharing L and l */
+int gap_distribution_batch(double  *probabilities,
+                  double              *errors,
+                  const unsigned long *L,
+                  const unsigned int  *l,
+                  const unsigned long *R,
+                  const double        *a,
+                  unsigned long  count,
+                  unsigned int   K,
+                  double         tolerance,
+                  unsigned long  threads);
+
+/* Reference implementations, using direct summation */
+int gap_consensus_direct(mpfr_t   result,
                   unsigned long   L, 
                   unsigned int    l, 
                   unsigned long   R, 
                            double a, 
                   unsigned int    k);
-int full_coverage(mpfr_t          result,
+int full_coverage_direct(mpfr_t   result,
                   unsigned long   L, 
                   unsigned int    l, 
                   unsigned long   R, 
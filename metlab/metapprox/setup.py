@@ -22,6 +22,8 @@ The implementation uses the MPFR library for numerical precision.
                                                 ('MINOR_VERSION', '1')],
                              include_dirs    = ['/usr/local/include', '../../local_apps/gcc/include'],
                              libraries       = ['mpfr', 'gmp'],
+                             extra_compile_args = ['-pthread'],
+                             extra_link_args    = ['-pthread'],
                              library_dirs    = ['/usr/local/lib', '../../local_apps/gcc/lib'],
                              sources         = ["_metapprox.c", "metapprox.c"])
                    ],
@@ -11,6 +11,7 @@ import numpy
 import socket
 import logging
 import sqlite3
+import Queue
 import subprocess
 import multiprocessing
 import tkFileDialog
@@ -37,6 +38,19 @@ def bp_to_int(value, suffix="KMGTP"):
     except:
         return -1
 
+def design_runs(generation, name, L, l, R, a, max_runs, limit):
+    """
+    Experimental design worker. Returns (generation, name, (runs, p), error),
+    where (runs, p) is the result of metamath.get_runs, or None if it failed,
+    with the error message in error. The design pool runs one worker per 
+    profile, so each worker sums the series in a single thread.
+    """
+    try:
+        import metamath
+        return generation, name, metamath.get_runs(L, l, R, a, max_runs, limit, threads = 1), None
+    except Exception as e:
+        return generation, name, None, "%s: %s" % (e.__class__.__name__, e)
+
 def check_if_exists(command, paths = None):
     try:
         os.stat(command)
@@ -259,7 +273,11 @@ class MetLabGUI(MetLabInterface):
         super(MetLabGUI, self).__init__()
         
         self.profile_dir = "profiles"
-        self.jobs = {}
+        
+        # experimental design workers, and their results for the GUI thread
+        self.design_pool = None
+        self.design_results = Queue.Queue()
+        self.design_generation = 0
         
         self.gui = Tk()
         self.gui.wm_title("%s v. %s" % (self.__name__, self.__version__))
@@ -320,24 +338,69 @@ class MetLabGUI(MetLabInterface):
     def __del__(self):
         self.close()
     
-    def _run(self, cmd, formatting, callbacks):
-        pid = self.ask("start %s" % cmd)
-        self.jobs[pid] = (formatting,callbacks)
+    def close(self, stop_running = False):
+        if self.design_pool:
+            self.design_pool.terminate()
+            self.design_pool = None
+        super(MetLabGUI, self).close(stop_running)
     
     def _experimental_design_calculate(self, limit = 0.1, max_runs = 10):
-        
+        """
+        Evaluates all sequencing profiles concurrently in the experimental 
+        design worker pool, which is separate from the pipeline queue. The 
+        results come back through _experimental_design_done, and are shown by
+        _experimental_design_result.
+        """
         a = float(self.experimental_design['abundance'].get())/100.0
         L = bp_to_int(self.experimental_design['genome_size'].get())
         
+        if not self.design_pool:
+            processes = max(1, min(len(self.profiles), multiprocessing.cpu_count()))
+            self.design_pool = multiprocessing.Pool(processes)
+        # results of earlier calculations are ignored when they arrive
+        self.design_generation += 1
         for name, profile in self.profiles.iteritems():
             l = profile['read_length_mean']
             R = profile['default_reads']
             self.log.info("Calculating probabilities for %s runs" % name)
-            self._run("./metlab/metamath.py -L %s -l %s -R %s -a %s -m %i -p %s" % (L,l,R,a,max_runs,limit),
-                      ("(%i runs)", "%3.5f"),
-                      (self.experimental_design['probability_comment'][name],
-                       self.experimental_design['probabilities'][name])
-                     )
+            self.experimental_design['probability_comment'][name].set('')
+            self.experimental_design['probabilities'][name].set('...')
+            self.design_pool.apply_async(design_runs, 
+                                         (self.design_generation, name, L, l, R, a, max_runs, limit),
+                                         callback = self._experimental_design_done)
+    
+    def _experimental_design_done(self, result):
+        """
+        Called from the worker pool's result thread: queues the result, and 
+        wakes the Tk event loop to show it. Widgets may only be updated from 
+        the GUI thread, and an exception here would stop the pool from 
+        handling any more results, so errors (e.g. after the window is 
+        closed) are only logged.
+        """
+        self.design_results.put(result)
+        try:
+            self.gui.event_generate("<<DesignResult>>", when="tail")
+        except Exception as e:
+            self.log.debug("Could not deliver experimental design result: %s" % e)
+    
+    def _experimental_design_result(self, event = None):
+        """
+        Shows the queued experimental design results, in the GUI thread.
+        """
+        while True:
+            try:
+                generation, name, result, error = self.design_results.get_nowait()
+            except Queue.Empty:
+                break
+            if generation != self.design_generation:
+                continue
+            if error:
+                self.log.error("Could not calculate probabilities for %s: %s" % (name, error))
+                self.experimental_design['probabilities'][name].set('-')
+                continue
+            runs, p = result
+            self.experimental_design['probability_comment'][name].set("(%i runs)" % runs)
+            self.experimental_design['probabilities'][name].set("%3.5f" % p)
     
     def _frame_experimental_design(self, parent):
         """
@@ -388,6 +451,7 @@ class MetLabGUI(MetLabInterface):
         
             arg_in = Button(settings_pane, text="Calculate", command=self._experimental_design_calculate
                             ).pack(side='left', anchor='nw')
+            self.gui.bind("<<DesignResult>>", self._experimental_design_result)
         
             settings_pane.pack(side='left', anchor='nw')
         
@@ -787,20 +851,8 @@ class MetLabGUI(MetLabInterface):
     
     def _stay_alive(self, interval = 1):
         self.status()
-        finished = []
-        for job in self.jobs:
-            retval =  self.ask("retval %s" % job)
-            if retval != "None":
-                formatting, controllers = self.jobs[job]
-                return_values = eval(retval)
-                for i, controller in enumerate(controllers):
-                    controller.set(formatting[i] % return_values[i])
-                finished += [job]
-        
         queue = self.ask("queue").split("|")
         self._set_queue(queue)
-        for job in finished:
-            del self.jobs[job]
         self.gui.after(int(interval*1000), self._stay_alive)
     
     def _stop_pipeline(self):
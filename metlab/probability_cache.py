@@ -0,0 +1,153 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Persistent cache for coverage probabilities calculated by metamath.
+
+Results are stored as json in a small sqlite database, keyed by the function
+name, its normalized arguments, and the version and tolerance of the
+calculation, so that the GUI, the controller and the metamath command line
+share them between sessions. The cache has a size cap, and evicts the least
+recently used results when it grows past it, checked every EVICT_INTERVAL
+stores.
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".metlab", "probabilities.sqlite3")
+
+DEFAULT_CACHE_ENTRIES = 2**17
+
+# Number of stored results between checks of the cache size
+EVICT_INTERVAL = 256
+
+CACHE_SCHEMA = [
+"""CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    accessed REAL);""",
+"""CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);"""]
+
+class ProbabilityCache(object):
+    """
+    Least recently used cache of json-serializable results.
+    """
+
+    def __init__(self, database = DEFAULT_CACHE_FILE, max_entries = DEFAULT_CACHE_ENTRIES,
+                 log = None):
+        """
+        Opens (and creates if needed) the cache database `database`, limited
+        to `max_entries` results.
+        """
+        self.database    = database
+        self.max_entries = max_entries
+        self.log         = log if log else logging.getLogger( __name__ )
+        self._puts       = 0
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(database))):
+            os.makedirs(os.path.dirname(os.path.abspath(database)))
+        for table in CACHE_SCHEMA:
+            self._query( table )
+
+    def _query(self, query, *args):
+        con = None
+        data = None
+
+        try:
+            con = sqlite3.connect( self.database, timeout = 60 )
+            cur = con.cursor()
+            cur.execute(query, tuple(args))
+            data = cur.fetchall()
+            if not data:
+                con.commit()
+        except sqlite3.Error as e:
+            self.log.error("Cache database error: %s" % e)
+        finally:
+            if con:
+                con.close()
+        return data
+
+    @staticmethod
+    def key(*args):
+        """
+        Returns the database key of a list of json-serializable values.
+        """
+        return json.dumps(args, separators = (',', ':'))
+
+    def get(self, key):
+        """
+        Returns the cached result for `key`, or None if it isn't cached.
+        """
+        con = None
+        data = None
+
+        try:
+            con = sqlite3.connect( self.database, timeout = 60 )
+            cur = con.cursor()
+            cur.execute("SELECT value FROM results WHERE key = ?", (key,))
+            data = cur.fetchall()
+            if data:
+                cur.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+                con.commit()
+        except sqlite3.Error as e:
+            self.log.error("Cache database error: %s" % e)
+        finally:
+            if con:
+                con.close()
+        return json.loads(data[0][0]) if data else None
+
+    def put(self, key, value):
+        """
+        Stores a json-serializable result under `key`. Every EVICT_INTERVAL 
+        stores, old results are evicted if the cache has grown too large.
+        """
+        self._query("INSERT OR REPLACE INTO results (key, value, accessed) "
+                    "VALUES (?, ?, ?)", key, json.dumps(value), time.time())
+        self._puts += 1
+        if self._puts % EVICT_INTERVAL == 1:
+            self.evict()
+
+    def size(self):
+        """
+        Returns the number of cached results.
+        """
+        data = self._query("SELECT COUNT(*) FROM results")
+        return data[0][0] if data else 0
+
+    def evict(self, max_entries = None):
+        """
+        Removes the least recently used results until the cache holds at most
+        `max_entries` (default: the cache size cap).
+        """
+        max_entries = self.max_entries if max_entries is None else max_entries
+        excess = self.size() - max_entries
+        if excess > 0:
+            self.log.debug("Evicting %i results from probability cache" % excess)
+            self._query("DELETE FROM results WHERE key IN (SELECT key FROM results "
+                        "ORDER BY accessed ASC LIMIT ?)", excess)
+
+    def clear(self):
+        """
+        Removes everything from the cache.
+        """
+        self._query("DELETE FROM results")
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser( description = __doc__ )
+
+    parser.add_argument("-d", "--database", help="Cache database.", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--clear", help="Remove all cached results.", action="store_true",
+                        default=False)
+
+    args = parser.parse_args()
+
+    cache = ProbabilityCache(args.database)
+    if args.clear:
+        cache.clear()
+    print "%i results" % cache.size()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Local reference collection for MetaMaker.
+
+Indexes a directory of FASTA and/or GenBank files, so that datasets can be
+assembled without any network access. The index holds one row per record
+(id, organism, taxonomy id, lineage, length and file position) and is built
+once, stored next to the files and memory-mapped when loaded. Records from
+the same organism in the same file (e.g. segments or chromosomes) are
+grouped into one genome.
+"""
+
+import os
+import re
+import json
+import numpy
+import logging
+from Bio import SeqIO
+
+INDEX_NAME = ".metlab_index"
+
+INDEX_VERSION = 2
+
+FORMATS = {'fa':'fasta', 'fasta':'fasta', 'fna':'fasta', 'ffn':'fasta',
+           'gb':'genbank', 'gbk':'genbank', 'genbank':'genbank', 'gbff':'genbank'}
+
+RECORD_START = {'fasta':'>', 'genbank':'LOCUS'}
+
+# index fields, where the string fields (type 'S') are sized to the longest
+# value when the index is built
+INDEX_FIELDS = [('id',          'S'),
+                ('description', 'S'),
+                ('organism',    'S'),
+                ('lineage',     'S'),
+                ('taxid',       '<i8'),
+                ('length',      '<i8'),
+                ('file',        '<i4'),
+                ('offset',      '<i8'),
+                ('genome',      '<i8')]
+
+def index_dtype(rows):
+    """
+    Returns the index dtype for a list of index rows, with string fields wide
+    enough for their longest values, so that nothing is truncated.
+    """
+    fields = []
+    for i, (name, kind) in enumerate(INDEX_FIELDS):
+        if kind == 'S':
+            kind = 'S%i' % max([len(row[i]) for row in rows] + [1])
+        fields += [(name, kind)]
+    return numpy.dtype(fields)
+
+# taxonomy id annotations in fasta headers, e.g. "taxid=1234" or the kraken
+# style "|kraken:taxid|1234"
+FASTA_TAXID = re.compile(r'\|?kraken:taxid\|(\d+)\|?|\btaxid[=:](\d+)')
+
+# segment annotations, so that segments are grouped into a single genome
+SEGMENT = re.compile(r'\s+(segment|chromosome|plasmid)\s+\S+$', re.I)
+
+class ReferenceIndex(object):
+    """
+    Memory-mapped index over a directory of reference sequences.
+    """
+
+    def __init__(self, directory, log = None):
+        """
+        Loads the index for `directory`, building it first if it's missing or
+        if the reference files have changed since it was built.
+        """
+        self.directory = directory
+        self.log = log if log else logging.getLogger( __name__ )
+        self.index_file = os.path.join(directory, "%s.npy" % INDEX_NAME)
+        self.info_file  = os.path.join(directory, "%s.json" % INDEX_NAME)
+
+        files = self._list_files()
+        info = None
+        try:
+            info = json.load(open(self.info_file))
+        except (IOError, ValueError):
+            pass
+        if not info or info.get('version') != INDEX_VERSION or info.get('files') != files:
+            self.build(files)
+            info = json.load(open(self.info_file))
+        self.files = [f for f, _, _ in info['files']]
+        self.index = numpy.load(self.index_file, mmap_mode = 'r')
+        self._genome_starts = numpy.searchsorted(self.index['genome'],
+                                                 numpy.arange(self.genomes() + 1))
+
+    def _list_files(self):
+        """
+        Returns a sorted list of [name, size, mtime] for all reference files.
+        """
+        files = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.split('.')[-1].lower() in FORMATS and name[0] != '.':
+                stat = os.stat(os.path.join(self.directory, name))
+                files += [[name, stat.st_size, int(stat.st_mtime)]]
+        return files
+
+    @staticmethod
+    def _format(name):
+        return FORMATS[name.split('.')[-1].lower()]
+
+    def _record_offsets(self, path, file_format):
+        """
+        Returns the byte offsets of all records in a file.
+        """
+        offsets = []
+        start = RECORD_START[file_format]
+        with open(path, 'rb') as handle:
+            while True:
+                offset = handle.tell()
+                line = handle.readline()
+                if not line:
+                    break
+                if line.startswith(start):
+                    offsets += [offset]
+        return offsets
+
+    def _describe(self, record, file_format):
+        """
+        Returns (description, organism, lineage, taxid) for a record.
+        """
+        description = record.description
+        if file_format == 'genbank':
+            organism = record.annotations.get('organism', '')
+            lineage  = "; ".join(record.annotations.get('taxonomy', []))
+            taxid    = 0
+            for feature in record.features:
+                if feature.type != 'source':
+                    continue
+                for xref in feature.qualifiers.get('db_xref', []):
+                    if xref.startswith('taxon:'):
+                        taxid = int(xref.split(':')[1])
+                break
+        else:
+            if description.startswith(record.id):
+                description = description[len(record.id):].strip()
+            match = FASTA_TAXID.search(record.id + " " + description)
+            taxid = int(match.group(1) or match.group(2)) if match else 0
+            description = FASTA_TAXID.sub('', description).strip()
+            organism = SEGMENT.sub('', description.split(',')[0].strip())
+            lineage  = ''
+        return description, organism, lineage, taxid
+
+    def build(self, files = None):
+        """
+        Builds the index for all reference files in the directory.
+        """
+        files = files if files is not None else self._list_files()
+        self.log.info("Indexing %i reference files in %s" % (len(files), self.directory))
+
+        rows = []
+        genomes = {}
+        for file_index, (name, _, _) in enumerate(files):
+            path = os.path.join(self.directory, name)
+            file_format = self._format(name)
+            with open(path, 'rb') as handle:
+                for offset in self._record_offsets(path, file_format):
+                    handle.seek(offset)
+                    record = next(SeqIO.parse(handle, file_format))
+                    description, organism, lineage, taxid = self._describe(record,
+                                                                           file_format)
+                    key = (file_index, organism, taxid)
+                    if key not in genomes:
+                        genomes[key] = len(genomes)
+                    rows += [(record.id, description, organism, lineage, taxid,
+                              len(record.seq), file_index, offset, genomes[key])]
+
+        index = numpy.array(rows, dtype = index_dtype(rows))
+        index = index[numpy.argsort(index['genome'], kind = 'mergesort')]
+        numpy.save(self.index_file, index)
+        with open(self.info_file, 'w') as info:
+            info.write(json.dumps({'version':INDEX_VERSION, 'files':files}))
+        self.log.info(" + Indexed %i records in %i genomes" % (len(index), len(genomes)))
+
+    def genomes(self):
+        """
+        Returns the number of genomes in the index.
+        """
+        return int(self.index['genome'][-1]) + 1 if len(self.index) else 0
+
+    def records(self, genome):
+        """
+        Returns the index rows of all records in a genome.
+        """
+        return self.index[self._genome_starts[genome]:self._genome_starts[genome+1]]
+
+    def select(self, taxa = None):
+        """
+        Returns the indices of all genomes matching `taxa`, which can be a
+        taxonomy id, or a name matched (case-insensitively) against the
+        lineage, organism name and description. If the index doesn't have any
+        lineage information (e.g. fasta only), names aren't filtered.
+        """
+        first = self.index[self._genome_starts[:-1]]
+        if not taxa or str(taxa).lower() == 'all':
+            return numpy.arange(len(first))
+        if str(taxa).isdigit():
+            return numpy.nonzero(first['taxid'] == int(taxa))[0]
+        if not (numpy.char.str_len(first['lineage']) > 0).any():
+            self.log.info("No lineage information in reference index, using all genomes")
+            return numpy.arange(len(first))
+        taxa = str(taxa).lower()
+        match = numpy.zeros(len(first), bool)
+        for field in ['lineage', 'organism', 'description']:
+            match |= numpy.char.find(numpy.char.lower(first[field]), taxa) >= 0
+        return numpy.nonzero(match)[0]
+
+    def load(self, genome):
+        """
+        Reads the sequences of a genome, returned as a list of (record id,
+        uint8 sequence array) tuples.
+        """
+        output = []
+        handles = {}
+        for row in self.records(genome):
+            name = self.files[row['file']]
+            if name not in handles:
+                handles[name] = open(os.path.join(self.directory, name), 'rb')
+            handle = handles[name]
+            handle.seek(row['offset'])
+            record = next(SeqIO.parse(handle, self._format(name)))
+            output += [(record.id, numpy.frombuffer(str(record.seq), numpy.uint8))]
+        for handle in handles.values():
+            handle.close()
+        return output
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser( description = __doc__ )
+
+    parser.add_argument("directory", help="Directory of reference fasta/genbank files.")
+    parser.add_argument("-x", "--taxa", help="List genomes matching taxa.", default=None)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    index = ReferenceIndex(args.directory)
+    for genome in index.select(args.taxa):
+        records = index.records(genome)
+        print "%s\t%s\t%i\t%i" % (records[0]['id'], records[0]['organism'],
+                                  records[0]['taxid'], records['length'].sum())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+"""
+Binary truth index for simulated reads.
+
+MetaMaker can write the origin of every simulated read to a .npy file holding
+a structured array with one row per read (and mate): the read number in the
+output, the dataset index and taxonomy id of its genome, the genome record,
+the read position, which mate it is, and the number of sequencing errors.
+The file is written incrementally, with the array header rewritten when it's
+closed, and can be memory-mapped with load_truth for evaluation.
+"""
+
+import numpy
+import struct
+
+TRUTH_DTYPE = numpy.dtype([('read',   '<u8'),
+                           ('genome', '<u4'),
+                           ('taxid',  '<i4'),
+                           ('record', '<u4'),
+                           ('start',  '<i8'),
+                           ('end',    '<i8'),
+                           ('mate',   'u1'),
+                           ('errors', '<u2')])
+
+NPY_MAGIC = "\x93NUMPY\x01\x00"
+
+def _npy_header(dtype, count, size = None):
+    """
+    Returns a version 1.0 .npy header for a 1-d array of `count` rows,
+    padded to `size` bytes (by default, the size needed for any row count).
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%i,), }" % \
+             (numpy.lib.format.dtype_to_descr(dtype), count)
+    if size is None:
+        # room for a 20 digit row count, aligned to 64 bytes
+        size = (len(NPY_MAGIC) + 2 + len(header) + 21 + 63) // 64 * 64
+    header = header.ljust(size - len(NPY_MAGIC) - 3) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header
+
+class TruthWriter(object):
+    """
+    Writes truth rows to a .npy file as they are generated.
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows = 0
+        self.handle = open(filename, 'wb')
+        self.header_size = len(_npy_header(TRUTH_DTYPE, 0))
+        self.handle.write(_npy_header(TRUTH_DTYPE, 0))
+    
+    def write(self, rows):
+        """
+        Appends a TRUTH_DTYPE array to the file.
+        """
+        self.handle.write(numpy.asarray(rows, TRUTH_DTYPE).tostring())
+        self.rows += len(rows)
+    
+    def close(self):
+        """
+        Writes the final row count to the header, and closes the file.
+        """
+        self.handle.seek(0)
+        self.handle.write(_npy_header(TRUTH_DTYPE, self.rows, self.header_size))
+        self.handle.close()
+
+def truth_rows(reads, read_offset, taxids):
+    """
+    Returns the truth rows of a batch of reads, as given by
+    MetaMaker.iter_reads, where read_offset is the output number of the first
+    read, and taxids the taxonomy ids of the dataset genomes. Mates get one
+    row each, in the order (read 1 mate 1, read 1 mate 2, read 2 mate 1...).
+    """
+    count = len(reads[0])
+    rows = numpy.zeros((count, len(reads)), TRUTH_DTYPE)
+    for mate, batch in enumerate(reads):
+        rows['read'][:,mate]   = read_offset + numpy.arange(count)
+        rows['genome'][:,mate] = batch.genome
+        rows['taxid'][:,mate]  = taxids[batch.genome]
+        rows['record'][:,mate] = batch.record
+        rows['start'][:,mate]  = batch.start
+        rows['end'][:,mate]    = batch.end
+        rows['mate'][:,mate]   = mate + 1 if len(reads) > 1 else 0
+        rows['errors'][:,mate] = batch.errors
+    return rows.reshape(-1)
+
+def load_truth(filename):
+    """
+    Returns the truth index of a simulated dataset as a memory-mapped
+    structured array.
+    """
+    return numpy.load(filename, mmap_mode = 'r')
+
+if __name__ == '__main__':
+    
+    import argparse
+    
+    parser = argparse.ArgumentParser( description = __doc__ )
+    
+    parser.add_argument("truth", help="Truth index (.npy) written by MetaMaker.")
+    
+    args = parser.parse_args()
+    
+    truth = load_truth(args.truth)
+    print "%i rows" % len(truth)
+    print "genome\ttaxid\treads\terrors"
+    genomes = numpy.bincount(truth['genome'])
+    errors = numpy.bincount(truth['genome'], weights = truth['errors'])
+    for genome in numpy.nonzero(genomes)[0]:
+        taxid = truth['taxid'][numpy.argmax(truth['genome'] == genome)]
+        print "%i\t%i\t%i\t%i" % (genome, taxid, genomes[genome], errors[genome])
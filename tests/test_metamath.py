@@ -0,0 +1,146 @@
+#!/usr/bin/env python2.7
+"""
+Regression tests of the metamath series evaluation, comparing the adaptive 
+recurrences, the grid functions and the float64 tier with the direct 
+summation reference, within the reported error bounds.
+"""
+
+import os
+import sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "metlab"))
+
+import metamath
+from metamath import workdps
+
+metamath.USE_CACHE = False
+
+# (L, l, R, a, k), small enough for the direct sums to converge at 128 digits.
+# L/l = 100.7 rounds up, unlike its integer part.
+CASES = [(10000,100,1000,0.5,2), (100000,150,50000,0.1,2), (20000,100,5000,0.2,2), 
+         (10000,50,2000,0.3,2), (10070,100,1500,0.4,1)]
+
+# Slack for rounding the 128 digit reference and the comparison to float64
+SLACK = 1e-15
+
+class DirectSummationTest(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.direct = {}
+        for L,l,R,a,k in CASES:
+            with workdps(128):
+                cls.direct[(L,l,R,a,k)] = (
+                    float(metamath._full_coverage_direct(L,l,R,a)),
+                    [float(metamath._gap_consensus_direct(L,l,R,a,j)) for j in xrange(k+1)])
+    
+    def assertWithin(self, p, error, reference, case):
+        self.assertLessEqual(abs(p - reference), error + SLACK, 
+                             "%s: %.12g != %.12g (error <= %.3g)" % (case, p, reference, error))
+    
+    def test_series_length(self):
+        self.assertEqual(metamath._series_length(10070, 100, 1500), 101)
+        self.assertEqual(metamath._series_length(10040, 100, 1500), 100)
+        self.assertEqual(metamath._series_length(10070, 100, 50), 50)
+    
+    def test_full_coverage_mpmath(self):
+        for case in CASES:
+            p, error, precision = metamath._full_coverage(*case[:4])
+            self.assertWithin(p, error, self.direct[case][0], case)
+    
+    def test_gap_consensus_mpmath(self):
+        for case in CASES:
+            for k in xrange(case[4]+1):
+                p, error, precision = metamath._gap_consensus(*case[:4] + (k,))
+                self.assertWithin(p, error, self.direct[case][1][k], case)
+    
+    def test_full_coverage_bounds(self):
+        for case in CASES:
+            p, error, precision = metamath.full_coverage_bounds(*case[:4])
+            self.assertWithin(p, error, self.direct[case][0], case)
+    
+    def test_gap_consensus_bounds(self):
+        for case in CASES:
+            p, error, precision = metamath.gap_consensus_bounds(*case)
+            self.assertWithin(p, error, self.direct[case][1][case[4]], case)
+    
+    def test_full_coverage(self):
+        for case in CASES:
+            p, error, tier = metamath.full_coverage_tiered(*case[:4])
+            self.assertLessEqual(error, metamath.TOLERANCE)
+            self.assertWithin(metamath.full_coverage(*case[:4]), metamath.TOLERANCE, 
+                              self.direct[case][0], case)
+    
+    def test_gap_consensus(self):
+        for case in CASES:
+            self.assertWithin(metamath.gap_consensus(*case), metamath.TOLERANCE, 
+                              self.direct[case][1][case[4]], case)
+    
+    def test_full_coverage_grid(self):
+        L, l, R, a = [numpy.array([case[i] for case in CASES]) for i in xrange(4)]
+        p, errors = metamath.full_coverage_grid(L, l, R, a, bounds = True)
+        for case, x, error in zip(CASES, p, errors):
+            self.assertWithin(x, error, self.direct[case][0], case)
+        self.assertTrue(numpy.array_equal(p, metamath.full_coverage_grid(L, l, R, a)))
+    
+    def test_full_coverage_grid_mpmath(self):
+        cases = sorted(CASES)
+        p, errors = metamath._full_coverage_grid(*[[case[i] for case in cases] for i in xrange(4)])
+        for case, x, error in zip(cases, p, errors):
+            self.assertWithin(x, error, self.direct[case][0], case)
+    
+    def test_gap_distribution(self):
+        for case in CASES:
+            p, errors = metamath.gap_distribution(*case)
+            for k in xrange(case[4]+1):
+                self.assertWithin(p[k], errors[k], self.direct[case][1][k], case)
+            self.assertWithin(p[0], errors[0], self.direct[case][0], case)
+    
+    def test_gap_distribution_mpmath(self):
+        for case in CASES:
+            p, errors = metamath._gap_distribution(*case)
+            for k in xrange(case[4]+1):
+                self.assertWithin(p[k], errors[k], self.direct[case][1][k], case)
+    
+    def test_coverage_curve(self):
+        L, l, R, a, k = CASES[0]
+        reads = [R//2, R, 2*R]
+        p, errors = metamath.coverage_curve(L, l, reads, a, k)
+        for i, r in enumerate(reads):
+            for j in xrange(k+1):
+                x, error, precision = metamath.gap_consensus_bounds(L, l, r, a, j)
+                self.assertLessEqual(abs(p[i,j] - x), errors[i,j] + error + SLACK)
+    
+    def test_probability_range(self):
+        # the series sums to a tiny negative number without clamping
+        p, error, precision = metamath.full_coverage_bounds(10000, 50, 2000, 0.3)
+        self.assertEqual(p, 0.0)
+        self.assertGreater(error, 0.0)
+        self.assertGreaterEqual(metamath.full_coverage(10000, 50, 2000, 0.3), 0.0)
+        p, errors = metamath.full_coverage_grid([10000], [50], [2000], [0.3], bounds = True)
+        self.assertEqual(p[0], 0.0)
+    
+    @unittest.skipUnless(metamath.metapprox, "the metapprox extension isn't built")
+    def test_extension_agrees_with_mpmath(self):
+        for case in CASES:
+            c = metamath.metapprox.full_coverage(*case[:4] + (metamath.TOLERANCE, 1))
+            py = metamath._full_coverage(*case[:4])
+            self.assertLessEqual(abs(c[0] - py[0]), c[1] + py[1] + SLACK, case)
+            c = metamath.metapprox.gap_consensus(*case + (metamath.TOLERANCE, 1))
+            py = metamath._gap_consensus(*case)
+            self.assertLessEqual(abs(c[0] - py[0]), c[1] + py[1] + SLACK, case)
+
+class MinReadsTest(unittest.TestCase):
+    
+    def test_minimum(self):
+        for k in [None, 1]:
+            R, p = metamath.min_reads(50000, 250, 0.05, 0.1, k)
+            below = metamath.min_reads(50000, 250, 0.05, 0.1, k, max_reads = R-1)
+            self.assertGreaterEqual(p, 0.1)
+            self.assertEqual(below[0], None)
+            self.assertLess(below[1], 0.1)
+
+if __name__ == '__main__':
+    unittest.main()